@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+import ocr_backends
+import payload
+import preprocess
+import schema
+from llm_scheduler import LLMScheduler
+from pipeline import (
+    IMAGE_EXTENSIONS,
+    PDF_EXTENSIONS,
+    extract_json_text,
+    fill_known_fields,
+    is_pdf_name,
+    load_cached_json,
+    merge_extractions,
+    plan_document_extraction,
+    prepare_document,
+    rules_only_extraction,
+    store_cached_json,
+)
+
+# Processamento em lote de documentos sem a interface Streamlit.
+# Exemplo: python batch.py notas/ --saida resultados.ndjson --workers 8
+
+# Função para listar os documentos a partir de um diretório ou de um manifesto
+# O manifesto é um arquivo texto com um caminho por linha (linhas vazias e iniciadas com # são ignoradas)
+def collect_documents(source):
+    extensions = PDF_EXTENSIONS + IMAGE_EXTENSIONS
+    if os.path.isdir(source):
+        documents = []
+        for root, _, files in os.walk(source):
+            for file_name in files:
+                if file_name.lower().endswith(extensions):
+                    documents.append(os.path.join(root, file_name))
+        return sorted(documents)
+
+    base_dir = os.path.dirname(os.path.abspath(source))
+    documents = []
+    with open(source, encoding='utf-8') as manifest:
+        for line in manifest:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if not os.path.isabs(line):
+                line = os.path.join(base_dir, line)
+            documents.append(line)
+    return documents
+
+# Função para obter o modo de execução gravado nos registros: completo ou sem-llm (apenas renderização e OCR)
+def run_mode(llm_options):
+    return "sem-llm" if llm_options is None else "completo"
+
+# Função para carregar os documentos já processados no mesmo modo (retomada após reinício)
+# Documentos com notas inválidas não são refeitos: o resultado seria o mesmo (cache do modelo).
+# Registros de uma execução sem o modelo não contam para uma execução completa e vice-versa;
+# os gravados antes do campo "modo" são completos quando trazem as notas ("dados")
+def load_completed(output_path, mode="completo"):
+    completed = set()
+    if not os.path.exists(output_path):
+        return completed
+    with open(output_path, encoding='utf-8') as output_file:
+        for line in output_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Linha truncada por uma interrupção; o documento será reprocessado
+                continue
+            record_mode = record.get("modo", "completo" if "dados" in record else "sem-llm")
+            if record.get("status") in ("ok", "invalido") and record_mode == mode:
+                completed.add(record["arquivo"])
+    return completed
+
+# Função executada nos processos do pool: renderização, OCR, regras e montagem das mensagens de um documento
+# As etapas medidas no processo voltam em "trace" para entrar nas métricas do processo principal
+def prepare_worker(path, use_cache=True):
+    started = time.perf_counter()
+    with metrics.collect_trace() as trace:
+        try:
+            with open(path, 'rb') as document:
+                file_bytes = document.read()
+            prepared = prepare_document(file_bytes, is_pdf_name(path), use_cache, keep_previews=False)
+            plans = plan_document_extraction(prepared)
+        except Exception as e:
+            return {"arquivo": path, "erro": f"{type(e).__name__}: {e}", "trace": trace}
+    return {
+        "arquivo": path,
+        "paginas": prepared["page_count"],
+        "ocr_text": prepared["ocr_text"],
+        "text_path": prepared["text_path"],
+        "ocr_pages": prepared["text_sources"].count("ocr"),
+        "ocr_backend": prepared["ocr_backend"],
+        "ocr_latencies": [round(latency, 3) for latency in prepared["ocr_latencies"]],
+        "payload_bytes": sum(part["payload"]["bytes"] for part in prepared["parts"] if part["payload"] is not None),
+        "image_pages": [part["image_pages"] for part in prepared["parts"]],
+        "layout": prepared["layout"]["modelo"] if prepared["layout"] is not None else None,
+        "plans": plans,
+        "tempo_preparo": round(time.perf_counter() - started, 3),
+        "trace": trace,
+    }
+
+# Função para extrair uma parte do documento (uma nota fiscal) pelo agendador, consultando o cache
+# Retorna o JSON interpretado, a origem do resultado (regras, cache ou llm) e os tokens consumidos
+async def extract_part(scheduler, plan, use_cache=True):
+    message_content = plan["message_content"]
+    if message_content is None:
+        return rules_only_extraction(plan["known"]), "regras", 0
+    cached_json = load_cached_json(message_content) if use_cache else None
+    if cached_json is not None:
+        return fill_known_fields(schema.loads(cached_json), plan["known"]), "cache", 0
+    raw_response, usage = await scheduler.complete(message_content)
+    parsed_json = schema.loads(extract_json_text(raw_response))
+    if use_cache:
+        store_cached_json(message_content, schema.dumps(parsed_json, indent=4))
+    return fill_known_fields(parsed_json, plan["known"]), "llm", usage.total_tokens if usage is not None else 0
+
+# Função para resumir as etapas medidas de um documento em {etapa: segundos}
+def stage_times(trace):
+    return {row["etapa"]: row["tempo"] for row in metrics.summarize_trace(trace)}
+
+# Função para chamar o modelo (pelo agendador) e montar o registro NDJSON de um documento
+async def build_record(scheduler, prepared, include_ocr, use_cache=True):
+    record = {"arquivo": prepared["arquivo"], "modo": "sem-llm" if scheduler is None else "completo"}
+    metrics.absorb_trace(prepared["trace"])
+    if "erro" in prepared:
+        record.update(status="erro", etapa="preparo", erro=prepared["erro"])
+        return record
+
+    record["paginas"] = prepared["paginas"]
+    record["tempo_preparo"] = prepared["tempo_preparo"]
+    # Caminho de extração do texto: texto (camada de texto do PDF), ocr ou misto
+    record["fonte_texto"] = prepared["text_path"]
+    record["paginas_ocr"] = prepared["ocr_pages"]
+    record["ocr_backend"] = prepared["ocr_backend"]
+    record["payload_bytes"] = prepared["payload_bytes"]
+    # Páginas enviadas como imagem em cada parte (uma parte por nota fiscal encontrada)
+    record["paginas_imagem"] = [[i + 1 for i in pages] for pages in prepared["image_pages"]]
+    # Campos obtidos pelas regras e partes em que o modelo foi dispensado
+    plans = prepared["plans"]
+    record["partes"] = len(plans)
+    record["partes_sem_llm"] = sum(1 for plan in plans if plan["message_content"] is None)
+    record["campos_regras"] = sorted({field for plan in plans for field in plan["known"]})
+    # Modelo de layout memorizado usado no documento (campos lidos nas regiões, os demais pelo modelo)
+    if prepared["layout"] is not None:
+        record["layout"] = prepared["layout"]
+    record["ocr_latencias"] = prepared["ocr_latencies"]
+    if include_ocr:
+        record["ocr_text"] = prepared["ocr_text"]
+
+    # Tempo de cada etapa no documento (segundos; etapas aninhadas são inclusivas)
+    record["tempos"] = stage_times(prepared["trace"])
+
+    if scheduler is None:
+        record["status"] = "ok"
+        return record
+
+    started = time.perf_counter()
+    try:
+        # As partes seguem juntas para o agendador e os resultados são combinados
+        with metrics.collect_trace() as llm_trace:
+            results = await asyncio.gather(*(extract_part(scheduler, plan, use_cache) for plan in plans))
+        record["tempos"].update(stage_times(llm_trace))
+        # Notas normalizadas pelo esquema da NFS-e (valores decimais exatos, datas no formato da definição)
+        # Notas com campos obrigatórios ausentes ou valores inválidos ficam com o status "invalido"
+        record["dados"], errors = schema.validate(merge_extractions([parsed_json for parsed_json, _, _ in results]))
+        if errors:
+            record["validacao"] = [f"{field}: {message}" for field, message in errors]
+        if "llm" not in (origin for _, origin, _ in results) and "cache" in (origin for _, origin, _ in results):
+            record["cache"] = True
+        tokens = sum(tokens for _, _, tokens in results)
+        if tokens:
+            record["tokens"] = tokens
+        record["status"] = "invalido" if errors else "ok"
+    except json.JSONDecodeError as e:
+        record.update(status="erro", etapa="json", erro=str(e), resposta=e.doc)
+    except Exception as e:
+        record.update(status="erro", etapa="llm", erro=f"{type(e).__name__}: {e}")
+    record["tempo_llm"] = round(time.perf_counter() - started, 3)
+    return record
+
+# Função de inicialização dos processos do pool: o paralelismo já vem dos processos,
+# então cada um faz o OCR das suas páginas em sequência
+def init_worker(ocr_backend, payload_options, preprocess_steps=None, profile_stages=None):
+    ocr_backends.configure(backend=ocr_backend, workers=1)
+    payload.configure(**payload_options)
+    preprocess.configure(steps=preprocess_steps)
+    metrics.configure(profile=profile_stages)
+
+# Renderização e OCR rodam no pool de processos; as chamadas ao modelo, no agendador assíncrono.
+# Cada documento segue para o modelo assim que é preparado e o resultado é gravado ao concluir
+async def _run_batch(pending, output_file, pool, workers, llm_options, include_ocr, use_cache):
+    loop = asyncio.get_running_loop()
+    scheduler = LLMScheduler(**llm_options) if llm_options is not None else None
+    # Documentos preparados aguardando o modelo também ocupam memória: a janela limita os dois estágios
+    window = asyncio.Semaphore(workers * 2 + (scheduler.concurrency if scheduler else 0))
+    counters = {"processados": 0, "falhas": 0, "partes": 0, "partes_sem_llm": 0}
+
+    async def process(path):
+        async with window:
+            prepared = await loop.run_in_executor(pool, prepare_worker, path, use_cache)
+            record = await build_record(scheduler, prepared, include_ocr, use_cache)
+        output_file.write(schema.dumps(record) + "\n")
+        output_file.flush()
+        counters["processados"] += 1
+        if record["status"] != "ok":
+            counters["falhas"] += 1
+        counters["partes"] += record.get("partes", 0)
+        counters["partes_sem_llm"] += record.get("partes_sem_llm", 0)
+        progress = f"[{counters['processados']}/{len(pending)}] {record['status']} {record['arquivo']}"
+        if scheduler is not None:
+            gauges = scheduler.gauges()
+            progress += f" (LLM: fila {gauges['fila']}, em andamento {gauges['em_andamento']})"
+        print(progress, file=sys.stderr)
+
+    try:
+        await asyncio.gather(*(process(path) for path in pending))
+    finally:
+        if scheduler is not None:
+            await scheduler.close()
+    # Taxa de dispensa do modelo: partes (notas) com todos os campos obrigatórios obtidos pelas regras
+    if counters["partes"]:
+        print(
+            f"Modelo dispensado (regras) em {counters['partes_sem_llm']} de {counters['partes']} parte(s) "
+            f"({100 * counters['partes_sem_llm'] / counters['partes']:.0f}%)",
+            file=sys.stderr,
+        )
+    return counters["processados"], counters["falhas"]
+
+# Função para processar os documentos, gravando um resultado por linha
+# llm_options: argumentos do LLMScheduler, ou None para executar apenas renderização e OCR
+# As métricas do lote são gravadas ao final no arquivo do Prometheus (OFM_METRICS_FILE ou --metricas)
+def run_batch(documents, output_path, llm_options=None, workers=None, include_ocr=False, use_cache=True, ocr_backend=None, payload_options=None, preprocess_steps=None, profile_stages=None):
+    workers = workers or os.cpu_count() or 1
+    completed = load_completed(output_path, run_mode(llm_options))
+    pending = [path for path in documents if path not in completed]
+    print(f"{len(documents)} documentos, {len(completed)} já processados, {len(pending)} pendentes", file=sys.stderr)
+
+    initargs = (ocr_backend, payload_options or {}, preprocess_steps, profile_stages)
+    try:
+        with open(output_path, 'a', encoding='utf-8') as output_file, ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=initargs) as pool:
+            return asyncio.run(_run_batch(pending, output_file, pool, workers, llm_options, include_ocr, use_cache))
+    finally:
+        metrics.write_metrics_file()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extração em lote de NFS-e (PDF e imagens) para NDJSON.")
+    parser.add_argument("entrada", help="Diretório com os documentos ou manifesto com um caminho por linha")
+    parser.add_argument("--saida", default="resultados.ndjson", help="Arquivo NDJSON de saída (retomado se já existir)")
+    parser.add_argument("--workers", type=int, default=None, help="Número de processos para renderização e OCR (padrão: núcleos da CPU)")
+    parser.add_argument("--sem-llm", action="store_true", help="Executa apenas renderização e OCR, sem chamar o modelo")
+    parser.add_argument("--incluir-ocr", action="store_true", help="Inclui o texto do OCR em cada registro")
+    parser.add_argument("--ocr", choices=["auto", "tesserocr", "pytesseract"], default=None, help="Backend de OCR (padrão: OFM_OCR_BACKEND ou auto)")
+    parser.add_argument(
+        "--preprocessamento", default=None,
+        help=f"Etapas do pré-processamento antes do OCR, separadas por vírgula ({','.join(preprocess.PREPROCESS_STEPS_ALL)}; 'nenhuma' desliga; padrão: OFM_PREPROCESS)",
+    )
+    parser.add_argument("--layout", choices=payload.PAYLOAD_LAYOUTS, default=None, help="Disposição da imagem enviada ao modelo (padrão: OFM_PAYLOAD_LAYOUT)")
+    parser.add_argument("--max-pixels", type=int, default=None, help="Máximo de pixels da imagem enviada ao modelo")
+    parser.add_argument("--max-bytes", type=int, default=None, help="Máximo de bytes do JPEG enviado ao modelo")
+    parser.add_argument("--tons-de-cinza", action="store_true", default=None, help="Envia a imagem ao modelo em tons de cinza")
+    parser.add_argument("--concorrencia-llm", type=int, default=None, help="Máximo de chamadas simultâneas ao modelo (padrão: OFM_LLM_CONCURRENCY)")
+    parser.add_argument("--rpm", type=int, default=None, help="Cota de requisições por minuto (padrão: OFM_LLM_RPM)")
+    parser.add_argument("--tpm", type=int, default=None, help="Cota de tokens por minuto (padrão: OFM_LLM_TPM)")
+    parser.add_argument("--sem-cache", action="store_true", help="Ignora o cache em disco de páginas, OCR e JSON")
+    parser.add_argument("--metricas", default=None, help="Arquivo com as métricas por etapa no formato do Prometheus (padrão: OFM_METRICS_FILE)")
+    parser.add_argument(
+        "--perfil", default=None,
+        help="Etapas perfiladas com cProfile e tracemalloc, separadas por vírgula ('todas' para todas; padrão: OFM_PROFILE)",
+    )
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=os.getenv('OFM_LOG_LEVEL', 'INFO'), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    profile_stages = args.perfil.split(",") if args.perfil is not None else None
+    metrics.configure(metrics_file=args.metricas, profile=profile_stages)
+
+    llm_options = None
+    if not args.sem_llm:
+        api_key = os.getenv('GROQ_API_KEY')
+        if not api_key:
+            parser.error("A chave de API da Groq não foi encontrada (GROQ_API_KEY).")
+        # O endereço da API pode ser trocado por GROQ_BASE_URL (ex: servidor stub_llm.py)
+        llm_options = {
+            "api_key": api_key,
+            "concurrency": args.concorrencia_llm,
+            "requests_per_minute": args.rpm,
+            "tokens_per_minute": args.tpm,
+        }
+
+    documents = collect_documents(args.entrada)
+    payload_options = {
+        "layout": args.layout,
+        "max_pixels": args.max_pixels,
+        "max_bytes": args.max_bytes,
+        "grayscale": args.tons_de_cinza,
+    }
+    preprocess_steps = args.preprocessamento.split(",") if args.preprocessamento is not None else None
+    _, failures = run_batch(
+        documents, args.saida, llm_options, args.workers, args.incluir_ocr, not args.sem_cache, args.ocr, payload_options,
+        preprocess_steps, profile_stages,
+    )
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
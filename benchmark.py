@@ -0,0 +1,433 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+import unicodedata
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from groq import Groq
+
+import metrics
+import ocr_backends
+from images import encode_jpeg
+from pipeline import (
+    extract_json_text,
+    extract_parts,
+    plan_document_extraction,
+    prepare_document,
+    request_completion,
+    stream_completion,
+)
+from stub_llm import start_stub_server
+
+# Benchmark offline do pipeline: gera um corpus sintético determinístico de notas fiscais (PDFs com
+# camada de texto, PDFs digitalizados com ruído e inclinação e imagens soltas, com uma ou várias
+# páginas), processa cada documento pelo mesmo caminho do modo em lote (prepare_document,
+# plan_document_extraction e extract_parts, sem cache nem memória de layouts) contra o servidor stub_llm.py e
+# grava a vazão, os percentis de latência de cada etapa e o pico de memória por tamanho de
+# documento e número de processos em um arquivo JSON, que pode ser comparado com o de outro commit.
+# Exemplo: python benchmark.py --paginas 1,4,12 --workers 1,2,4 --saida benchmark.json
+#          python benchmark.py --saida novo.json --comparar benchmark.json
+
+# Tamanho da página dos PDFs (pontos, A4) e resolução das páginas digitalizadas (pixels por ponto)
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+SCAN_SCALE = 150 / 72
+# Linhas de serviço por página (a primeira página perde HEADER_SERVICES linhas para o cabeçalho),
+# altura da linha em pontos e escala da fonte das páginas digitalizadas
+SERVICES_PER_PAGE = 40
+HEADER_SERVICES = 10
+LINE_HEIGHT = 14
+SCAN_FONT_SCALE = 0.65
+# Percentis de latência informados para cada etapa
+PERCENTILES = (50, 90, 99)
+# Texto devolvido pelo OCR simulado (usado quando o Tesseract não está disponível)
+SIMULATED_OCR_TEXT = (
+    "NOTA FISCAL DE SERVIÇOS ELETRÔNICA - NFS-e\nNúmero da Nota: 000123\nData de Emissão: 05/10/2024\n"
+    "Prestador: Empresa Exemplo Ltda\nValor Total da Nota: R$ 1.234,56\n"
+)
+
+COMPANIES = ("Alfa Serviços Ltda", "Beta Consultoria S.A.", "Gama Tecnologia Ltda", "Delta Engenharia Eireli", "Ômega Manutenção Ltda")
+CITIES = ("São Paulo - SP", "Curitiba - PR", "Belo Horizonte - MG", "Porto Alegre - RS", "Recife - PE")
+SERVICES = (
+    "Consultoria em tecnologia da informação", "Manutenção preventiva de equipamentos", "Licenciamento de software",
+    "Treinamento de equipe", "Suporte técnico remoto", "Serviço de limpeza e conservação", "Desenvolvimento de sistemas",
+)
+
+# Função para calcular os dígitos verificadores de um CNPJ a partir dos 12 primeiros dígitos
+def _cnpj(rng):
+    digits = [rng.randrange(10) for _ in range(8)] + [0, 0, 0, 1]
+    for weights in ((5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2), (6, 5, 4, 3, 2, 9, 8, 7, 6, 5, 4, 3, 2)):
+        remainder = sum(digit * weight for digit, weight in zip(digits, weights)) % 11
+        digits.append(0 if remainder < 2 else 11 - remainder)
+    text = "".join(map(str, digits))
+    return f"{text[:2]}.{text[2:5]}.{text[5:8]}/{text[8:12]}-{text[12:]}"
+
+def _money(value):
+    return f"R$ {value:,.2f}".replace(",", "_").replace(".", ",").replace("_", ".")
+
+# Função para gerar as linhas de texto de cada página de uma nota fiscal sintética
+# A primeira página tem o cabeçalho, as seguintes continuam a lista de serviços e a última tem os totais
+def invoice_pages(rng, page_count):
+    number = rng.randrange(1, 99999)
+    issued = f"{rng.randrange(1, 29):02d}/{rng.randrange(1, 13):02d}/2024"
+    services = [
+        (rng.choice(SERVICES), round(rng.uniform(50, 5000), 2))
+        for _ in range(SERVICES_PER_PAGE * page_count - HEADER_SERVICES)
+    ]
+    total = sum(value for _, value in services)
+    header = [
+        "PREFEITURA MUNICIPAL - SECRETARIA DA FAZENDA",
+        "NOTA FISCAL DE SERVIÇOS ELETRÔNICA - NFS-e",
+        f"Número da Nota: {number:06d}    Data de Emissão: {issued} 10:{rng.randrange(60):02d}:00",
+        f"Prestador: {rng.choice(COMPANIES)}    CNPJ: {_cnpj(rng)}",
+        f"Tomador: {rng.choice(COMPANIES)}    CNPJ: {_cnpj(rng)}",
+        f"Município da prestação: {rng.choice(CITIES)}",
+        "DISCRIMINAÇÃO DOS SERVIÇOS",
+    ]
+    lines = [f"{description} .......... {_money(value)}" for description, value in services]
+    first_page = SERVICES_PER_PAGE - HEADER_SERVICES
+    chunks = [lines[:first_page]] + [lines[start:start + SERVICES_PER_PAGE] for start in range(first_page, len(lines), SERVICES_PER_PAGE)]
+    pages = [header + chunks[0]]
+    pages += [
+        [f"NFS-e {number:06d} - continuação (página {page_index + 1} de {page_count})"] + chunk
+        for page_index, chunk in enumerate(chunks[1:], start=1)
+    ]
+    pages[-1] += [f"Valor Total da Nota: {_money(total)}", f"ISS retido: {_money(round(total * 0.05, 2))}"]
+    return pages
+
+# Função para escapar um texto dentro de uma string de PDF
+def _pdf_string(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)").encode('cp1252', errors='replace')
+
+# Função para montar um PDF mínimo a partir das páginas
+# pages: [(conteúdo da página, JPEG em tons de cinza ou None, (largura, altura) do JPEG)]
+def build_pdf(pages):
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"]
+    page_ids = []
+    for content, jpeg, size in pages:
+        resources = b"/Font << /F1 3 0 R >>"
+        if jpeg is not None:
+            objects.append(
+                b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray /BitsPerComponent 8 "
+                b"/Filter /DCTDecode /Length %d >>\nstream\n" % (size[0], size[1], len(jpeg)) + jpeg + b"\nendstream"
+            )
+            resources += b" /XObject << /Im0 %d 0 R >>" % len(objects)
+        objects.append(b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] /Resources << %s >> /Contents %d 0 R >>"
+            % (PAGE_WIDTH, PAGE_HEIGHT, resources, content_id)
+        )
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % i for i in page_ids), len(page_ids))
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for object_id, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % object_id + body + b"\nendobj\n"
+    xref = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    output += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    output += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    return bytes(output)
+
+# Função para montar um PDF com camada de texto (uma página por lista de linhas)
+def text_layer_pdf(pages_lines):
+    pages = []
+    for lines in pages_lines:
+        content = b"BT /F1 10 Tf %d TL 40 %d Td " % (LINE_HEIGHT, PAGE_HEIGHT - 50)
+        content += b" ".join(b"(" + _pdf_string(line) + b") '" for line in lines) + b" ET"
+        pages.append((content, None, None))
+    return build_pdf(pages)
+
+# Função para desenhar as linhas de uma página como uma digitalização: texto rasterizado, inclinação,
+# desfoque e ruído. As fontes do OpenCV só têm ASCII, então os acentos são removidos
+def scanned_page(lines, rng):
+    width, height = round(PAGE_WIDTH * SCAN_SCALE), round(PAGE_HEIGHT * SCAN_SCALE)
+    image = np.full((height, width), 255, np.uint8)
+    line_height = round(LINE_HEIGHT * SCAN_SCALE)
+    for i, line in enumerate(lines):
+        ascii_line = unicodedata.normalize('NFKD', line).encode('ascii', 'ignore').decode('ascii')
+        origin = (round(40 * SCAN_SCALE), round(50 * SCAN_SCALE) + i * line_height)
+        cv2.putText(image, ascii_line, origin, cv2.FONT_HERSHEY_SIMPLEX, SCAN_FONT_SCALE, 0, 1, cv2.LINE_AA)
+    angle = rng.uniform(-3, 3)
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    image = cv2.warpAffine(image, matrix, (width, height), flags=cv2.INTER_LINEAR, borderValue=255)
+    image = cv2.GaussianBlur(image, (3, 3), 0.6)
+    noise = np.random.default_rng(rng.randrange(2 ** 32)).normal(0, 12, image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+# Função para montar um PDF digitalizado (só imagens JPEG, sem camada de texto)
+def scanned_pdf(pages_lines, rng):
+    pages = []
+    for lines in pages_lines:
+        image = scanned_page(lines, rng)
+        jpeg = encode_jpeg(image, quality=80, optimize=False)
+        pages.append((b"q %d 0 0 %d 0 0 cm /Im0 Do Q" % (PAGE_WIDTH, PAGE_HEIGHT), jpeg, (image.shape[1], image.shape[0])))
+    return build_pdf(pages)
+
+# Função para gerar o corpus: para cada número de páginas, `per_kind` documentos de cada tipo
+# (texto, digitalizado e, com uma página, imagem PNG). A mesma semente gera sempre os mesmos bytes
+def generate_corpus(page_counts, per_kind=2, seed=42):
+    rng = random.Random(seed)
+    corpus = []
+    for page_count in page_counts:
+        kinds = ("texto", "digitalizado", "imagem") if page_count == 1 else ("texto", "digitalizado")
+        for kind in kinds:
+            for i in range(per_kind):
+                pages_lines = invoice_pages(rng, page_count)
+                if kind == "texto":
+                    file_bytes, extension = text_layer_pdf(pages_lines), ".pdf"
+                elif kind == "digitalizado":
+                    file_bytes, extension = scanned_pdf(pages_lines, rng), ".pdf"
+                else:
+                    _, buffer = cv2.imencode('.png', scanned_page(pages_lines[0], rng))
+                    file_bytes, extension = buffer.tobytes(), ".png"
+                corpus.append({
+                    "nome": f"{kind}-{page_count:02d}p-{i + 1}{extension}",
+                    "tipo": kind,
+                    "paginas": page_count,
+                    "bytes": file_bytes,
+                    "referencia": ["\n".join(lines) for lines in pages_lines],
+                })
+    return corpus
+
+# Função para gravar o corpus em um diretório, com o texto de referência em <nome>.txt
+# (páginas separadas por form feed, o formato lido por python preprocess.py)
+def save_corpus(corpus, directory):
+    os.makedirs(directory, exist_ok=True)
+    for document in corpus:
+        path = os.path.join(directory, document["nome"])
+        with open(path, 'wb') as document_file:
+            document_file.write(document["bytes"])
+        with open(os.path.splitext(path)[0] + ".txt", 'w', encoding='utf-8') as reference_file:
+            reference_file.write("\f".join(document["referencia"]))
+
+# OCR simulado: o pré-processamento real roda antes (em ocr_backends) e o Tesseract é substituído
+# por um texto fixo após um atraso opcional por região
+def _simulated_ocr(delay):
+    def ocr(image, lang, psm=None):
+        if delay:
+            time.sleep(delay)
+        return SIMULATED_OCR_TEXT
+    return ocr
+
+_worker = {}
+
+# Função de inicialização dos processos do benchmark (como no modo em lote, o OCR de cada
+# processo roda em sequência)
+def init_worker(ocr_backend, simulated_delay, base_url, streaming):
+    if ocr_backend == "simulado":
+        ocr_backends.register_backend("simulado", _simulated_ocr(simulated_delay))
+    ocr_backends.configure(backend=ocr_backend, workers=1)
+    _worker["client"] = Groq(api_key="benchmark", base_url=base_url, max_retries=0)
+    _worker["streaming"] = streaming
+    _worker["memoria_base"] = _max_rss()
+
+# Função para obter o pico de memória residente do processo em bytes (ru_maxrss é informado em KB no Linux)
+def _max_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+# Função executada uma vez em cada processo antes da medição (os processos já iniciados não entram no tempo)
+def warm_up(_):
+    return os.getpid()
+
+# Função para obter o texto do JSON de uma mensagem pelo modelo stub (em streaming ou não)
+def _complete(message_content):
+    if _worker["streaming"]:
+        return stream_completion(_worker["client"], message_content)[0]
+    return extract_json_text(request_completion(_worker["client"], message_content))
+
+# Função executada nos processos: preparação (renderização, camada de texto ou OCR, classificação
+# das páginas e imagem do modelo), regras, chamadas ao modelo stub e interpretação do JSON de um
+# documento, como no modo em lote. As etapas internas do pipeline (renderizacao, ocr, payload,
+# jpeg, prompt, modelo...) entram no detalhamento junto com preparo e extracao
+# Retorna o tempo total, os eventos das etapas e o pico de memória do processo
+def run_document(document):
+    started = time.perf_counter()
+    error = None
+    with metrics.collect_trace() as trace:
+        try:
+            is_pdf = document["nome"].endswith(".pdf")
+            with metrics.stage("preparo", paginas=document["paginas"]):
+                prepared = prepare_document(document["bytes"], is_pdf, use_cache=False, keep_previews=False, use_layouts=False)
+            with metrics.stage("extracao"):
+                extract_parts(plan_document_extraction(prepared), _complete, use_cache=False)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    return {
+        "nome": document["nome"],
+        "paginas": document["paginas"],
+        "tempo": time.perf_counter() - started,
+        "trace": trace,
+        "memoria_base": _worker["memoria_base"],
+        "memoria_pico": _max_rss(),
+        "erro": error,
+    }
+
+# Função para calcular um percentil (método do posto mais próximo)
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+# Função para resumir os eventos de um conjunto de documentos por etapa: chamadas, média e percentis (segundos)
+def stage_percentiles(traces):
+    durations = {}
+    for trace in traces:
+        for event in trace:
+            durations.setdefault(event["etapa"], []).append(event["tempo"])
+    return {
+        stage: {
+            "chamadas": len(values),
+            "media": round(sum(values) / len(values), 4),
+            **{f"p{q}": round(percentile(values, q), 4) for q in PERCENTILES},
+        }
+        for stage, values in sorted(durations.items())
+    }
+
+# Função para medir um conjunto de documentos com `workers` processos (pool novo a cada medição,
+# para que o pico de memória seja o dos documentos medidos). A memória base é a do processo ao
+# iniciar, herdada do processo principal
+def run_cell(documents, workers, init_args):
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=init_args) as pool:
+        list(pool.map(warm_up, range(workers)))
+        started = time.perf_counter()
+        results = list(pool.map(run_document, documents))
+        wall = time.perf_counter() - started
+    pages = sum(result["paginas"] for result in results)
+    failures = [result for result in results if result["erro"] is not None]
+    return {
+        "documentos": len(results),
+        "paginas": pages,
+        "falhas": len(failures),
+        "erros": sorted({result["erro"] for result in failures})[:5],
+        "tempo_total": round(wall, 3),
+        "documentos_por_segundo": round(len(results) / wall, 3),
+        "paginas_por_segundo": round(pages / wall, 3),
+        "latencia_documento": {f"p{q}": round(percentile([result["tempo"] for result in results], q), 4) for q in PERCENTILES},
+        "memoria_base_mb": round(max(result["memoria_base"] for result in results) / 2 ** 20, 1),
+        "memoria_pico_mb": round(max(result["memoria_pico"] for result in results) / 2 ** 20, 1),
+        "etapas": stage_percentiles(result["trace"] for result in results),
+    }
+
+# Função para identificar o commit medido (None fora de um repositório git)
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Função para executar o benchmark: um resultado por número de páginas e número de processos
+def run_benchmark(page_counts, worker_counts, per_kind=2, seed=42, ocr_backend=None, simulated_delay=0.0,
+                  latency=0.2, token_interval=0.0, streaming=False, corpus_dir=None):
+    corpus = generate_corpus(page_counts, per_kind, seed)
+    if corpus_dir:
+        save_corpus(corpus, corpus_dir)
+    server = start_stub_server(latency=latency, token_interval=token_interval)
+    init_args = (ocr_backend or ocr_backends.OCR_BACKEND, simulated_delay, server.base_url, streaming)
+    results = []
+    try:
+        for page_count in page_counts:
+            documents = [document for document in corpus if document["paginas"] == page_count]
+            for workers in worker_counts:
+                cell = {"paginas_por_documento": page_count, "workers": workers}
+                cell.update(run_cell(documents, workers, init_args))
+                results.append(cell)
+                print(
+                    f"{page_count:>3} página(s), {workers:>2} processo(s): {cell['documentos_por_segundo']} doc/s, "
+                    f"{cell['paginas_por_segundo']} páginas/s, memória {cell['memoria_base_mb']} -> {cell['memoria_pico_mb']} MB"
+                    + (f", {cell['falhas']} falha(s): {cell['erros'][0]}" if cell["falhas"] else ""),
+                    file=sys.stderr,
+                )
+    finally:
+        server.shutdown()
+    return {
+        "commit": current_commit(),
+        "data": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "ambiente": {"python": platform.python_version(), "plataforma": platform.platform(), "cpus": os.cpu_count()},
+        "configuracao": {
+            "paginas": list(page_counts), "workers": list(worker_counts), "documentos_por_tipo": per_kind, "semente": seed,
+            "ocr": init_args[0], "atraso_ocr_simulado": simulated_delay, "latencia_llm": latency,
+            "intervalo_token": token_interval, "streaming": streaming,
+        },
+        "resultados": results,
+    }
+
+# Função para comparar um resultado com outro de referência (ex: do commit anterior)
+# Retorna as linhas do relatório e as regressões acima da tolerância (fração; 0.1 = 10%)
+def compare_results(current, baseline, tolerance=0.1):
+    baseline_cells = {(cell["paginas_por_documento"], cell["workers"]): cell for cell in baseline["resultados"]}
+    lines, regressions = [], []
+    for cell in current["resultados"]:
+        key = (cell["paginas_por_documento"], cell["workers"])
+        reference = baseline_cells.get(key)
+        if reference is None:
+            continue
+        label = f"{key[0]} página(s), {key[1]} processo(s)"
+        change = cell["paginas_por_segundo"] / reference["paginas_por_segundo"] - 1 if reference["paginas_por_segundo"] else 0.0
+        lines.append(f"{label}: {reference['paginas_por_segundo']} -> {cell['paginas_por_segundo']} páginas/s ({change:+.0%})")
+        if change < -tolerance:
+            regressions.append(f"{label}: vazão {change:+.0%}")
+        for stage, values in cell["etapas"].items():
+            reference_values = reference["etapas"].get(stage)
+            if reference_values is None or not reference_values["p50"]:
+                continue
+            stage_change = values["p50"] / reference_values["p50"] - 1
+            # Etapas muito curtas variam demais para indicar regressão
+            if stage_change > tolerance and values["p50"] - reference_values["p50"] > 0.005:
+                lines.append(f"    {stage}: p50 {reference_values['p50']}s -> {values['p50']}s ({stage_change:+.0%})")
+                regressions.append(f"{label}: {stage} p50 {stage_change:+.0%}")
+    return lines, regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark offline do pipeline com um corpus sintético e o modelo stub.")
+    parser.add_argument("--paginas", default="1,4,12", help="Números de páginas dos documentos, separados por vírgula")
+    parser.add_argument("--workers", default="1,2,4", help="Números de processos medidos, separados por vírgula")
+    parser.add_argument("--documentos", type=int, default=2, help="Documentos de cada tipo por número de páginas")
+    parser.add_argument("--semente", type=int, default=42, help="Semente do corpus sintético")
+    parser.add_argument(
+        "--ocr", choices=["auto", "tesserocr", "pytesseract", "simulado"], default=None,
+        help="Backend de OCR (padrão: OFM_OCR_BACKEND ou auto; 'simulado' mede o pipeline sem o Tesseract)",
+    )
+    parser.add_argument("--atraso-ocr", type=float, default=0.0, help="Atraso de cada região no OCR simulado, em segundos")
+    parser.add_argument("--latencia", type=float, default=0.2, help="Latência do modelo stub em segundos")
+    parser.add_argument("--intervalo-token", type=float, default=0.0, help="Intervalo entre tokens do modelo stub em streaming")
+    parser.add_argument("--streaming", action="store_true", help="Recebe a resposta do modelo em streaming")
+    parser.add_argument("--corpus", default=None, help="Diretório onde gravar o corpus gerado (com os textos de referência)")
+    parser.add_argument("--saida", default="benchmark.json", help="Arquivo JSON com os resultados")
+    parser.add_argument("--comparar", default=None, help="Resultado de referência (ex: do commit anterior) para comparar")
+    parser.add_argument("--tolerancia", type=float, default=0.1, help="Piora aceita na comparação antes de indicar regressão (0.1 = 10%%)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(
+        [int(value) for value in args.paginas.split(",")], [int(value) for value in args.workers.split(",")],
+        args.documentos, args.semente, args.ocr, args.atraso_ocr, args.latencia, args.intervalo_token, args.streaming,
+        args.corpus,
+    )
+    with open(args.saida, 'w', encoding='utf-8') as output_file:
+        json.dump(results, output_file, ensure_ascii=False, indent=2)
+    if any(cell["falhas"] for cell in results["resultados"]):
+        return 1
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as baseline_file:
+            lines, regressions = compare_results(results, json.load(baseline_file), args.tolerancia)
+        print("\n".join(lines))
+        if regressions:
+            print("Regressões: " + "; ".join(regressions), file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
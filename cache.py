@@ -0,0 +1,148 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+# Cache em disco endereçado por conteúdo, compartilhado entre sessões e processos.
+# Cada camada (páginas renderizadas, texto do OCR e JSON do LLM) fica em um diretório
+# próprio com limite de tamanho e descarte LRU baseado no horário de último acesso.
+
+CACHE_ENABLED = os.getenv('OFM_CACHE', '1') != '0'
+CACHE_DIR = os.getenv('OFM_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'ofm-extractor'))
+
+# Limite de cada camada em MB
+TIER_LIMITS_MB = {
+    "paginas": int(os.getenv('OFM_CACHE_PAGINAS_MB', '2048')),
+    "ocr": int(os.getenv('OFM_CACHE_OCR_MB', '256')),
+    "llm": int(os.getenv('OFM_CACHE_LLM_MB', '256')),
+}
+
+# Ao estourar o limite, descartar até ficar nesta fração dele (a próxima varredura fica para bem depois)
+EVICTION_TARGET = 0.9
+
+_caches = {}
+
+# Função para calcular o hash do conteúdo de um arquivo
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+# Função para gerar uma chave a partir do hash do documento e dos parâmetros de processamento
+def make_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+# Função para empacotar uma lista de blobs (ex: páginas em JPEG) em um único valor
+def pack_blobs(blobs):
+    header = json.dumps([len(blob) for blob in blobs]).encode('utf-8')
+    return header + b'\n' + b''.join(blobs)
+
+# Função para desempacotar os blobs gravados por pack_blobs
+def unpack_blobs(data):
+    header, _, payload = data.partition(b'\n')
+    blobs = []
+    offset = 0
+    for size in json.loads(header):
+        blobs.append(payload[offset:offset + size])
+        offset += size
+    return blobs
+
+class DiskCache:
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        os.makedirs(root, exist_ok=True)
+        # Total em bytes mantido a cada gravação; o diretório só é varrido na abertura e ao passar do limite.
+        # Gravações de outros processos não entram na conta até a próxima varredura
+        self._lock = threading.Lock()
+        self._total = sum(size for _, size, _ in self._scan())
+
+    def _path(self, key):
+        return os.path.join(self.root, key)
+
+    # Retorna os bytes gravados para a chave ou None
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as cached:
+                data = cached.read()
+        except FileNotFoundError:
+            return None
+        # Atualizar o horário de acesso usado pelo descarte LRU
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    # Grava de forma atômica (outro processo nunca lê um arquivo pela metade)
+    def set(self, key, data):
+        path = self._path(key)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        with self._lock:
+            self._total += len(data) - replaced
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def get_text(self, key):
+        data = self.get(key)
+        return None if data is None else data.decode('utf-8')
+
+    def set_text(self, key, text):
+        self.set(key, text.encode('utf-8'))
+
+    # Lista as entradas da camada: (horário de último acesso, tamanho, caminho)
+    def _scan(self):
+        entries = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    # Descarta as entradas menos usadas recentemente quando a camada passa do limite
+    # Chamada com o lock; a varredura também corrige o total com as gravações de outros processos
+    def _evict(self):
+        entries = self._scan()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            target = self.max_bytes * EVICTION_TARGET
+            for _, size, path in sorted(entries):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                if total <= target:
+                    break
+        self._total = total
+
+# Função para obter o cache de uma camada (None se o cache estiver desativado)
+def get_cache(tier):
+    if not CACHE_ENABLED:
+        return None
+    if tier not in _caches:
+        _caches[tier] = DiskCache(os.path.join(CACHE_DIR, tier), TIER_LIMITS_MB[tier] * 1024 * 1024)
+    return _caches[tier]
@@ -0,0 +1,90 @@
+import base64
+
+import cv2
+import numpy as np
+from PIL import Image
+
+from metrics import stage
+
+# Operações sobre páginas já decodificadas (arrays NumPy RGB ou em tons de cinza)
+
+# Função para codificar bytes de imagem em base64
+def encode_image(image_bytes):
+    with stage("base64", bytes_entrada=len(image_bytes)) as record:
+        encoded = base64.b64encode(image_bytes).decode('utf-8')
+        record.add(bytes_saida=len(encoded))
+    return encoded
+
+# Função para decodificar bytes de imagem (JPEG/PNG) em um array RGB
+def decode_image(image_bytes):
+    nparr = np.frombuffer(image_bytes, np.uint8)
+    image = cv2.imdecode(nparr, cv2.IMREAD_COLOR) if nparr.size else None
+    # Arquivo vazio, corrompido ou em formato não suportado pelo OpenCV
+    if image is None:
+        raise ValueError("Não foi possível ler a imagem: arquivo corrompido ou formato não suportado")
+    # O OpenCV decodifica em BGR; o restante do pipeline trabalha em RGB
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+
+# Função para obter o array RGB de uma página (aceita bytes codificados, imagem PIL ou array)
+def as_array(image):
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return decode_image(image)
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert('RGB'))
+    return image
+
+# Função para codificar um array RGB em JPEG (única etapa de codificação do pipeline)
+def encode_jpeg(image, quality=75, optimize=True):
+    image = as_array(image)
+    if image.ndim == 3:
+        # O codificador do OpenCV espera BGR
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, int(optimize)]
+    with stage("jpeg", bytes_entrada=image.nbytes) as record:
+        _, buffer = cv2.imencode('.jpg', image, params)
+        record.add(bytes_saida=buffer.nbytes)
+    return buffer.tobytes()
+
+# Função para inverter as cores da imagem (vetorizada, sem decodificar/codificar JPEG)
+def invert_image_color(image):
+    image = as_array(image)
+    with stage("inversao", bytes_entrada=image.nbytes, bytes_saida=image.nbytes):
+        return np.invert(image)
+
+# Função para combinar duas imagens horizontalmente em um único buffer
+def combine_images(image1, image2):
+    image1 = as_array(image1)
+    image2 = as_array(image2)
+
+    # Garantir que ambas as imagens tenham a mesma altura
+    if image1.shape[0] != image2.shape[0]:
+        # Redimensionar a segunda imagem para a altura da primeira
+        aspect_ratio = image2.shape[1] / image2.shape[0]
+        new_width = int(image1.shape[0] * aspect_ratio)
+        image2 = cv2.resize(image2, (new_width, image1.shape[0]), interpolation=cv2.INTER_AREA)
+
+    # Copiar as duas imagens lado a lado em um buffer pré-alocado
+    height, width1 = image1.shape[:2]
+    combined_image = np.empty((height, width1 + image2.shape[1]) + image1.shape[2:], dtype=np.uint8)
+    combined_image[:, :width1] = image1
+    combined_image[:, width1:] = image2
+    return combined_image
+
+# Função para combinar duas imagens verticalmente em um único buffer
+def stack_images(image1, image2):
+    image1 = as_array(image1)
+    image2 = as_array(image2)
+
+    # Garantir que ambas as imagens tenham a mesma largura
+    if image1.shape[1] != image2.shape[1]:
+        # Redimensionar a segunda imagem para a largura da primeira
+        aspect_ratio = image2.shape[0] / image2.shape[1]
+        new_height = int(image1.shape[1] * aspect_ratio)
+        image2 = cv2.resize(image2, (image1.shape[1], new_height), interpolation=cv2.INTER_AREA)
+
+    # Copiar as duas imagens uma sobre a outra em um buffer pré-alocado
+    height1, width = image1.shape[:2]
+    stacked_image = np.empty((height1 + image2.shape[0], width) + image1.shape[2:], dtype=np.uint8)
+    stacked_image[:height1] = image1
+    stacked_image[height1:] = image2
+    return stacked_image
@@ -0,0 +1,220 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Fila de trabalhos em segundo plano para a interface: um pool limitado de threads, criado uma vez
+# por processo do servidor e compartilhado entre as sessões. Cada envio vira um trabalho com id,
+# progresso por etapa e por página e cancelamento; a interface consulta o estado em vez de
+# processar o documento dentro da execução do script. Trabalhos idênticos em andamento são
+# compartilhados, e novos envios são recusados quando a fila está cheia
+
+# Trabalhos executados ao mesmo tempo (cada um já usa o pool de OCR para as páginas)
+JOBS_WORKERS = int(os.getenv('OFM_JOBS_WORKERS', '2'))
+# Máximo de trabalhos aguardando na fila antes de recusar novos envios
+JOBS_MAX_QUEUE = int(os.getenv('OFM_JOBS_MAX_QUEUE', '20'))
+# Tempo (segundos) em que o resultado de um trabalho concluído fica disponível para consulta
+JOBS_RETENTION = int(os.getenv('OFM_JOBS_RETENTION', '900'))
+
+# Estados de um trabalho
+QUEUED = "na_fila"
+RUNNING = "em_andamento"
+DONE = "concluido"
+FAILED = "erro"
+CANCELLED = "cancelado"
+FINISHED_STATES = (DONE, FAILED, CANCELLED)
+
+class QueueFullError(Exception):
+    # A fila atingiu JOBS_MAX_QUEUE trabalhos aguardando
+    def __init__(self, queued):
+        super().__init__(f"Fila de processamento cheia ({queued} trabalhos aguardando)")
+        self.queued = queued
+
+class JobCancelled(Exception):
+    # Levantada no trabalho, no próximo registro de progresso, depois de um pedido de cancelamento
+    pass
+
+class Job:
+    def __init__(self, job_id, key):
+        self.id = job_id
+        self.key = key
+        self.status = QUEUED
+        self.stage = None
+        self.done = 0
+        self.total = None
+        # Etapas concluídas com a sua duração em segundos
+        self.stages = []
+        # Campos recebidos do modelo em streaming, exibidos antes do fim do trabalho
+        self.fields = []
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        # Sessões que aguardam o trabalho (o cancelamento só vale quando nenhuma aguarda mais)
+        self.watchers = 1
+        self.future = None
+        self._cancel_event = threading.Event()
+        self._stage_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def cancel_requested(self):
+        return self._cancel_event.is_set()
+
+    # Registra o progresso do trabalho: etapa atual, itens concluídos e total (páginas, partes...)
+    # Levanta JobCancelled se o cancelamento foi pedido
+    def report(self, stage, done=0, total=None):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+        now = time.perf_counter()
+        with self._lock:
+            if stage != self.stage:
+                if self.stage is not None:
+                    self.stages.append((self.stage, round(now - self._stage_started, 3)))
+                self.stage = stage
+                self._stage_started = now
+            self.done = done
+            self.total = total
+
+    # Registra um campo recebido do modelo (índice do objeto, nome, valor)
+    def add_field(self, index, key, value):
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+        with self._lock:
+            self.fields.append((index, key, value))
+
+    def _finish(self, status, result=None, error=None):
+        with self._lock:
+            if self.stage is not None:
+                self.stages.append((self.stage, round(time.perf_counter() - self._stage_started, 3)))
+                self.stage = None
+            self.status = status
+            self.result = result
+            self.error = error
+            self.finished = time.time()
+
+    # Estado do trabalho para a interface (cópia, sem o resultado)
+    def snapshot(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "status": self.status,
+                "etapa": self.stage,
+                "feito": self.done,
+                "total": self.total,
+                "etapas": list(self.stages),
+                "campos": list(self.fields),
+                "erro": self.error,
+                "tempo": round((self.finished or time.time()) - (self.started or self.created), 1),
+            }
+
+class JobQueue:
+    def __init__(self, workers=None, max_queue=None, retention=None):
+        self.workers = workers or JOBS_WORKERS
+        self.max_queue = JOBS_MAX_QUEUE if max_queue is None else max_queue
+        self.retention = JOBS_RETENTION if retention is None else retention
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='trabalho')
+        self._jobs = {}
+        # Trabalho não concluído de cada chave (para compartilhar envios idênticos)
+        self._active = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    # Indicadores da fila
+    def gauges(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            "fila": statuses.count(QUEUED),
+            "em_andamento": statuses.count(RUNNING),
+            "workers": self.workers,
+            "limite_fila": self.max_queue,
+        }
+
+    # Remove os trabalhos concluídos há mais de `retention` segundos
+    def _expire(self):
+        oldest = time.time() - self.retention
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.finished is not None and job.finished < oldest]:
+            del self._jobs[job_id]
+
+    # Envia um trabalho: function(job, *args) roda no pool e retorna o resultado
+    # Um trabalho com a mesma chave ainda não concluído é reaproveitado em vez de executado de novo.
+    # Levanta QueueFullError se a fila estiver cheia
+    def submit(self, key, function, *args):
+        with self._lock:
+            self._expire()
+            job = self._active.get(key)
+            if job is not None and not job.cancel_requested:
+                job.watchers += 1
+                return job
+            queued = sum(1 for job in self._jobs.values() if job.status == QUEUED)
+            if queued >= self.max_queue:
+                raise QueueFullError(queued)
+            job = Job(f"{next(self._ids):06d}", key)
+            self._jobs[job.id] = job
+            self._active[key] = job
+            job.future = self._executor.submit(self._run, job, function, args)
+        return job
+
+    def _run(self, job, function, args):
+        if job.cancel_requested:
+            self._complete(job, CANCELLED)
+            return
+        job.status = RUNNING
+        job.started = time.time()
+        try:
+            result = function(job, *args)
+        except JobCancelled:
+            logger.info("Trabalho %s cancelado", job.id)
+            self._complete(job, CANCELLED)
+        except Exception as e:
+            logger.exception("Falha no trabalho %s", job.id)
+            self._complete(job, FAILED, error=f"{type(e).__name__}: {e}")
+        else:
+            self._complete(job, DONE, result=result)
+
+    def _complete(self, job, status, result=None, error=None):
+        job._finish(status, result, error)
+        with self._lock:
+            if self._active.get(job.key) is job:
+                del self._active[job.key]
+
+    # Retorna o trabalho com o id informado (None se não existir ou já tiver expirado)
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    # Posição do trabalho na fila (0 se já estiver em execução ou concluído)
+    def position(self, job_id):
+        with self._lock:
+            queued = [job.id for job in sorted(self._jobs.values(), key=lambda job: job.created) if job.status == QUEUED]
+        return queued.index(job_id) + 1 if job_id in queued else 0
+
+    # Cancela o trabalho para uma sessão; ele só é interrompido quando nenhuma outra sessão o aguarda
+    # Um trabalho ainda na fila é retirado dela; um em execução para no próximo registro de progresso
+    def cancel(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.status in FINISHED_STATES:
+                return False
+            job.watchers -= 1
+            if job.watchers > 0:
+                return False
+            job._cancel_event.set()
+            if self._active.get(job.key) is job:
+                del self._active[job.key]
+        if job.future.cancel():
+            self._complete(job, CANCELLED)
+        return True
+
+    def shutdown(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            job._cancel_event.set()
+        self._executor.shutdown(wait=False, cancel_futures=True)
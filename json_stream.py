@@ -0,0 +1,95 @@
+import json
+
+# Leitura incremental do array JSON devolvido pelo modelo em modo streaming.
+# Os trechos são recebidos à medida que chegam; cada campo de primeiro nível de um objeto do
+# array é entregue assim que seu valor termina, e o fim do array é detectado no colchete de
+# fechamento (o texto que o modelo escreve depois dele pode ser descartado sem ser gerado)
+
+class JsonArrayStream:
+    def __init__(self):
+        self.text = ""
+        self.start = None
+        self.done = False
+        # Posição já analisada no texto acumulado
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        # Estado do objeto de primeiro nível em andamento (profundidade 2: array > objeto)
+        self._object_index = -1
+        self._key = None
+        self._value_start = None
+
+    # Recebe um trecho da resposta e retorna os campos concluídos: [(índice do objeto, nome, valor)]
+    def feed(self, chunk):
+        if self.done or not chunk:
+            return []
+        self.text += chunk
+        fields = []
+        text = self.text
+        for pos in range(self._pos, len(text)):
+            char = text[pos]
+            if self.start is None:
+                # Texto anterior ao JSON (ex: "Segue o JSON extraído [abaixo]:"): como em
+                # schema.extract_json, o array começa no "[" seguido de "{" ou "]"
+                if char == '[':
+                    following = text[pos + 1:].lstrip()[:1]
+                    if not following:
+                        # O caractere seguinte ainda não chegou: decidir no próximo trecho
+                        self._pos = pos
+                        return fields
+                    if following in ('{', ']'):
+                        self.start = pos
+                        self._depth = 1
+                continue
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    # Uma string concluída na profundidade do objeto, fora de um valor, é um nome de campo
+                    if self._depth == 2 and self._key is None:
+                        self._key = json.loads(text[self._string_start:pos + 1])
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif char in '[{':
+                self._depth += 1
+                if self._depth == 2 and char == '{':
+                    self._object_index += 1
+                    self._key = None
+            elif char == ':' and self._depth == 2:
+                self._value_start = pos + 1
+            elif char in ',]}':
+                if self._depth == 2 and self._value_start is not None:
+                    fields.append(self._complete_field(text[self._value_start:pos]))
+                if char != ',':
+                    self._depth -= 1
+                    if self._depth == 0:
+                        self.text = text[self.start:pos + 1]
+                        self.done = True
+                        return fields
+        self._pos = len(text)
+        return fields
+
+    def _complete_field(self, value_text):
+        key = self._key
+        self._key = None
+        self._value_start = None
+        try:
+            value = json.loads(value_text)
+        except json.JSONDecodeError:
+            value = value_text.strip()
+        return self._object_index, key, value
+
+    # Texto do array JSON completo (ou o texto recebido até agora, se o array não terminou)
+    def json_text(self):
+        if self.start is None:
+            return self.text
+        return self.text if self.done else self.text[self.start:]
@@ -0,0 +1,423 @@
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from cache import CACHE_DIR
+from rule_extractor import find_cnpj, fold_text, is_valid_ibge_code, parse_amount, parse_emission_date
+
+# fcntl só existe em sistemas POSIX: sem ele a gravação não é protegida entre processos
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Memória de layouts: documentos corrigidos pelo usuário ensinam onde cada campo fica na página.
+# Um documento novo com a mesma impressão digital (hash perceptual da primeira página e MinHash
+# das palavras do seu texto) tem só essas regiões lidas (OCR zonal, ou a camada de texto dentro
+# da caixa), sem OCR completo. Os valores lidos não são pedidos ao LLM, que lê da imagem das
+# páginas o restante da nota (inclusive as listas): nada é copiado de outro documento.
+# Os modelos ficam em um arquivo JSON no diretório do cache, com descarte dos antigos e dos que falham
+
+LAYOUTS_ENABLED = os.getenv('OFM_LAYOUTS', '1') != '0'
+LAYOUT_INDEX_PATH = os.getenv('OFM_LAYOUT_INDEX', os.path.join(CACHE_DIR, 'layouts.json'))
+# Distância de Hamming máxima entre os hashes perceptuais (64 bits) quando o texto confirma o layout;
+# até 7 qualquer candidato compartilha ao menos um dos 8 bytes do hash com a consulta
+LAYOUT_MAX_DISTANCE = int(os.getenv('OFM_LAYOUT_MAX_DISTANCE', '6'))
+# Distância máxima quando não há texto para confirmar (página digitalizada ainda sem OCR)
+LAYOUT_MAX_DISTANCE_IMAGE_ONLY = int(os.getenv('OFM_LAYOUT_MAX_DISTANCE_IMAGEM', '3'))
+# Similaridade mínima (Jaccard estimado pelo MinHash) entre as palavras da primeira página
+LAYOUT_MIN_SIMILARITY = float(os.getenv('OFM_LAYOUT_MIN_SIMILARITY', '0.7'))
+# Limites da memória: número de modelos, dias sem uso e falhas seguidas antes do descarte
+LAYOUT_MAX_TEMPLATES = int(os.getenv('OFM_LAYOUT_MAX_TEMPLATES', '1000'))
+LAYOUT_MAX_AGE_DAYS = int(os.getenv('OFM_LAYOUT_MAX_AGE_DAYS', '180'))
+LAYOUT_MAX_FAILURES = int(os.getenv('OFM_LAYOUT_MAX_FAILURES', '3'))
+
+# Versão do formato do arquivo (muda se o hash ou o MinHash mudarem)
+INDEX_VERSION = 1
+# Largura da imagem da primeira página usada na impressão digital
+FINGERPRINT_WIDTH = 256
+MINHASH_SIZE = 64
+# Intervalo mínimo entre gravações motivadas só pelo uso dos modelos (horário do último uso)
+SAVE_INTERVAL = 60
+
+# Campos lidos nas regiões e o tipo de cada um; os demais campos são lidos pelo LLM
+ZONAL_FIELDS = {
+    "numeroRps": "numero",
+    "numeroNota": "numero",
+    "dataEmissao": "data",
+    "cnpjCliente": "cnpj",
+    "codIbgeCidadeServico": "municipio",
+    "valorNotaFiscal": "valor",
+    "valorMulta": "valor",
+    "valorDesconto": "valor",
+}
+# Campos que mudam a cada nota: sem a sua região o layout não é memorizado
+VARIABLE_FIELDS = ("numeroRps", "numeroNota", "dataEmissao", "valorNotaFiscal")
+# Máximo de palavras seguidas comparadas com o valor de um campo
+MAX_VALUE_WORDS = 8
+
+_AMOUNT = re.compile(r'(?<![\d.,])(\d{1,3}(?:\.\d{3})+,\d{2}|\d+,\d{2})(?![\d,])')
+_NUMBER = re.compile(r'\d+')
+_TIME = re.compile(r'^\d{2}:\d{2}')
+_WORD = re.compile(r'[a-z]{3,}')
+
+# Coeficientes fixos das permutações do MinHash (os modelos gravados dependem deles)
+_rng = np.random.default_rng(20241005)
+_MINHASH_A = _rng.integers(1, 2 ** 32, MINHASH_SIZE, dtype=np.uint64) | np.uint64(1)
+_MINHASH_B = _rng.integers(0, 2 ** 32, MINHASH_SIZE, dtype=np.uint64)
+del _rng
+
+# Função para calcular o hash perceptual (pHash de 64 bits) de uma página
+# Frequências baixas da DCT da página reduzida a 32x32: o desenho do layout, não os valores impressos
+def page_hash(image):
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].flatten()
+    # O termo constante (brilho médio) fica fora da mediana
+    bits = low > np.median(low[1:])
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+# Função para calcular o MinHash das palavras de um texto (None se não houver palavras)
+# Só palavras sem dígitos, sem acento e com 3 letras ou mais: os rótulos do layout, não os valores
+def token_minhash(text):
+    words = set(_WORD.findall(fold_text(text).lower())) if text else set()
+    if not words:
+        return None
+    hashes = np.fromiter((zlib.crc32(word.encode('ascii', 'ignore')) for word in words), dtype=np.uint64, count=len(words))
+    permuted = (hashes[:, None] * _MINHASH_A + _MINHASH_B) & np.uint64(0xFFFFFFFF)
+    return permuted.min(axis=0).tolist()
+
+# Função para estimar a similaridade de Jaccard entre dois MinHash
+def minhash_similarity(first, second):
+    return sum(1 for a, b in zip(first, second) if a == b) / MINHASH_SIZE
+
+def _digits(text):
+    return "".join(char for char in str(text) if char.isdigit())
+
+# Função para verificar se um trecho do documento corresponde ao valor de um campo
+def _matches(kind, text, value):
+    if kind == "valor":
+        amount = _AMOUNT.search(text)
+        number = parse_amount(amount.group(1)) if amount is not None else None
+        return number is not None and float(number) == round(float(value), 2)
+    if kind == "data":
+        return str(value)[:10] in text
+    digits = _digits(text)
+    # Números, CNPJ e códigos: os mesmos dígitos, sem texto demais em volta (ex: "Nota:" fica de fora)
+    return bool(digits) and digits.lstrip('0') == _digits(value).lstrip('0') and len(digits) >= len(text.strip()) / 2
+
+# Função para localizar o valor de um campo nas palavras de uma página
+# words: [(texto, x0, y0, x1, y1)] com caixas normalizadas; retorna a caixa do trecho ou None
+def _locate(kind, value, words):
+    for start in range(len(words)):
+        for end in range(start + 1, min(len(words), start + MAX_VALUE_WORDS) + 1):
+            text = " ".join(word[0] for word in words[start:end])
+            if not _matches(kind, text, value):
+                continue
+            span = words[start:end]
+            # A hora da emissão costuma vir na palavra seguinte à data
+            if kind == "data" and end < len(words) and _TIME.match(words[end][0]):
+                span = words[start:end + 1]
+            return (
+                min(word[1] for word in span), min(word[2] for word in span),
+                max(word[3] for word in span), max(word[4] for word in span),
+            )
+    return None
+
+# Função para ampliar a caixa de um valor: valores mais longos em outras notas e pequenos
+# deslocamentos do layout continuam dentro da região
+def _expand_box(box):
+    x0, y0, x1, y1 = box
+    width = x1 - x0
+    height = y1 - y0
+    return (
+        round(max(0.0, x0 - width * 0.5 - 0.01), 4), round(max(0.0, y0 - height * 0.3), 4),
+        round(min(1.0, x1 + width * 0.5 + 0.01), 4), round(min(1.0, y1 + height * 0.3), 4),
+    )
+
+def _is_empty(value):
+    return value in ("", None, 0, 0.0)
+
+# Função para montar um modelo de layout a partir de uma nota corrigida
+# words_by_page: {página: palavras com caixas normalizadas}, também as páginas enviadas como imagem
+# ao LLM nas próximas notas; retorna None se algum campo variável preenchido não for encontrado
+def build_template(phash, minhash, words_by_page, invoice):
+    regions = {}
+    for field, kind in ZONAL_FIELDS.items():
+        value = invoice.get(field)
+        if _is_empty(value) or (kind == "valor" and not isinstance(value, (int, float))):
+            continue
+        for page_index, words in sorted(words_by_page.items()):
+            box = _locate(kind, value, words)
+            if box is not None:
+                regions[field] = {"pagina": page_index, "caixa": _expand_box(box)}
+                break
+    missing = [field for field in VARIABLE_FIELDS if not _is_empty(invoice.get(field)) and field not in regions]
+    if missing:
+        logger.info("Layout não memorizado: %s não encontrado(s) no documento", ", ".join(missing))
+        return None
+
+    now = time.time()
+    return {
+        "id": uuid.uuid4().hex,
+        "phash": f"{phash:016x}",
+        "minhash": minhash,
+        "regioes": regions,
+        # Valores corrigidos dos campos das regiões (só o formato é usado, ex: zeros à esquerda)
+        "modelo": {field: invoice[field] for field in regions},
+        "paginas_imagem": sorted(words_by_page),
+        "criado": now,
+        "usado": now,
+        "usos": 0,
+        "falhas": 0,
+    }
+
+# Função para interpretar o texto lido na região de um campo (None se não houver um valor válido)
+def parse_region(kind, text):
+    folded = fold_text(text or "")
+    if kind == "valor":
+        amounts = _AMOUNT.findall(folded)
+        return parse_amount(amounts[-1]) if amounts else None
+    if kind == "data":
+        return parse_emission_date(folded)
+    if kind == "cnpj":
+        return find_cnpj(folded)
+    if kind == "municipio":
+        for number in _NUMBER.findall(folded):
+            if len(number) == 7 and is_valid_ibge_code(number):
+                return number
+        return None
+    numbers = _NUMBER.findall(folded)
+    return max(numbers, key=len) if numbers else None
+
+# Função para interpretar os campos de um documento com layout conhecido
+# region_texts: {campo: texto lido na região}; retorna {campo: valor} só com os campos lidos nas
+# regiões, ou None se algum não puder ser lido (o documento segue então pelo pipeline completo)
+def build_extraction(template, region_texts):
+    memorized = template["modelo"]
+    values = {}
+    for field in template["regioes"]:
+        value = parse_region(ZONAL_FIELDS[field], region_texts.get(field))
+        if value is None:
+            logger.info("Layout %s: campo %s não lido na região (%r)", template["id"], field, region_texts.get(field))
+            return None
+        # Números com zeros à esquerda seguem o formato da nota corrigida (ex: "4567" e não "00004567")
+        if ZONAL_FIELDS[field] == "numero" and not str(memorized.get(field, "")).startswith("0"):
+            value = value.lstrip("0") or "0"
+        values[field] = value
+    if "codIbgeCidadeServico" in values:
+        values["codIbgeEstadoServico"] = values["codIbgeCidadeServico"][:2]
+    return values
+
+# Trava exclusiva entre processos (arquivo auxiliar <caminho>.lock) enquanto o bloco executa
+@contextmanager
+def _file_lock(path):
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class LayoutIndex:
+    # Modelos de layout em memória, com índice pelos 8 bytes do hash perceptual: um candidato a até
+    # 7 bits de distância compartilha ao menos um byte com a consulta, então a busca compara só
+    # os modelos dos mesmos baldes em vez de percorrer todos
+    def __init__(self, path):
+        self.path = path
+        self.templates = {}
+        self._buckets = [{} for _ in range(8)]
+        self._lock = threading.Lock()
+        self._mtime = None
+        # Alterações ainda não gravadas (mescladas com o arquivo, que outros processos também atualizam)
+        self._changed = set()
+        self._removed = set()
+        self._saved = time.monotonic()
+        self.reload()
+
+    def __len__(self):
+        return len(self.templates)
+
+    @staticmethod
+    def _bucket_keys(phash):
+        return [(phash >> (8 * i)) & 0xFF for i in range(8)]
+
+    def _read_file(self):
+        try:
+            with open(self.path, encoding='utf-8') as index_file:
+                data = json.load(index_file)
+            mtime = os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return {}, None
+        except (OSError, ValueError) as e:
+            logger.warning("Memória de layouts ilegível (%s): %s", self.path, e)
+            return {}, None
+        if data.get("versao") != INDEX_VERSION:
+            return {}, mtime
+        return {template["id"]: template for template in data.get("modelos", [])}, mtime
+
+    def _index(self, template):
+        phash = int(template["phash"], 16)
+        for bucket, key in zip(self._buckets, self._bucket_keys(phash)):
+            bucket.setdefault(key, set()).add(template["id"])
+
+    def _rebuild(self):
+        self._buckets = [{} for _ in range(8)]
+        for template in self.templates.values():
+            self._index(template)
+
+    # Relê o arquivo se outro processo o alterou (as alterações locais pendentes são preservadas)
+    def reload(self):
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                mtime = None
+            if mtime == self._mtime and (self.templates or mtime is None):
+                return
+            templates, mtime = self._read_file()
+            for template_id in self._changed:
+                if template_id in self.templates:
+                    templates[template_id] = self.templates[template_id]
+            for template_id in self._removed:
+                templates.pop(template_id, None)
+            self.templates = templates
+            self._mtime = mtime
+            self._rebuild()
+
+    # Busca o modelo mais próximo de uma página (None se nenhum estiver perto o bastante)
+    # Sem MinHash (página sem texto) a distância aceita é menor
+    def lookup(self, phash, minhash=None):
+        max_distance = LAYOUT_MAX_DISTANCE if minhash is not None else LAYOUT_MAX_DISTANCE_IMAGE_ONLY
+        with self._lock:
+            candidates = set()
+            for bucket, key in zip(self._buckets, self._bucket_keys(phash)):
+                candidates.update(bucket.get(key, ()))
+            best = None
+            best_distance = None
+            for template_id in candidates:
+                template = self.templates[template_id]
+                distance = (int(template["phash"], 16) ^ phash).bit_count()
+                if distance > max_distance:
+                    continue
+                if minhash is not None and template["minhash"] is not None:
+                    if minhash_similarity(minhash, template["minhash"]) < LAYOUT_MIN_SIMILARITY:
+                        continue
+                if best is None or distance < best_distance:
+                    best = template
+                    best_distance = distance
+            return best
+
+    # Registra o uso de um modelo: as falhas seguidas descartam o modelo, um acerto zera a contagem
+    def record_use(self, template_id, success):
+        with self._lock:
+            template = self.templates.get(template_id)
+            if template is None:
+                return
+            if success:
+                template["usado"] = time.time()
+                template["usos"] += 1
+                template["falhas"] = 0
+            else:
+                template["falhas"] += 1
+            self._changed.add(template_id)
+            if template["falhas"] >= LAYOUT_MAX_FAILURES:
+                logger.info("Layout %s descartado depois de %d falhas seguidas", template_id, template["falhas"])
+                self._remove(template_id)
+            # Acertos só atualizam o descarte LRU: gravados no máximo a cada SAVE_INTERVAL segundos
+            if success and time.monotonic() - self._saved < SAVE_INTERVAL:
+                return
+        self.save()
+
+    def _remove(self, template_id):
+        self.templates.pop(template_id, None)
+        self._changed.discard(template_id)
+        self._removed.add(template_id)
+        self._rebuild()
+
+    # Adiciona (ou substitui, se replace_id for informado) um modelo e descarta os antigos
+    def add(self, template, replace_id=None):
+        with self._lock:
+            if replace_id is not None and replace_id in self.templates:
+                template["id"] = replace_id
+                template["criado"] = self.templates[replace_id]["criado"]
+                template["usos"] = self.templates[replace_id]["usos"]
+            self.templates[template["id"]] = template
+            self._changed.add(template["id"])
+            self._removed.discard(template["id"])
+            self._evict()
+            self._rebuild()
+        self.save()
+
+    # Descarta os modelos sem uso há mais de LAYOUT_MAX_AGE_DAYS e, acima do limite, os usados há mais tempo
+    def _evict(self):
+        oldest = time.time() - LAYOUT_MAX_AGE_DAYS * 86400
+        stale = [template_id for template_id, template in self.templates.items() if template["usado"] < oldest]
+        by_use = sorted(self.templates, key=lambda template_id: self.templates[template_id]["usado"])
+        stale += by_use[:max(0, len(self.templates) - LAYOUT_MAX_TEMPLATES)]
+        for template_id in set(stale):
+            self.templates.pop(template_id, None)
+            self._changed.discard(template_id)
+            self._removed.add(template_id)
+
+    # Grava o arquivo de forma atômica, mesclando com as alterações feitas por outros processos
+    # A leitura, a mescla e a substituição ficam sob a trava do arquivo: gravações simultâneas
+    # (processos do lote, sessões da interface) não perdem os modelos umas das outras
+    def save(self):
+        with self._lock:
+            directory = os.path.dirname(self.path) or '.'
+            os.makedirs(directory, exist_ok=True)
+            with _file_lock(self.path):
+                templates, _ = self._read_file()
+                for template_id in self._changed:
+                    if template_id in self.templates:
+                        templates[template_id] = self.templates[template_id]
+                for template_id in self._removed:
+                    templates.pop(template_id, None)
+                fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+                try:
+                    with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+                        json.dump({"versao": INDEX_VERSION, "modelos": list(templates.values())}, tmp_file, ensure_ascii=False)
+                    os.replace(tmp_path, self.path)
+                except BaseException:
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                    raise
+                self._mtime = os.path.getmtime(self.path)
+            self.templates = templates
+            self._changed.clear()
+            self._removed.clear()
+            self._saved = time.monotonic()
+            self._rebuild()
+
+_index = None
+_index_lock = threading.Lock()
+
+# Função para obter a memória de layouts do processo (None se desativada)
+# O arquivo é relido quando outro processo o altera (ex: correção salva na interface durante um lote)
+def get_layout_index():
+    global _index
+    if not LAYOUTS_ENABLED:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = LayoutIndex(LAYOUT_INDEX_PATH)
+        else:
+            _index.reload()
+    return _index
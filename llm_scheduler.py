@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import os
+import random
+import time
+
+import groq
+from groq import AsyncGroq
+
+from metrics import record_stage
+from pipeline import completion_params, llm_usage_values, log_request_size
+from prompt import estimate_text_tokens
+
+logger = logging.getLogger(__name__)
+
+# Agendador assíncrono das chamadas ao modelo para cargas em lote: um cliente persistente
+# (pool de conexões HTTP reaproveitado), limite de concorrência, limitadores de requisições
+# e de tokens por minuto e novas tentativas com recuo exponencial em 429 e 5xx
+
+LLM_CONCURRENCY = int(os.getenv('OFM_LLM_CONCURRENCY', '4'))
+LLM_REQUESTS_PER_MINUTE = int(os.getenv('OFM_LLM_RPM', '30'))
+LLM_TOKENS_PER_MINUTE = int(os.getenv('OFM_LLM_TPM', '7000'))
+LLM_TIMEOUT = float(os.getenv('OFM_LLM_TIMEOUT', '120'))
+LLM_MAX_RETRIES = int(os.getenv('OFM_LLM_MAX_RETRIES', '6'))
+
+# Recuo exponencial: BACKOFF_BASE * 2^tentativa, limitado a BACKOFF_MAX segundos, com jitter
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# Estimativa de tokens das imagens: um custo fixo por imagem
+IMAGE_TOKENS_ESTIMATE = int(os.getenv('OFM_LLM_IMAGE_TOKENS', '1600'))
+# Tokens de resposta reservados antes da chamada (ajustados depois pelo uso real)
+COMPLETION_TOKENS_ESTIMATE = int(os.getenv('OFM_LLM_COMPLETION_TOKENS', '1200'))
+
+# Erros transitórios que justificam nova tentativa
+RETRYABLE_ERRORS = (groq.RateLimitError, groq.InternalServerError, groq.APITimeoutError, groq.APIConnectionError)
+
+# Função para estimar os tokens de uma requisição (texto do prompt, imagens e resposta)
+def estimate_tokens(message_content):
+    tokens = COMPLETION_TOKENS_ESTIMATE
+    for part in message_content:
+        if part["type"] == "text":
+            tokens += estimate_text_tokens(part["text"])
+        elif part["type"] == "image_url":
+            tokens += IMAGE_TOKENS_ESTIMATE
+    return tokens
+
+class TokenBucket:
+    # Balde de fichas com reposição contínua de `per_minute` fichas por minuto
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+        # Atende quem chegou primeiro (uma requisição grande não é ultrapassada indefinidamente por pequenas)
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        # Uma requisição maior que a capacidade passa quando o balde estiver cheio
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    # Corrige o saldo depois que o uso real é conhecido (o saldo pode ficar negativo)
+    def adjust(self, delta):
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+    # Esvazia o balde (ex: o servidor respondeu 429)
+    def drain(self):
+        self._refill()
+        self.tokens = min(self.tokens, 0.0)
+
+class LLMScheduler:
+    def __init__(self, api_key=None, base_url=None, concurrency=None, requests_per_minute=None,
+                 tokens_per_minute=None, max_retries=None, timeout=None):
+        self.concurrency = concurrency or LLM_CONCURRENCY
+        self.max_retries = LLM_MAX_RETRIES if max_retries is None else max_retries
+        # As novas tentativas são feitas aqui, de forma coordenada entre as requisições
+        self.client = AsyncGroq(api_key=api_key, base_url=base_url, max_retries=0, timeout=timeout or LLM_TIMEOUT)
+        self.request_bucket = TokenBucket(requests_per_minute or LLM_REQUESTS_PER_MINUTE)
+        self.token_bucket = TokenBucket(tokens_per_minute or LLM_TOKENS_PER_MINUTE)
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        self._paused_until = 0.0
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.retries = 0
+
+    # Indicadores de fila e de requisições em andamento
+    def gauges(self):
+        return {
+            "fila": self.queued,
+            "em_andamento": self.in_flight,
+            "concluidas": self.completed,
+            "novas_tentativas": self.retries,
+        }
+
+    # Função para calcular a espera antes da próxima tentativa (respeita Retry-After quando presente)
+    def _backoff(self, attempt, error):
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+        response = getattr(error, "response", None)
+        if response is not None:
+            retry_after = response.headers.get("retry-after")
+            try:
+                delay = max(delay, float(retry_after))
+            except (TypeError, ValueError):
+                pass
+        return delay
+
+    # Envia uma requisição respeitando concorrência e cotas; retorna (conteúdo, uso de tokens)
+    async def complete(self, message_content):
+        estimated_tokens = estimate_tokens(message_content)
+        self.queued += 1
+        dequeued = False
+        try:
+            async with self._semaphore:
+                for attempt in range(self.max_retries + 1):
+                    # Pausa global depois de um 429: todas as requisições recuam juntas
+                    pause = self._paused_until - time.monotonic()
+                    if pause > 0:
+                        await asyncio.sleep(pause)
+                    await self.request_bucket.acquire(1)
+                    await self.token_bucket.acquire(estimated_tokens)
+                    if not dequeued:
+                        self.queued -= 1
+                        dequeued = True
+                    self.in_flight += 1
+                    error = None
+                    started = time.perf_counter()
+                    try:
+                        log_request_size(message_content)
+                        completion = await self.client.chat.completions.create(**completion_params(message_content))
+                    except RETRYABLE_ERRORS as e:
+                        if attempt == self.max_retries:
+                            raise
+                        error = e
+                    finally:
+                        self.in_flight -= 1
+
+                    if error is not None:
+                        delay = self._backoff(attempt, error)
+                        if isinstance(error, groq.RateLimitError):
+                            self.request_bucket.drain()
+                            self.token_bucket.drain()
+                            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                        self.retries += 1
+                        logger.warning("Falha transitória no LLM (%s); nova tentativa em %.1fs", type(error).__name__, delay)
+                        await asyncio.sleep(delay)
+                        continue
+
+                    usage = completion.usage
+                    # Tempo de CPU não é medido: o laço de eventos é compartilhado pelas requisições
+                    wall = time.perf_counter() - started
+                    record_stage("modelo", wall, tentativas=attempt + 1, **llm_usage_values(usage, wall))
+                    if usage is not None and usage.total_tokens:
+                        self.token_bucket.adjust(usage.total_tokens - estimated_tokens)
+                    self.completed += 1
+                    return completion.choices[0].message.content, usage
+        finally:
+            # Requisição cancelada ou com erro antes de sair da fila
+            if not dequeued:
+                self.queued -= 1
+
+    async def close(self):
+        await self.client.close()
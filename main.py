@@ -1,92 +1,251 @@
 import os
+import logging
 from groq import Groq
 import streamlit as st
-from PIL import Image
-import tempfile
-import base64
-import pypdfium2 as pdfium
-from io import BytesIO
-from pytesseract import image_to_string
-import pytesseract
-import cv2
-import numpy as np
 import json
 from streamlit_ace import st_ace  # Importando o componente Ace
-import re  # Importado para regex no parsing
-
-# Configurar o caminho do Tesseract OCR
-pytesseract.pytesseract.tesseract_cmd = r'/usr/bin/tesseract'
-
-# Função para codificar bytes de imagem em base64
-def encode_image(image_bytes):
-    return base64.b64encode(image_bytes).decode('utf-8')
-
-# Função para inverter as cores da imagem
-def invert_image_color(image_bytes):
-    # Converter bytes de imagem em um array NumPy
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    # Decodificar a imagem para o formato OpenCV
-    image = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    # Inverter as cores
-    inverted_image = 255 - image
-    # Codificar a imagem invertida de volta para bytes
-    _, buffer = cv2.imencode('.jpg', inverted_image)
-    inverted_image_bytes = buffer.tobytes()
-    return inverted_image_bytes
-
-# Função para combinar duas imagens horizontalmente
-def combine_images(image_bytes1, image_bytes2):
-    # Abrir as duas imagens
-    image1 = Image.open(BytesIO(image_bytes1))
-    image2 = Image.open(BytesIO(image_bytes2))
-    
-    # Garantir que ambas as imagens tenham a mesma altura
-    if image1.height != image2.height:
-        # Redimensionar a segunda imagem para a altura da primeira
-        aspect_ratio = image2.width / image2.height
-        new_width = int(image1.height * aspect_ratio)
-        image2 = image2.resize((new_width, image1.height))
-    
-    # Combinar as imagens horizontalmente
-    combined_image = Image.new('RGB', (image1.width + image2.width, image1.height))
-    combined_image.paste(image1, (0, 0))
-    combined_image.paste(image2, (image1.width, 0))
-    
-    # Salvar a imagem combinada em bytes
-    byte_arr = BytesIO()
-    combined_image.save(byte_arr, format='JPEG', optimize=True)
-    combined_image_bytes = byte_arr.getvalue()
-    return combined_image_bytes
-
-# Função para converter PDF em imagens (sem aplicar inversão de cores)
-def convert_pdf_to_images(file_path, scale=300/72):
-    pdf_file = pdfium.PdfDocument(file_path)
-    page_indices = [i for i in range(len(pdf_file))]
-    renderer = pdf_file.render(
-        pdfium.PdfBitmap.to_pil,
-        page_indices=page_indices,
-        scale=scale,
+from cache import hash_bytes, make_key
+from jobs import CANCELLED, DONE, FINISHED_STATES, QUEUED, JobQueue, QueueFullError
+from metrics import collect_trace, start_metrics_server, summarize_trace, write_metrics_file
+from pipeline import (
+    LLM_STREAM,
+    extract_json_text,
+    extract_parts,
+    plan_document_extraction,
+    prepare_document,
+    remember_layout,
+    render_page_preview,
+    request_completion,
+    stream_completion,
+)
+from schema import load_document, to_plain, validate_document
+
+# Registrar os eventos do pipeline (ex: bytes do payload enviado ao modelo) no log do servidor
+logging.basicConfig(level=os.getenv('OFM_LOG_LEVEL', 'INFO'), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+logger = logging.getLogger(__name__)
+
+# Cliente Groq compartilhado entre as sessões e reexecuções do servidor (reaproveita as conexões HTTP)
+@st.cache_resource
+def get_client(api_key):
+    return Groq(api_key=api_key)
+
+# Fila de trabalhos compartilhada entre as sessões (um pool limitado por processo do servidor)
+@st.cache_resource
+def get_job_queue():
+    return JobQueue()
+
+# Endpoint /metrics do Prometheus, iniciado uma vez por processo do servidor quando OFM_METRICS_PORT é definida
+@st.cache_resource
+def get_metrics_server():
+    return start_metrics_server()
+
+# Nomes das etapas exibidos no progresso
+STAGE_LABELS = {
+    "layout": "Procurando o layout na memória",
+    "paginas": "Extraindo o texto das páginas",
+    "miniaturas": "Gerando as miniaturas",
+    "imagem": "Montando a imagem para o modelo",
+    "modelo": "Gerando o JSON",
+}
+
+# Nomes das etapas medidas exibidos no detalhamento de tempos
+METRIC_STAGE_LABELS = {
+    "layout": "Memória de layouts",
+    "renderizacao": "Renderização do PDF",
+    "ocr": "OCR (por página)",
+    "preprocessamento": "Pré-processamento do OCR",
+    "payload": "Imagem do modelo",
+    "composicao": "Composição da imagem",
+    "inversao": "Inversão de cores",
+    "jpeg": "Codificação JPEG",
+    "base64": "Base64",
+    "prompt": "Prompt",
+    "modelo": "Chamada ao modelo",
+    "rede": "Rede",
+}
+
+# Função executada na fila: preparação do documento e geração do JSON usando a API Groq (uma chamada
+# por nota fiscal, com os resultados combinados). Na geração inicial o cache é consultado e as regras
+# podem dispensar o modelo; na regeneração (refresh) o modelo é sempre chamado, apenas para os campos
+# que as regras não obtiveram. O documento já preparado na sessão é reaproveitado
+def process_document(job, client, file_bytes, is_pdf, refresh=False, prepared=None):
+    # Documento reconhecido por um layout memorizado ou com partes dispensadas pelas regras (sem imagem):
+    # a regeneração refaz a preparação completa
+    bypassed = prepared is not None and (prepared["layout"] is not None or any(part["payload"] is None for part in prepared["parts"]))
+    if prepared is None or (refresh and bypassed):
+        # Converter PDF em imagens, extrair o texto via OCR e montar a imagem das páginas mais relevantes
+        prepared = prepare_document(
+            file_bytes, is_pdf=is_pdf, use_layouts=not refresh, allow_bypass=not refresh, progress=job.report,
+        )
+    # Uma mensagem por nota fiscal do documento, com o texto do OCR das suas páginas (compactado),
+    # a imagem das suas páginas mais relevantes e só os campos que as regras não obtiveram
+    plans = plan_document_extraction(prepared)
+    result = {
+        "prepared": prepared,
+        "refresh": refresh,
+        "rule_fields": {
+            # Com layout memorizado, os campos conhecidos são os das regiões (exibidos à parte)
+            "campos": sorted({field for plan in plans for field in plan["known"]}) if prepared["layout"] is None else [],
+            "dispensado": all(plan["message_content"] is None for plan in plans),
+        },
+        "json_error": None,
+    }
+    stream_metrics = []
+
+    def complete(message_content):
+        if LLM_STREAM:
+            # Os campos de primeiro nível ficam no trabalho e aparecem no progresso assim que chegam
+            raw_json, metrics = stream_completion(client, message_content, job.add_field)
+            stream_metrics.append(metrics)
+            return raw_json
+        # Extrair apenas o JSON da resposta
+        return extract_json_text(request_completion(client, message_content))
+
+    try:
+        # Parsear o JSON retornado, validar e normalizar pelo esquema da NFS-e e reformatar com indentação
+        # (o documento validado fica em cache pelo texto, usado no download e no editor)
+        parsed_json = extract_parts(plans, complete, refresh=refresh, progress=job.report)
+        result["json"] = validate_document(parsed_json).text
+    except json.JSONDecodeError as e:
+        result["json_error"] = str(e)
+        result["json"] = e.doc  # Retorna o JSON bruto mesmo que inválido
+    # Métricas da primeira chamada em streaming (ausentes quando tudo veio do cache)
+    result["llm_metrics"] = stream_metrics[0] if stream_metrics else None
+    return result
+
+# Função executada na fila que registra o tempo de cada etapa do documento (exibido na barra lateral)
+# e atualiza o arquivo de métricas (OFM_METRICS_FILE) ao final
+def run_document_job(job, *args):
+    try:
+        with collect_trace() as trace:
+            result = process_document(job, *args)
+        result["trace"] = trace
+        return result
+    finally:
+        write_metrics_file()
+
+# Função executada na fila para memorizar o layout de um documento a partir do JSON corrigido
+# (renderização e OCR das palavras fora da execução da página)
+def remember_layout_job(job, file_bytes, is_pdf, prepared, corrected_json):
+    return remember_layout(file_bytes, is_pdf, prepared, corrected_json)
+
+# Função para enviar a memorização do layout à fila sem aguardar o resultado
+# Com a fila cheia o layout não é memorizado (a extração dos documentos tem prioridade)
+def submit_layout_job(file_bytes, is_pdf, document_hash, document):
+    try:
+        get_job_queue().submit(
+            make_key(document_hash, "layout", document.text),
+            remember_layout_job, file_bytes, is_pdf, st.session_state.prepared_document, to_plain(document.data),
+        )
+    except QueueFullError:
+        logger.warning("Fila cheia: layout do documento não memorizado")
+        return
+    st.toast('Memorizando o layout para as próximas notas deste modelo.')
+
+# Função para enviar o documento da sessão à fila de trabalhos (envios idênticos em andamento são compartilhados)
+def submit_job(client, file_bytes, is_pdf, document_hash, refresh=False):
+    try:
+        job = get_job_queue().submit(
+            make_key(document_hash, "regenerar" if refresh else "extrair"),
+            run_document_job, client, file_bytes, is_pdf, refresh, st.session_state.prepared_document,
+        )
+    except QueueFullError as e:
+        st.session_state.job_stopped = (
+            f"Servidor ocupado: {e.queued} documentos aguardando processamento. Tente novamente em instantes."
+        )
+        return
+    st.session_state.job_id = job.id
+
+# Acompanhamento do trabalho da sessão: a página é atualizada periodicamente sem reprocessar nada,
+# e executada por inteiro quando o trabalho termina
+@st.fragment(run_every=0.5)
+def show_job_progress(job_id):
+    queue = get_job_queue()
+    job = queue.get(job_id)
+    if job is None or job.status in FINISHED_STATES:
+        st.rerun()
+    snapshot = job.snapshot()
+    if snapshot["status"] == QUEUED:
+        st.info(f"Documento na fila de processamento (posição {queue.position(job_id)}).")
+    else:
+        label = STAGE_LABELS.get(snapshot["etapa"], "Processando o arquivo")
+        if snapshot["total"]:
+            st.progress(min(1.0, snapshot["feito"] / snapshot["total"]), text=f"{label}: {snapshot['feito']} de {snapshot['total']}")
+        else:
+            st.progress(0.0, text=f"{label}...")
+        st.caption(f"{snapshot['tempo']:.0f}s; etapas concluídas: " + (
+            ", ".join(f"{STAGE_LABELS.get(stage, stage)} ({seconds:.1f}s)" for stage, seconds in snapshot["etapas"]) or "nenhuma"
+        ))
+    # Exibir os campos de primeiro nível (numeroNota, dataEmissao, valorNotaFiscal...) assim que chegam
+    # Listas (Servicos, Titulos...) e campos vazios aparecem só no editor
+    streamed_fields = [
+        f"- **{key if index == 0 else f'{key} (item {index + 1})'}**: {value}"
+        for index, key, value in snapshot["campos"] if not isinstance(value, (list, dict)) and value != ""
+    ]
+    if streamed_fields:
+        st.markdown("\n".join(streamed_fields))
+    if st.button('Cancelar'):
+        # O trabalho só é interrompido se nenhuma outra sessão estiver aguardando o mesmo documento
+        queue.cancel(job_id)
+        st.session_state.job_id = None
+        st.session_state.job_stopped = "Processamento cancelado."
+        st.rerun()
+
+# Função para aplicar à sessão o resultado do trabalho em andamento
+# Retorna False enquanto o trabalho não terminou (o progresso é exibido no lugar do resultado)
+def collect_job():
+    job = get_job_queue().get(st.session_state.job_id)
+    if job is not None and job.status not in FINISHED_STATES:
+        show_job_progress(job.id)
+        return False
+    st.session_state.job_id = None
+    if job is None:
+        st.session_state.job_stopped = "O resultado do processamento expirou."
+    elif job.status == DONE:
+        result = job.result
+        st.session_state.prepared_document = result["prepared"]
+        st.session_state.ocr_text = result["prepared"]["ocr_text"]
+        st.session_state.rule_fields = result["rule_fields"]
+        st.session_state.llm_metrics = result["llm_metrics"]
+        st.session_state.stage_trace = result["trace"]
+        st.session_state.generated_json = result["json"]
+        if result["json_error"] is not None:
+            st.error(f"Erro ao parsear o JSON retornado pela API: {result['json_error']}")
+        else:
+            # Atualizar também o editor de JSON
+            st.session_state.ace_json_editor = result["json"]
+            if result["refresh"]:
+                st.success('JSON regenerado com sucesso!')
+    elif job.status == CANCELLED:
+        st.session_state.job_stopped = "Processamento cancelado."
+    else:
+        st.session_state.job_stopped = f"Ocorreu um erro no processamento. Por favor, tente novamente. ({job.error})"
+    return True
+
+# Função para exibir na barra lateral o tempo de cada etapa de um documento (relógio e CPU, em segundos)
+# Etapas aninhadas são inclusivas: a imagem do modelo contém a composição, a inversão e os JPEGs
+def show_stage_times(trace):
+    rows = summarize_trace(trace)
+    if not rows:
+        st.sidebar.caption("Nenhuma etapa medida (resultado obtido do cache).")
+        return
+    st.sidebar.subheader("Tempos por etapa")
+    st.sidebar.dataframe(
+        [
+            {
+                "Etapa": METRIC_STAGE_LABELS.get(row["etapa"], row["etapa"]),
+                "Chamadas": row["chamadas"],
+                "Tempo (s)": row["tempo"],
+                "CPU (s)": row["cpu"],
+                "Bytes": row.get("bytes_saida", 0),
+            }
+            for row in rows
+        ],
+        hide_index=True,
     )
-    list_final_images = []
-    for i, image in zip(page_indices, renderer):
-        # Converter imagem PIL para bytes
-        image_byte_array = BytesIO()
-        image.save(image_byte_array, format='JPEG', optimize=True)
-        image_bytes = image_byte_array.getvalue()
-        list_final_images.append({i: image_bytes})
-    return list_final_images
-
-# Função para extrair texto usando o Tesseract OCR (usando imagens originais)
-def extract_text_with_pytesseract(list_dict_final_images):
-    image_list = [list(data.values())[0] for data in list_dict_final_images]
-    image_content = []
-    for index, image_bytes in enumerate(image_list):
-        # Abrir imagem a partir dos bytes
-        image = Image.open(BytesIO(image_bytes))
-        # Realizar OCR
-        raw_text = str(image_to_string(image, lang='por'))
-        image_content.append(raw_text)
-    return "\n".join(image_content)
+    tokens = [row for row in rows if row["etapa"] == "modelo" and row.get("tokens_prompt")]
+    if tokens:
+        st.sidebar.caption(f"Tokens: {tokens[0]['tokens_prompt']} no prompt, {tokens[0].get('tokens_resposta', 0)} na resposta")
 
 def main():
     st.set_page_config(layout="wide")  # Ajusta o layout para largura total
@@ -99,10 +258,20 @@ def main():
         st.session_state.ace_json_editor = ""
     if 'last_uploaded_file' not in st.session_state:
         st.session_state.last_uploaded_file = None
-    if 'images_list' not in st.session_state:
-        st.session_state.images_list = []
     if 'ocr_text' not in st.session_state:
         st.session_state.ocr_text = ""
+    if 'prepared_document' not in st.session_state:
+        st.session_state.prepared_document = None
+    if 'llm_metrics' not in st.session_state:
+        st.session_state.llm_metrics = None
+    if 'rule_fields' not in st.session_state:
+        st.session_state.rule_fields = None
+    if 'stage_trace' not in st.session_state:
+        st.session_state.stage_trace = None  # Etapas medidas no último processamento do documento
+    if 'job_id' not in st.session_state:
+        st.session_state.job_id = None  # Trabalho da sessão na fila de processamento
+    if 'job_stopped' not in st.session_state:
+        st.session_state.job_stopped = None  # Motivo da interrupção (cancelado, erro ou fila cheia)
     if 'editor_version' not in st.session_state:
         st.session_state.editor_version = 0  # Inicializa o contador de versões
 
@@ -112,22 +281,33 @@ def main():
         st.error('A chave de API da Groq não foi encontrada. Verifique as configurações de segredos no Streamlit Cloud.')
         return
 
-    # Inicializar o cliente Groq com a chave de API
-    client = Groq(api_key=api_key)
+    # Obter o cliente Groq com a chave de API
+    client = get_client(api_key)
+    get_metrics_server()
 
     uploaded_file = st.file_uploader("Escolha uma imagem ou PDF...", type=["jpg", "jpeg", "png", "pdf"])
 
     # Verificar se um novo arquivo foi carregado
     if uploaded_file is not None:
-        # Verificar se o arquivo atual é diferente do último carregado
-        if st.session_state.last_uploaded_file != uploaded_file.name:
+        file_bytes = uploaded_file.getvalue()
+        # Verificar se o conteúdo do arquivo atual é diferente do último carregado (o nome pode mudar)
+        document_hash = hash_bytes(file_bytes)
+        if st.session_state.last_uploaded_file != document_hash:
             # Atualizar o último arquivo carregado
-            st.session_state.last_uploaded_file = uploaded_file.name
+            st.session_state.last_uploaded_file = document_hash
             # Limpar o JSON gerado anteriormente, editor e outros estados
             st.session_state.generated_json = ""
             st.session_state.ace_json_editor = ""
-            st.session_state.images_list = []
             st.session_state.ocr_text = ""
+            st.session_state.prepared_document = None
+            st.session_state.llm_metrics = None
+            st.session_state.rule_fields = None
+            st.session_state.stage_trace = None
+            # O trabalho do documento anterior deixa de ser aguardado por esta sessão
+            if st.session_state.job_id is not None:
+                get_job_queue().cancel(st.session_state.job_id)
+            st.session_state.job_id = None
+            st.session_state.job_stopped = None
             st.session_state.editor_version += 1  # Incrementa o contador de versões
     else:
         # Se nenhum arquivo estiver carregado, limpar todos os estados
@@ -135,297 +315,147 @@ def main():
             st.session_state.generated_json = ""
         if st.session_state.last_uploaded_file is not None:
             st.session_state.last_uploaded_file = None
-        if st.session_state.images_list != []:
-            st.session_state.images_list = []
         if st.session_state.ocr_text != "":
             st.session_state.ocr_text = ""
+        if st.session_state.prepared_document is not None:
+            st.session_state.prepared_document = None
+        if st.session_state.llm_metrics is not None:
+            st.session_state.llm_metrics = None
+        if st.session_state.rule_fields is not None:
+            st.session_state.rule_fields = None
+        if st.session_state.stage_trace is not None:
+            st.session_state.stage_trace = None
         if st.session_state.ace_json_editor != "":
             st.session_state.ace_json_editor = ""
+        if st.session_state.job_id is not None:
+            get_job_queue().cancel(st.session_state.job_id)
+            st.session_state.job_id = None
+        if st.session_state.job_stopped is not None:
+            st.session_state.job_stopped = None
         if st.session_state.editor_version != 0:
             st.session_state.editor_version = 0  # Reseta o contador de versões
 
     if uploaded_file is not None:
+        is_pdf = uploaded_file.type == "application/pdf"
         try:
-            with st.spinner('Processando o arquivo...'):
-                if uploaded_file.type == "application/pdf":
-                    # É um PDF
-                    with tempfile.NamedTemporaryFile(delete=False, suffix=".pdf") as tmp_file:
-                        tmp_file.write(uploaded_file.getbuffer())
-                        tmp_file_path = tmp_file.name
-
-                    # Converter PDF em imagens (sem inversão de cores)
-                    st.session_state.images_list = convert_pdf_to_images(tmp_file_path)
-
-                    # Extrair texto usando OCR das imagens originais
-                    st.session_state.ocr_text = extract_text_with_pytesseract(st.session_state.images_list)
-
-                    # Obter a primeira imagem (página) do PDF
-                    first_image_bytes = list(st.session_state.images_list[0].values())[0]
-
-                    # Aplicar inversão de cores à primeira imagem para o LLM
-                    enhanced_image_bytes = invert_image_color(first_image_bytes)
-
-                    # Combinar as imagens original e invertida
-                    combined_image_bytes = combine_images(first_image_bytes, enhanced_image_bytes)
-
-                    # Codificar a imagem combinada em base64
-                    base64_combined_image = encode_image(combined_image_bytes)
-                else:
-                    # É uma imagem
-                    image_bytes = uploaded_file.getvalue()
-
-                    # Realizar OCR na imagem original
-                    image = Image.open(BytesIO(image_bytes))
-                    st.session_state.ocr_text = image_to_string(image, lang='por')
-
-                    # Aplicar inversão de cores à imagem para o LLM
-                    enhanced_image_bytes = invert_image_color(image_bytes)
-
-                    # Combinar as imagens original e invertida
-                    combined_image_bytes = combine_images(image_bytes, enhanced_image_bytes)
-
-                    # Codificar a imagem combinada em base64
-                    base64_combined_image = encode_image(combined_image_bytes)
-
-            # Definições dos campos do JSON (mantido igual)
-            field_definitions = (
-                "Definições dos campos do JSON a serem preenchidos:\n\n"
-                "1. numeroRps (String) - Número do RPS que gerou a nota fiscal de saída de serviço. Obrigatório: Sim\n"
-                "2. numeroNota (String) - Número da nota fiscal de saída de serviço. Obrigatório: Sim\n"
-                "3. dataEmissao (String) - Data de emissão da nota fiscal de saída (Formato: DD/MM/YYYY HH24:MI:SS). Obrigatório: Sim\n"
-                "4. codigoSerie (String) - Código da série da nota fiscal de serviço. Obrigatório: Não\n"
-                "5. descricaoSerie (String) - Descrição da série da nota fiscal de serviço. Obrigatório: Não\n"
-                "6. codigoModelo (String) - Código do modelo da nota fiscal de serviço. Obrigatório: Sim\n"
-                "7. descricaoModelo (String) - Descrição do modelo da nota fiscal de serviço. Obrigatório: Não\n"
-                "8. cnpjCliente (String) - CNPJ do cliente da nota fiscal de serviço. Obrigatório: Não\n"
-                "9. razaoCliente (String) - Razão social do cliente da nota fiscal de serviço. Obrigatório: Não\n"
-                "10. codIbgeEstadoServico (String) - Código IBGE do estado da execução do serviço. Obrigatório: Sim\n"
-                "11. codIbgeCidadeServico (String) - Código IBGE da cidade da execução do serviço. Obrigatório: Sim\n"
-                "12. tipoTributacaoIss (String) - Tipo de Tributação do ISS (1 a 9). Obrigatório: Sim\n"
-                "   Valores possíveis:\n"
-                "     1. Tributado no Município\n"
-                "     2. Tributado fora do Município\n"
-                "     3. Tributado no Município Isento\n"
-                "     4. Tributado fora do Município Isento\n"
-                "     5. Tributado no Município Imune\n"
-                "     6. Tributado fora do Município Imune\n"
-                "     7. Tributado no Município Suspensa\n"
-                "     8. Tributado fora do Município Suspensa\n"
-                "     9. Exp Servicos\n"
-                "13. valorNotaFiscal (BigDecimal) - Valor da nota fiscal de serviço. Obrigatório: Sim\n"
-                "14. valorMulta (BigDecimal) - Valor da multa na nota fiscal de serviço. Obrigatório: Não\n"
-                "15. valorDesconto (BigDecimal) - Valor do desconto na nota fiscal de serviço. Obrigatório: Não\n"
-                "16. termoRecebimento (String) - Descrição do termo de recebimento da nota fiscal de serviço integrado com o Fusion (Oracle). Obrigatório: Não\n"
-                "17. observacao (String) - Descrição da observação da nota fiscal de serviço. Obrigatório: Sim\n\n"
-                "Servicos:\n"
-                "1. codigoTipoServico (String) - Código do Tipo de Serviço na nota fiscal. Obrigatório: Sim\n"
-                "2. descricaoTipoServico (String) - Descrição do Tipo de Serviço na nota fiscal. Obrigatório: Sim\n"
-                "3. codigoServico (String) - Código do Serviço na nota fiscal. Obrigatório: Sim\n"
-                "4. descricaoServico (String) - Descrição do Serviço na nota fiscal. Obrigatório: Sim\n"
-                "5. quantidadeServico (BigDecimal) - Quantidade do serviço na nota fiscal. Obrigatório: Sim\n"
-                "6. valorServico (BigDecimal) - Valor do serviço na nota fiscal. Obrigatório: Sim\n"
-                "7. valorTotalServico (BigDecimal) - Valor total do serviço na nota fiscal. Obrigatório: Sim\n\n"
-                "ImpostosRetido (Se houver):\n"
-                "1. indicadorImposto (String) - Tipo de imposto (ex: COFINS, PIS/PASEP, ISS, INSS-PJ, INSS-PF, IRRF-PF, IRRF-PJ, CSLL). Obrigatório se houver informação no documento.\n"
-                "2. codigoReceita (String) - Código da Receita. Obrigatório: Não\n"
-                "3. indicadorRetencao (String) - Indica se o imposto possui Retenção. Obrigatório se houver informação no documento.\n"
-                "4. vlrBaseImposto (BigDecimal) - Valor base do Imposto. Obrigatório se houver informação no documento.\n"
-                "5. aliquotaImposto (BigDecimal) - Alíquota do Imposto. Obrigatório se houver informação no documento.\n"
-                "6. vlrImposto (BigDecimal) - Valor do Imposto. Obrigatório se houver informação no documento.\n\n"
-                "Titulos:\n"
-                "1. numeroTitulo (String) - Informar o número do título. Obrigatório: Não\n"
-                "2. dataVencimento (Data) - Data de vencimento do título (Formato: DD/MM/YYYY). Obrigatório: Não\n"
-                "3. cnpjCpfCredorTitulo (String) - CNPJ/CPF do credor do título. Obrigatório: Não\n"
-                "4. valorTitulo (BigDecimal) - Valor do título. Obrigatório: Não\n"
-                "5. indicadorTipoTitulo (String) - Tipo do título ('P' - Título do credor principal, 'R' - Título de retenção). Obrigatório: Não\n"
-            )
-
-            # Construir o conteúdo da mensagem com o entendimento de que os arquivos podem não seguir um padrão
-            message_content = [
-                {
-                    "type": "text",
-                    "text": (
-                        "Por favor, analise o documento fornecido e extraia todas as informações relevantes necessárias para preencher o JSON abaixo. "
-                        "Note que os arquivos fornecidos podem não seguir um padrão específico, portanto, é importante buscar as informações pertinentes para preencher o JSON, independentemente do formato do documento. "
-                        "Utilize tanto o conteúdo das imagens (original e tratada) quanto o texto extraído via OCR fornecido abaixo. "
-                        "Corrija todas as incongruências entre o OCR e as imagens para chegar ao melhor resultado possível. "
-                        "Preencha o JSON abaixo com os dados extraídos. "
-                        "Não inclua descrições adicionais, apenas preencha o JSON seguindo exatamente a estrutura apresentada. "
-                        "Sempre responda **apenas com o JSON**, sem incluir qualquer texto adicional ou explicações.\n\n"
-                        "Certifique-se de preencher todos os campos com as informações extraídas do documento fornecido e siga a estrutura exata para garantir a compatibilidade com o sistema de integração. "
-                        "Por favor, concentre-se apenas nas informações do arquivo; não invente dados. Para os campos que não tiverem informação no arquivo, deixe vazio como \"\".\n\n"
-                        f"{field_definitions}\n"
-                        "Conteúdo extraído via OCR (pode conter erros):\n"
-                        f"{st.session_state.ocr_text}\n\n"
-                        "Estrutura do JSON a ser preenchido,  caso não tenha informações suficientes de seção, exiba apenas o array vazio []:\n"
-                        "[\n"
-                        "  {\n"
-                        "    \"numeroRps\": \"\",\n"
-                        "    \"numeroNota\": \"\",\n"
-                        "    \"dataEmissao\": \"\",\n"
-                        "    \"codigoSerie\": \"\",\n"
-                        "    \"descricaoSerie\": \"\",\n"
-                        "    \"codigoModelo\": \"\",\n"
-                        "    \"descricaoModelo\": \"\",\n"
-                        "    \"cnpjCliente\": \"\",\n"
-                        "    \"razaoCliente\": \"\",\n"
-                        "    \"codIbgeEstadoServico\": \"\",\n"
-                        "    \"codIbgeCidadeServico\": \"\",\n"
-                        "    \"tipoTributacaoIss\": \"\",\n"
-                        "    \"valorNotaFiscal\": 0,\n"
-                        "    \"valorMulta\": 0,\n"
-                        "    \"valorDesconto\": 0,\n"
-                        "    \"termoRecebimento\": \"\",\n"
-                        "    \"observacao\": \"\",\n"
-                        "    \"Servicos\": [\n"
-                        "      {\n"
-                        "        \"codigoTipoServico\": \"\",\n"
-                        "        \"descricaoTipoServico\": \"\",\n"
-                        "        \"codigoServico\": \"\",\n"
-                        "        \"descricaoServico\": \"\",\n"
-                        "        \"quantidadeServico\": 0,\n"
-                        "        \"valorServico\": 0,\n"
-                        "        \"valorTotalServico\": 0,\n"
-                        "        \"cstSpedEfdSaida\": 0,\n"
-                        "        \"aliqPisSpedEfdSaida\": 0.0,\n"
-                        "        \"aliqCofinsSpedEfdSaida\": 0.0\n"
-                        "      }\n"
-                        "    ],\n"
-                        "    \"CodigoReceita\": [\n"
-                        "      {\n"
-                        "        \"codigoReceita\": \"\"\n"
-                        "      },\n"
-                        "      {\n"
-                        "        \"codigoReceita\": \"\"\n"
-                        "      }\n"
-                        "    ],\n"
-                        "    \"ImpostosRetido\": [\n"
-                        "      {\n"
-                        "        \"indicadorImposto\": \"\",\n"
-                        "        \"codigoReceita\": \"\",\n"
-                        "        \"indicadorRetencao\": \"\",\n"
-                        "        \"vlrBaseImposto\": 0,\n"
-                        "        \"aliquotaImposto\": 0.0,\n"
-                        "        \"vlrImposto\": 0.0\n"
-                        "      }\n"
-                        "    ],\n"
-                        "    \"Titulos\": [\n"
-                        "      {\n"
-                        "        \"numeroTitulo\": \"\",\n"
-                        "        \"dataVencimento\": \"\",\n"
-                        "        \"cnpjCpfCredorTitulo\": \"\",\n"
-                        "        \"valorTitulo\": 0,\n"
-                        "        \"indicadorTipoTitulo\": \"\"\n"
-                        "      }\n"
-                        "    ]\n"
-                        "  }\n"
-                        "]"
-                    )
-                }
-            ]
-
-            # Adicionar a imagem combinada ao conteúdo da mensagem
-            message_content.append(
-                {
-                    "type": "image_url",
-                    "image_url": {
-                        "url": f"data:image/jpeg;base64,{base64_combined_image}"
-                    }
-                }
-            )
-
-            # Função para gerar o JSON usando a API Groq
-            def generate_json():
-                completion = client.chat.completions.create(
-                    model="llama-3.2-11b-vision-preview",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": message_content
-                        }
-                    ],
-                    temperature=0,  # Definir como 0 para saída determinística
-                    max_tokens=8000,  # Ajuste conforme necessário
-                    top_p=1,
-                    stream=False,
-                    stop=None,
-                )
-                raw_response = completion.choices[0].message.content
-
-                # Extrair apenas o JSON da resposta usando regex
-                json_match = re.search(r'\[.*\]', raw_response, re.DOTALL)
-                if json_match:
-                    raw_json = json_match.group(0)
-                else:
-                    raw_json = raw_response  # Fallback se não encontrar padrão
-
-                try:
-                    # Parsear o JSON retornado para garantir que está válido
-                    parsed_json = json.loads(raw_json)
-                    # Reformatar o JSON com indentação
-                    pretty_json = json.dumps(parsed_json, indent=4, ensure_ascii=False)
-                    # Atualizar tanto o JSON gerado quanto o editor de JSON
-                    st.session_state.generated_json = pretty_json
-                    st.session_state.ace_json_editor = pretty_json
-                    return pretty_json
-                except json.JSONDecodeError as e:
-                    st.error(f"Erro ao parsear o JSON retornado pela API: {e}")
-                    return raw_json  # Retorna o JSON bruto mesmo que inválido
-
-            # Se o JSON ainda não foi gerado, faça a geração inicial
-            if st.session_state.generated_json == "":
-                with st.spinner('Gerando o JSON...'):
-                    st.session_state.generated_json = generate_json()
+            # O documento é processado na fila de trabalhos; enquanto isso a página apenas acompanha o progresso
+            if st.session_state.job_id is None and st.session_state.generated_json == "" and st.session_state.job_stopped is None:
+                submit_job(client, file_bytes, is_pdf, document_hash)
+            if st.session_state.job_id is not None and not collect_job():
+                return
+            if st.session_state.job_stopped is not None:
+                st.warning(st.session_state.job_stopped)
+                if st.button('Processar novamente'):
+                    st.session_state.job_stopped = None
+                    st.rerun()
+                return
+
+            # Detalhamento opcional do tempo de cada etapa do último processamento do documento
+            if st.sidebar.checkbox('Exibir tempos por etapa') and st.session_state.stage_trace is not None:
+                show_stage_times(st.session_state.stage_trace)
 
             # Exibir a imagem e o JSON lado a lado
             col1, col2 = st.columns([1, 1])  # Ajuste as proporções conforme necessário
 
             with col1:
                 st.subheader('Documento')
-                if uploaded_file.type == "application/pdf":
-                    num_pages = len(st.session_state.images_list)
+                # Origem do texto enviado ao modelo: camada de texto do PDF, OCR ou ambos
+                text_sources = st.session_state.prepared_document["text_sources"]
+                text_path_labels = {
+                    "texto": "camada de texto do PDF (sem OCR)",
+                    "ocr": "OCR",
+                    "zonal": "OCR zonal das regiões de um layout memorizado",
+                    "misto": f"camada de texto em {text_sources.count('texto')} página(s), OCR em {text_sources.count('ocr')}",
+                }
+                st.caption(f"Texto extraído via {text_path_labels[st.session_state.prepared_document['text_path']]}")
+                # Páginas enviadas ao modelo como imagem, escolhidas pela relevância
+                parts = st.session_state.prepared_document["parts"]
+                if len(parts) > 1:
+                    st.caption(f"{len(parts)} notas fiscais encontradas: uma chamada ao modelo por nota, com os resultados combinados")
+                for part in parts:
+                    payload_info = part["payload"]
+                    if payload_info is None:
+                        continue
+                    image_pages = ", ".join(str(i + 1) for i in part["image_pages"])
+                    st.caption(
+                        f"Imagem enviada ao modelo (página(s) {image_pages}): {payload_info['width']}x{payload_info['height']} px, "
+                        f"{payload_info['bytes'] / 1024:.0f} KB (qualidade {payload_info['quality']})"
+                    )
+                # Latência do OCR por página (ausente quando o texto veio do cache)
+                ocr_latencies = st.session_state.prepared_document["ocr_latencies"]
+                if ocr_latencies:
+                    st.caption(
+                        f"OCR ({st.session_state.prepared_document['ocr_backend']}): "
+                        f"{sum(ocr_latencies):.1f}s em {len(ocr_latencies)} página(s), "
+                        f"máx. {max(ocr_latencies):.2f}s por página"
+                    )
+                if is_pdf:
+                    thumbnails = st.session_state.prepared_document["thumbnails"]
+                    num_pages = len(thumbnails)
+                    # Miniaturas leves de todas as páginas; só a página selecionada é renderizada em resolução total
+                    with st.expander(f"Páginas ({num_pages})", expanded=num_pages > 1):
+                        st.image(thumbnails, caption=[f'Página {i}' for i in range(1, num_pages + 1)], width=96)
                     page_number = st.selectbox(
                         "Selecione a página do PDF para visualizar:",
                         options=range(1, num_pages + 1),
                         index=0
                     )
-                    selected_image_bytes = list(st.session_state.images_list[page_number - 1].values())[0]
+                    selected_image_bytes = render_page_preview(
+                        file_bytes, page_number - 1, st.session_state.prepared_document["document_hash"]
+                    )
                     st.image(selected_image_bytes, caption=f'Página {page_number} do PDF carregado.', use_column_width=True)
                 else:
-                    st.image(image_bytes, caption='Imagem carregada.', use_column_width=True)
+                    st.image(file_bytes, caption='Imagem carregada.', use_column_width=True)
 
             with col2:
                 st.subheader('JSON Editor')
                 st.markdown('Para aplicar as alterações, utilize **CTRL+ENTER**.')  # Descrição adicionada
+                # Campos obtidos por regras no texto, sem o modelo
+                rule_fields = st.session_state.rule_fields
+                if rule_fields and rule_fields["campos"]:
+                    st.caption(
+                        f"Campos obtidos pelas regras: {', '.join(rule_fields['campos'])}"
+                        + (" (modelo dispensado)" if rule_fields["dispensado"] else "")
+                    )
+                # Layout memorizado: campos lidos nas regiões, sem OCR completo
+                layout = st.session_state.prepared_document["layout"]
+                if layout is not None:
+                    st.caption(f"Layout memorizado: {', '.join(layout['campos'])} lidos nas regiões; os demais campos pelo modelo")
+                # Tempo até o primeiro campo da resposta em streaming
+                llm_metrics = st.session_state.llm_metrics
+                if llm_metrics and llm_metrics["tempo_primeiro_campo"] is not None:
+                    st.caption(
+                        f"Primeiro campo em {llm_metrics['tempo_primeiro_campo']:.1f}s, "
+                        f"JSON completo em {llm_metrics['tempo_total']:.1f}s"
+                    )
 
                 # Botões lado a lado após a descrição
                 col_buttons = st.columns(2)
                 with col_buttons[0]:
                     # Botão para regenerar o JSON
                     if st.button('Regenerar JSON'):
-                        with st.spinner('Regenerando o JSON...'):
-                            st.session_state.generated_json = generate_json()
-                            st.success('JSON regenerado com sucesso!')
+                        submit_job(client, file_bytes, is_pdf, document_hash, refresh=True)
+                        st.rerun()
 
                 with col_buttons[1]:
-                    # Botão para baixar o JSON
-                    try:
-                        parsed_json = json.loads(st.session_state.generated_json)
-                        json_valid = True
-                    except json.JSONDecodeError as e:
-                        json_valid = False
-                        st.error(f"O JSON fornecido não é válido: {e}")
-
-                    if json_valid:
+                    # Botão para baixar o JSON (lido e validado só quando o texto muda)
+                    document = load_document(st.session_state.generated_json)
+                    if document.error is None:
                         st.download_button(
                             label="Baixar JSON",
-                            data=json.dumps(parsed_json, indent=4, ensure_ascii=False),
+                            data=document.text,
                             file_name='extracted_data.json',
                             mime='application/json'
                         )
                     else:
+                        st.error(f"O JSON fornecido não é válido: {document.error}")
                         st.warning("Corrija os erros no JSON para habilitar o download.")
 
+                # Campos obrigatórios vazios e valores que não seguem o tipo do campo
+                if document.errors:
+                    with st.expander(f"{len(document.errors)} aviso(s) de validação"):
+                        st.markdown("\n".join(f"- `{field}`: {message}" for field, message in document.errors))
+
                 # Editor de código Ace para edição do JSON com destaque de sintaxe
                 edited_json = st_ace(
                     value=st.session_state.ace_json_editor,
@@ -441,13 +471,15 @@ def main():
 
                 # Atualizar o JSON no session_state se houver alterações
                 if edited_json and edited_json != st.session_state.ace_json_editor:
-                    try:
-                        parsed_json = json.loads(edited_json)
-                        # Reformatar o JSON com indentação
-                        pretty_json = json.dumps(parsed_json, indent=4, ensure_ascii=False)
-                        st.session_state.generated_json = pretty_json
-                        st.session_state.ace_json_editor = pretty_json
-                    except json.JSONDecodeError as e:
+                    document = load_document(edited_json)
+                    if document.error is None:
+                        # Usar o JSON normalizado e reformatado com indentação
+                        st.session_state.generated_json = document.text
+                        st.session_state.ace_json_editor = document.text
+                        # Memorizar onde cada campo corrigido está no documento (próximas notas do mesmo
+                        # layout), em segundo plano na fila de trabalhos
+                        submit_layout_job(file_bytes, is_pdf, document_hash, document)
+                    else:
                         # Se o JSON for inválido, manter o texto editado como está
                         st.session_state.ace_json_editor = edited_json
 
@@ -0,0 +1,260 @@
+import contextvars
+import cProfile
+import io
+import json
+import logging
+import os
+import pstats
+import tempfile
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# Instrumentação por etapa do pipeline (renderização, JPEG, OCR, inversão, composição, base64,
+# prompt, rede e modelo): tempo de relógio e de CPU, bytes de entrada e saída, páginas, caracteres
+# e tokens. Cada etapa vira um evento de log estruturado (JSON) e soma nas métricas do processo,
+# expostas no formato texto do Prometheus (endpoint HTTP ou arquivo). O detalhamento por documento
+# é coletado com collect_trace, e OFM_PROFILE liga o cProfile e o tracemalloc nas etapas escolhidas
+
+# Eventos de cada etapa no log em nível INFO (por padrão ficam em DEBUG)
+METRICS_LOG = os.getenv('OFM_METRICS_LOG', '0') == '1'
+# Arquivo com as métricas no formato do Prometheus (ex: para o textfile collector do node_exporter)
+METRICS_FILE = os.getenv('OFM_METRICS_FILE', '')
+# Porta do endpoint /metrics (0 desliga)
+METRICS_PORT = int(os.getenv('OFM_METRICS_PORT', '0'))
+# Etapas perfiladas, separadas por vírgula ("todas" para todas), e diretório dos perfis
+PROFILE_STAGES = {stage for stage in os.getenv('OFM_PROFILE', '').split(",") if stage}
+PROFILE_DIR = os.getenv('OFM_PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'ofm-perfis'))
+
+# Limites (segundos) do histograma de duração das etapas
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Valores numéricos aceitos em uma etapa, somados nas métricas como contadores
+VALUE_FIELDS = (
+    "paginas", "bytes_entrada", "bytes_saida", "caracteres", "tokens_estimados",
+    "tokens_prompt", "tokens_resposta",
+)
+
+_lock = threading.Lock()
+_stages = {}
+_trace = contextvars.ContextVar('ofm_trace', default=None)
+# Uma etapa perfilada por vez no processo: o tracemalloc (início, pico e fim) é global, então as
+# etapas escolhidas que começam enquanto outra é perfilada (aninhadas ou em outras threads, ex: o
+# pool de OCR) são apenas medidas
+_profile_lock = threading.Lock()
+
+# Função para alterar a configuração (ex: a partir dos argumentos do modo em lote)
+def configure(log=None, metrics_file=None, profile=None, profile_dir=None):
+    global METRICS_LOG, METRICS_FILE, PROFILE_STAGES, PROFILE_DIR
+    if log is not None:
+        METRICS_LOG = log
+    if metrics_file is not None:
+        METRICS_FILE = metrics_file
+    if profile is not None:
+        PROFILE_STAGES = set(profile)
+    if profile_dir is not None:
+        PROFILE_DIR = profile_dir
+
+def _new_aggregate():
+    return {
+        "chamadas": 0, "tempo": 0.0, "cpu": 0.0,
+        "buckets": [0] * len(DURATION_BUCKETS),
+        **{field: 0 for field in VALUE_FIELDS},
+    }
+
+def _aggregate(stage, wall, cpu, values):
+    with _lock:
+        aggregate = _stages.get(stage)
+        if aggregate is None:
+            aggregate = _stages[stage] = _new_aggregate()
+        aggregate["chamadas"] += 1
+        aggregate["tempo"] += wall
+        aggregate["cpu"] += cpu or 0.0
+        for i, limit in enumerate(DURATION_BUCKETS):
+            if wall <= limit:
+                aggregate["buckets"][i] += 1
+        for field in VALUE_FIELDS:
+            aggregate[field] += values.get(field) or 0
+
+# Função para registrar uma etapa já medida (ex: a latência de uma página devolvida pelo pool de OCR)
+# values: paginas, bytes_entrada, bytes_saida, caracteres, tokens_*; outros valores só vão para o log
+def record_stage(stage, wall, cpu=None, **values):
+    event = {"etapa": stage, "tempo": round(wall, 6)}
+    if cpu is not None:
+        event["cpu"] = round(cpu, 6)
+    event.update((key, value) for key, value in values.items() if value is not None)
+    _aggregate(stage, wall, cpu, values)
+    trace = _trace.get()
+    if trace is not None:
+        trace.append(event)
+    logger.log(logging.INFO if METRICS_LOG else logging.DEBUG, json.dumps(event, ensure_ascii=False))
+
+class StageRecord:
+    # Valores de uma etapa em andamento (bytes, páginas, tokens...), preenchidos pelo código medido
+    def __init__(self):
+        self.values = {}
+
+    def add(self, **values):
+        for key, value in values.items():
+            if isinstance(value, (int, float)) and isinstance(self.values.get(key), (int, float)):
+                self.values[key] += value
+            else:
+                self.values[key] = value
+
+def _profile_enabled(stage):
+    return bool(PROFILE_STAGES) and ("todas" in PROFILE_STAGES or stage in PROFILE_STAGES)
+
+# Função para gravar o perfil de uma etapa (.prof, legível com pstats ou snakeviz) e registrar as funções mais caras
+def _save_profile(stage, profiler, memory_peak):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{stage}-{time.strftime('%Y%m%d-%H%M%S')}-{threading.get_ident()}.prof")
+    profiler.dump_stats(path)
+    summary = io.StringIO()
+    pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(15)
+    logger.info("Perfil da etapa %s gravado em %s (pico de memória %.1f MB)\n%s", stage, path, memory_peak / 2 ** 20, summary.getvalue())
+
+# Mede uma etapa: tempo de relógio, tempo de CPU da thread e os valores adicionados ao registro
+# Uso: with stage("jpeg") as record: ...; record.add(bytes_saida=len(data))
+# Etapas aninhadas são medidas de forma inclusiva (a etapa externa contém o tempo das internas)
+@contextmanager
+def stage(name, **values):
+    record = StageRecord()
+    record.add(**values)
+    profiler = None
+    if _profile_enabled(name) and _profile_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        started_tracemalloc = not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profiler.enable()
+    started = time.perf_counter()
+    started_cpu = time.thread_time()
+    try:
+        yield record
+    finally:
+        wall = time.perf_counter() - started
+        cpu = time.thread_time() - started_cpu
+        if profiler is not None:
+            profiler.disable()
+            try:
+                _, memory_peak = tracemalloc.get_traced_memory()
+                if started_tracemalloc:
+                    tracemalloc.stop()
+            finally:
+                _profile_lock.release()
+            record.add(memoria_pico=memory_peak)
+            _save_profile(name, profiler, memory_peak)
+        record_stage(name, wall, cpu, **record.values)
+
+# Coleta os eventos das etapas executadas na thread atual (ex: o detalhamento de um documento)
+# Uso: with collect_trace() as trace: ... ; trace é a lista de eventos
+@contextmanager
+def collect_trace():
+    trace = []
+    token = _trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _trace.reset(token)
+
+# Função para resumir os eventos de um documento por etapa: chamadas, tempos e valores somados
+def summarize_trace(trace):
+    summary = {}
+    for event in trace:
+        row = summary.setdefault(event["etapa"], {"etapa": event["etapa"], "chamadas": 0, "tempo": 0.0, "cpu": 0.0})
+        row["chamadas"] += 1
+        for key, value in event.items():
+            if key != "etapa" and isinstance(value, (int, float)):
+                row[key] = row.get(key, 0) + value
+    for row in summary.values():
+        for key, value in row.items():
+            if isinstance(value, float):
+                row[key] = round(value, 3)
+    return list(summary.values())
+
+# Função para somar às métricas deste processo os eventos medidos em outro (ex: processos do modo em lote)
+def absorb_trace(trace):
+    for event in trace:
+        _aggregate(event["etapa"], event["tempo"], event.get("cpu"), event)
+
+# Função para gerar as métricas no formato texto do Prometheus
+def render_prometheus():
+    with _lock:
+        stages = {name: dict(aggregate, buckets=list(aggregate["buckets"])) for name, aggregate in _stages.items()}
+    lines = [
+        "# HELP ofm_stage_calls_total Execuções de cada etapa do pipeline.",
+        "# TYPE ofm_stage_calls_total counter",
+    ]
+    lines += [f'ofm_stage_calls_total{{etapa="{name}"}} {aggregate["chamadas"]}' for name, aggregate in sorted(stages.items())]
+    lines += [
+        "# HELP ofm_stage_cpu_seconds_total Tempo de CPU (da thread) de cada etapa.",
+        "# TYPE ofm_stage_cpu_seconds_total counter",
+    ]
+    lines += [f'ofm_stage_cpu_seconds_total{{etapa="{name}"}} {aggregate["cpu"]:.6f}' for name, aggregate in sorted(stages.items())]
+    lines += [
+        "# HELP ofm_stage_duration_seconds Tempo de relógio de cada etapa.",
+        "# TYPE ofm_stage_duration_seconds histogram",
+    ]
+    for name, aggregate in sorted(stages.items()):
+        for limit, count in zip(DURATION_BUCKETS, aggregate["buckets"]):
+            lines.append(f'ofm_stage_duration_seconds_bucket{{etapa="{name}",le="{limit}"}} {count}')
+        lines.append(f'ofm_stage_duration_seconds_bucket{{etapa="{name}",le="+Inf"}} {aggregate["chamadas"]}')
+        lines.append(f'ofm_stage_duration_seconds_sum{{etapa="{name}"}} {aggregate["tempo"]:.6f}')
+        lines.append(f'ofm_stage_duration_seconds_count{{etapa="{name}"}} {aggregate["chamadas"]}')
+    for field in VALUE_FIELDS:
+        rows = [(name, aggregate[field]) for name, aggregate in sorted(stages.items()) if aggregate[field]]
+        if not rows:
+            continue
+        lines += [
+            f"# HELP ofm_stage_{field}_total Soma de {field} nas execuções de cada etapa.",
+            f"# TYPE ofm_stage_{field}_total counter",
+        ]
+        lines += [f'ofm_stage_{field}_total{{etapa="{name}"}} {value}' for name, value in rows]
+    return "\n".join(lines) + "\n"
+
+# Função para gravar as métricas no arquivo configurado (de forma atômica; nada é feito sem arquivo)
+def write_metrics_file(path=None):
+    path = path or METRICS_FILE
+    if not path:
+        return
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as tmp_file:
+            tmp_file.write(render_prometheus())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+# Função para iniciar o endpoint /metrics em uma thread (None se nenhuma porta foi configurada)
+def start_metrics_server(port=None, host="0.0.0.0"):
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name='metricas').start()
+    logger.info("Métricas disponíveis em http://%s:%d/metrics", host, server.server_address[1])
+    return server
@@ -0,0 +1,193 @@
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import cv2
+import numpy as np
+import pytesseract
+from PIL import Image
+from pytesseract import image_to_string
+
+from images import as_array
+from metrics import stage
+from preprocess import preprocess_page
+
+# tesserocr é opcional: mantém a API do Tesseract carregada no próprio processo,
+# sem abrir um executável e recarregar o traineddata a cada página
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# Configurar o caminho do Tesseract OCR
+pytesseract.pytesseract.tesseract_cmd = r'/usr/bin/tesseract'
+
+# Backend de OCR: auto (tesserocr se instalado), tesserocr, pytesseract ou um registrado com register_backend
+OCR_BACKEND = os.getenv('OFM_OCR_BACKEND', 'auto')
+# Número de páginas processadas em paralelo
+OCR_WORKERS = int(os.getenv('OFM_OCR_WORKERS', '0')) or min(4, os.cpu_count() or 1)
+
+_executor = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+# Função para definir o backend e o número de workers (ex: nos processos do modo em lote)
+def configure(backend=None, workers=None):
+    global OCR_BACKEND, OCR_WORKERS, _executor
+    with _executor_lock:
+        if backend is not None:
+            OCR_BACKEND = backend
+        if workers is not None and workers != OCR_WORKERS:
+            OCR_WORKERS = workers
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+                _executor = None
+
+# Função para resolver o nome do backend efetivamente usado
+def resolve_backend(backend=None):
+    backend = backend or OCR_BACKEND
+    if backend == 'auto':
+        return 'tesserocr' if tesserocr is not None else 'pytesseract'
+    if backend == 'tesserocr' and tesserocr is None:
+        raise RuntimeError("Backend de OCR 'tesserocr' selecionado, mas o pacote tesserocr não está instalado.")
+    if backend not in _BACKENDS:
+        raise ValueError(f"Backend de OCR desconhecido: {backend}")
+    return backend
+
+# Função para obter o pool de threads compartilhado pelas chamadas de OCR
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Cada página já ocupa um núcleo; evitar que o Tesseract abra threads OpenMP adicionais
+            os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+            _executor = ThreadPoolExecutor(max_workers=OCR_WORKERS, thread_name_prefix='ocr')
+        return _executor
+
+# OCR via executável do Tesseract (fallback)
+def _ocr_pytesseract(image, lang, psm=None):
+    return str(image_to_string(image, lang=lang, config=f'--psm {psm}' if psm is not None else ''))
+
+# Função para obter a API do Tesseract da thread atual (carregada uma vez por thread e idioma)
+def _tesserocr_api(lang):
+    api = getattr(_local, 'api', None)
+    if api is None or _local.lang != lang:
+        if api is not None:
+            api.End()
+        api = tesserocr.PyTessBaseAPI(lang=lang)
+        _local.api = api
+        _local.lang = lang
+    return api
+
+# OCR via API do Tesseract carregada uma vez por thread
+def _ocr_tesserocr(image, lang, psm=None):
+    api = _tesserocr_api(lang)
+    api.SetPageSegMode(tesserocr.PSM.AUTO if psm is None else psm)
+    api.SetImage(image)
+    return api.GetUTF8Text()
+
+_BACKENDS = {
+    'pytesseract': _ocr_pytesseract,
+    'tesserocr': _ocr_tesserocr,
+}
+
+# Função para registrar um backend de OCR com um nome próprio, selecionável em configure e nas
+# funções de OCR (ex: o OCR simulado do benchmark). ocr_function(imagem, idioma, psm=None) retorna
+# o texto; as palavras com caixas (ocr_words) continuam vindo do executável do Tesseract
+def register_backend(name, ocr_function):
+    if name in ('auto', 'pytesseract', 'tesserocr'):
+        raise ValueError(f"Backend de OCR já existente: {name}")
+    _BACKENDS[name] = ocr_function
+
+# Função para preparar a imagem entregue ao Tesseract
+# Arrays RGB (páginas já decodificadas) viram uma imagem em tons de cinza, que o Tesseract
+# usaria de qualquer forma; arrays já em tons de cinza (pré-processados) e bytes codificados
+# ainda são aceitos
+def _to_ocr_image(image):
+    if isinstance(image, np.ndarray):
+        return Image.fromarray(image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2GRAY))
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return Image.open(BytesIO(image))
+    return image
+
+# Função para realizar o OCR de uma página e medir sua latência (pré-processamento incluído)
+# A página passa pelo pré-processamento e cada recorte (bloco de texto ou página sem margens) é
+# lido com o seu modo de segmentação; psm força o modo (ex: regiões pequenas de um layout)
+def _ocr_page(ocr_function, image, lang, steps=None, psm=None):
+    started = time.perf_counter()
+    with stage("ocr", paginas=1) as record:
+        image = as_array(image)
+        with stage("preprocessamento", bytes_entrada=image.nbytes) as preprocess_record:
+            regions = preprocess_page(image, steps)
+            preprocess_record.add(regioes=len(regions))
+        texts = [ocr_function(_to_ocr_image(region), lang, psm or region_psm) for region, region_psm in regions]
+        text = "\n".join(texts)
+        record.add(bytes_entrada=image.nbytes, caracteres=len(text))
+    return text, time.perf_counter() - started
+
+# Função para realizar o OCR de várias páginas em paralelo, preservando a ordem
+# Aceita qualquer iterável (ex: um gerador de páginas renderizadas) e mantém no máximo
+# OCR_WORKERS + 1 páginas em memória ao mesmo tempo
+# steps escolhe as etapas do pré-processamento (padrão: OFM_PREPROCESS) e psm força o modo de segmentação
+# on_page(páginas concluídas) é chamada na thread de quem chamou, a cada página concluída
+# Retorna os textos e a latência de cada página em segundos
+def ocr_pages(images, lang, backend=None, steps=None, psm=None, on_page=None):
+    ocr_function = _BACKENDS[resolve_backend(backend)]
+    results = []
+
+    def collect(result):
+        results.append(result)
+        if on_page is not None:
+            on_page(len(results))
+
+    if OCR_WORKERS <= 1:
+        for image in images:
+            collect(_ocr_page(ocr_function, image, lang, steps, psm))
+    else:
+        executor = _get_executor()
+        in_flight = deque()
+        try:
+            for image in images:
+                # As páginas são medidas no contexto de quem chamou (ex: detalhamento do documento)
+                in_flight.append(executor.submit(contextvars.copy_context().run, _ocr_page, ocr_function, image, lang, steps, psm))
+                if len(in_flight) > OCR_WORKERS:
+                    collect(in_flight.popleft().result())
+            while in_flight:
+                collect(in_flight.popleft().result())
+        finally:
+            # Interrompido (ex: trabalho cancelado): páginas ainda não iniciadas são descartadas
+            for future in in_flight:
+                future.cancel()
+    texts = [text for text, _ in results]
+    latencies = [latency for _, latency in results]
+    return texts, latencies
+
+# Função para realizar o OCR de uma página retornando as palavras e suas caixas em pixels
+# [(texto, x0, y0, x1, y1)]; usada para localizar os campos de um layout (ver layout_memory)
+def ocr_words(image, lang, backend=None):
+    backend = resolve_backend(backend)
+    image = _to_ocr_image(image)
+    if backend == 'tesserocr':
+        api = _tesserocr_api(lang)
+        # A API da thread guarda o modo de segmentação da última página (ex: o dos recortes do OCR zonal)
+        api.SetPageSegMode(tesserocr.PSM.AUTO)
+        api.SetImage(image)
+        api.Recognize()
+        level = tesserocr.RIL.WORD
+        words = []
+        for word in tesserocr.iterate_level(api.GetIterator(), level):
+            text = word.GetUTF8Text(level)
+            box = word.BoundingBox(level)
+            if text and text.strip() and box:
+                words.append((text.strip(), *box))
+        return words
+    data = pytesseract.image_to_data(image, lang=lang, output_type=pytesseract.Output.DICT)
+    return [
+        (text.strip(), left, top, left + width, top + height)
+        for text, left, top, width, height in zip(data["text"], data["left"], data["top"], data["width"], data["height"])
+        if text and text.strip()
+    ]
@@ -0,0 +1,92 @@
+import os
+import re
+
+# Classificação das páginas pela relevância para a extração. O texto de cada página (camada de
+# texto ou OCR) é pontuado por sinais de NFS-e, para que o modelo receba as imagens das páginas
+# certas (e não uma carta de apresentação na página 1), e as páginas são agrupadas por nota
+# fiscal quando o documento traz mais de uma
+
+# Máximo de páginas enviadas ao modelo como imagem em cada chamada
+PAGE_TOP_K = int(os.getenv('OFM_PAGE_TOP_K', '2'))
+# Pontuação mínima, relativa à melhor página, para uma página adicional entrar na imagem
+PAGE_MIN_RELATIVE_SCORE = float(os.getenv('OFM_PAGE_MIN_RELATIVE_SCORE', '0.5'))
+# Máximo de notas fiscais extraídas separadamente de um documento (uma chamada ao modelo por nota)
+MAX_INVOICES = int(os.getenv('OFM_MAX_INVOICES', '10'))
+
+# Sinais de nota fiscal: (expressão, peso por ocorrência, máximo de ocorrências contadas)
+PAGE_SIGNALS = (
+    (re.compile(r'\bnota\s+fiscal\b|\bnfs-?e\b', re.IGNORECASE), 4, 1),
+    (re.compile(r'\b\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2}\b'), 3, 2),
+    (re.compile(r'\brps\b\D{0,20}\d+', re.IGNORECASE), 2, 1),
+    (re.compile(r'valor\s+(?:total|l[íi]quido|da\s+nota|dos\s+servi[çc]os)|total\s+da\s+nota', re.IGNORECASE), 3, 1),
+    (re.compile(r'R\$\s*\d|\b\d{1,3}(?:\.\d{3})*,\d{2}\b'), 1, 5),
+    (re.compile(r'data\s+(?:e\s+hora\s+)?(?:de\s+|da\s+)?emiss[ãa]o|emitida\s+em', re.IGNORECASE), 1, 1),
+    (re.compile(r'\bprestador\b', re.IGNORECASE), 1, 1),
+    (re.compile(r'\btomador\b', re.IGNORECASE), 1, 1),
+    (re.compile(r'c[óo]digo\s+de\s+verifica[çc][ãa]o', re.IGNORECASE), 1, 1),
+)
+
+# Número da nota no cabeçalho (ex: "Número da Nota: 4567", "Nº NFS-e 000123")
+INVOICE_NUMBER = re.compile(
+    r'(?:n[úu]mero|n[º°o]\.?)\s*(?:da\s+)?(?:nota(?:\s+fiscal)?|nfs-?e)\b\D{0,20}?(\d{1,15})\b',
+    re.IGNORECASE,
+)
+
+# Função para pontuar o texto de uma página pelos sinais de nota fiscal
+def score_page(text):
+    score = 0
+    for pattern, weight, max_count in PAGE_SIGNALS:
+        count = 0
+        for _ in pattern.finditer(text):
+            count += 1
+            if count == max_count:
+                break
+        score += weight * count
+    return score
+
+# Função para encontrar o número da nota fiscal em uma página (None se não houver)
+def find_invoice_number(text):
+    match = INVOICE_NUMBER.search(text)
+    return (match.group(1).lstrip('0') or '0') if match else None
+
+# Função para escolher as páginas enviadas como imagem: as top_k de maior pontuação, desde que
+# próximas da melhor, na ordem do documento
+def select_pages(page_indices, scores, top_k=None):
+    top_k = top_k or PAGE_TOP_K
+    ranked = sorted(page_indices, key=lambda i: (-scores[i], i))
+    best = scores[ranked[0]]
+    selected = [i for i in ranked[:top_k] if scores[i] >= best * PAGE_MIN_RELATIVE_SCORE]
+    return sorted(selected)
+
+# Função para agrupar as páginas relevantes por nota fiscal
+# Uma página com número de nota diferente do grupo atual abre um novo grupo; páginas sem número
+# (continuação da lista de serviços, por exemplo) ficam no grupo atual. Páginas sem nenhum sinal
+# são descartadas, e se nenhuma página tiver sinal o documento inteiro forma um único grupo
+def group_pages(page_texts, scores):
+    groups = []
+    current_number = None
+    for i, text in enumerate(page_texts):
+        if scores[i] <= 0:
+            continue
+        number = find_invoice_number(text)
+        if not groups or (number is not None and current_number is not None and number != current_number):
+            if len(groups) == MAX_INVOICES:
+                # Notas excedentes seguem junto com a última
+                groups[-1].append(i)
+                continue
+            groups.append([i])
+        else:
+            groups[-1].append(i)
+        if number is not None:
+            current_number = number
+    return groups or [list(range(len(page_texts)))]
+
+# Função para classificar as páginas de um documento
+# Retorna a pontuação de cada página e as partes a extrair: [{"pages", "image_pages"}]
+def rank_document_pages(page_texts, top_k=None):
+    scores = [score_page(text) for text in page_texts]
+    parts = [
+        {"pages": group, "image_pages": select_pages(group, scores, top_k)}
+        for group in group_pages(page_texts, scores)
+    ]
+    return scores, parts
@@ -0,0 +1,149 @@
+import logging
+import math
+import os
+
+import cv2
+
+from images import as_array, combine_images, encode_jpeg, invert_image_color, stack_images
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# Montagem da imagem enviada ao modelo de visão dentro de um orçamento de pixels e de bytes.
+# O modelo reduz a imagem de qualquer forma (o Llama 3.2 Vision trabalha com até 4 blocos de
+# 560x560), então enviar a página em 300 DPI só aumenta o upload e a latência
+
+# Disposição da página e da cópia com cores invertidas: lado_a_lado, empilhado ou original (sem cópia)
+PAYLOAD_LAYOUTS = ("lado_a_lado", "empilhado", "original")
+PAYLOAD_LAYOUT = os.getenv('OFM_PAYLOAD_LAYOUT', 'lado_a_lado')
+# Máximo de pixels da imagem final
+PAYLOAD_MAX_PIXELS = int(os.getenv('OFM_PAYLOAD_MAX_PIXELS', str(1120 * 1120)))
+# Máximo de bytes do JPEG final (antes da codificação em base64)
+PAYLOAD_MAX_BYTES = int(os.getenv('OFM_PAYLOAD_MAX_BYTES', '400000'))
+PAYLOAD_GRAYSCALE = os.getenv('OFM_PAYLOAD_GRAYSCALE', '0') == '1'
+
+# Faixa de qualidade JPEG percorrida na busca binária
+PAYLOAD_MAX_QUALITY = 90
+PAYLOAD_MIN_QUALITY = 40
+# Reduções adicionais de resolução quando nem a qualidade mínima cabe no orçamento de bytes
+PAYLOAD_MAX_DOWNSCALES = 5
+
+# Função para alterar a configuração do payload (ex: a partir dos argumentos do modo em lote)
+def configure(layout=None, max_pixels=None, max_bytes=None, grayscale=None):
+    global PAYLOAD_LAYOUT, PAYLOAD_MAX_PIXELS, PAYLOAD_MAX_BYTES, PAYLOAD_GRAYSCALE
+    if layout is not None:
+        PAYLOAD_LAYOUT = layout
+    if max_pixels is not None:
+        PAYLOAD_MAX_PIXELS = max_pixels
+    if max_bytes is not None:
+        PAYLOAD_MAX_BYTES = max_bytes
+    if grayscale is not None:
+        PAYLOAD_GRAYSCALE = grayscale
+
+# Função para obter a configuração atual (faz parte da chave do cache da imagem)
+def payload_settings():
+    return (PAYLOAD_LAYOUT, PAYLOAD_MAX_PIXELS, PAYLOAD_MAX_BYTES, PAYLOAD_GRAYSCALE)
+
+# Função para reduzir a imagem por área (INTER_AREA preserva o texto melhor que interpolação simples)
+def _downscale(image, scale):
+    width = max(1, int(image.shape[1] * scale))
+    height = max(1, int(image.shape[0] * scale))
+    return cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA)
+
+# Função para obter o número de blocos por página na disposição escolhida (página e cópia invertida)
+def _tiles_per_page(layout):
+    return 1 if layout == "original" else 2
+
+# Função para calcular o máximo de pixels de cada página quando várias páginas dividem a imagem
+# (usada para renderizar as páginas do PDF direto no tamanho final)
+def page_pixel_budget(page_count, layout=None, max_pixels=None):
+    layout = layout or PAYLOAD_LAYOUT
+    max_pixels = max_pixels or PAYLOAD_MAX_PIXELS
+    return max_pixels // (page_count * _tiles_per_page(layout))
+
+# Função para montar o bloco de uma página conforme a disposição escolhida
+def _compose_page(page, layout):
+    if layout == "lado_a_lado":
+        return combine_images(page, invert_image_color(page))
+    if layout == "empilhado":
+        return stack_images(page, invert_image_color(page))
+    return page
+
+# Função para montar a imagem final a partir das páginas
+# As páginas seguem no eixo oposto ao da cópia invertida, para manter a imagem próxima de um quadrado
+def _compose(pages, layout):
+    join = stack_images if layout == "lado_a_lado" else combine_images
+    with stage("composicao", paginas=len(pages), bytes_entrada=sum(page.nbytes for page in pages)) as record:
+        image = _compose_page(pages[0], layout)
+        for page in pages[1:]:
+            image = join(image, _compose_page(page, layout))
+        record.add(bytes_saida=image.nbytes)
+    return image
+
+# Função para encontrar a maior qualidade JPEG que cabe no orçamento de bytes (busca binária)
+# Retorna None se nem a qualidade mínima couber
+def _encode_within_budget(image, max_bytes):
+    best = None
+    low, high = PAYLOAD_MIN_QUALITY, PAYLOAD_MAX_QUALITY
+    while low <= high:
+        quality = (low + high) // 2
+        encoded = encode_jpeg(image, quality=quality)
+        if len(encoded) <= max_bytes:
+            best = (encoded, quality)
+            low = quality + 1
+        else:
+            high = quality - 1
+    return best
+
+# Função para montar o JPEG enviado ao modelo a partir de uma página ou de uma lista de páginas
+# Retorna os bytes do JPEG e um resumo (dimensões, qualidade, bytes) para registro
+def build_payload(pages, layout=None, max_pixels=None, max_bytes=None, grayscale=None):
+    layout = layout or PAYLOAD_LAYOUT
+    max_pixels = max_pixels or PAYLOAD_MAX_PIXELS
+    max_bytes = max_bytes or PAYLOAD_MAX_BYTES
+    grayscale = PAYLOAD_GRAYSCALE if grayscale is None else grayscale
+    if layout not in PAYLOAD_LAYOUTS:
+        raise ValueError(f"Disposição de payload desconhecida: {layout}")
+
+    if not isinstance(pages, (list, tuple)):
+        pages = [pages]
+    pages = [as_array(page) for page in pages]
+    if grayscale:
+        pages = [cv2.cvtColor(page, cv2.COLOR_RGB2GRAY) if page.ndim == 3 else page for page in pages]
+
+    # Reduzir as páginas antes de compor, para que a imagem final caiba no orçamento de pixels
+    total_pixels = sum(page.shape[0] * page.shape[1] for page in pages) * _tiles_per_page(layout)
+    scale = math.sqrt(max_pixels / total_pixels)
+    if scale < 1:
+        pages = [_downscale(page, scale) for page in pages]
+
+    for _ in range(PAYLOAD_MAX_DOWNSCALES + 1):
+        image = _compose(pages, layout)
+        result = _encode_within_budget(image, max_bytes)
+        if result is not None:
+            break
+        # Nem a qualidade mínima coube: reduzir a resolução proporcionalmente ao excesso
+        smallest = len(encode_jpeg(image, quality=PAYLOAD_MIN_QUALITY))
+        downscale = min(0.9, 0.95 * math.sqrt(max_bytes / smallest))
+        pages = [_downscale(page, downscale) for page in pages]
+    else:
+        # Orçamento inalcançável nas reduções permitidas: enviar a menor versão obtida, composta das
+        # páginas já reduzidas pela última tentativa
+        image = _compose(pages, layout)
+        result = _encode_within_budget(image, max_bytes) or (encode_jpeg(image, quality=PAYLOAD_MIN_QUALITY), PAYLOAD_MIN_QUALITY)
+
+    encoded, quality = result
+    info = {
+        "layout": layout,
+        "pages": len(pages),
+        "width": image.shape[1],
+        "height": image.shape[0],
+        "grayscale": image.ndim == 2,
+        "quality": quality,
+        "bytes": len(encoded),
+    }
+    logger.info(
+        "Payload de imagem: %d página(s), %dx%d (%s%s), qualidade %d, %d bytes",
+        len(pages), info["width"], info["height"], layout, ", tons de cinza" if info["grayscale"] else "", quality, len(encoded),
+    )
+    return encoded, info
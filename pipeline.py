@@ -0,0 +1,735 @@
+import json
+import logging
+import math
+import os
+import time
+
+import cv2
+import pypdfium2 as pdfium
+
+from cache import get_cache, hash_bytes, make_key, pack_blobs, unpack_blobs
+# Operações de imagem (também fazem parte da API do pipeline)
+from images import (
+    as_array,
+    combine_images,
+    decode_image,
+    encode_image,
+    encode_jpeg,
+    invert_image_color,
+)
+from json_stream import JsonArrayStream
+from layout_memory import FINGERPRINT_WIDTH, build_extraction, build_template, get_layout_index, page_hash, token_minhash
+from metrics import record_stage, stage
+from ocr_backends import ocr_pages, ocr_words, resolve_backend
+from page_ranking import rank_document_pages
+from payload import build_payload, page_pixel_budget, payload_settings
+from preprocess import PSM_BLOCK, preprocess_settings
+# Montagem do prompt (também faz parte da API do pipeline)
+from prompt import FIELD_DEFINITIONS, JSON_TEMPLATE, TEMPLATE_FIELDS, build_message_content
+from rule_extractor import RULES_DEFAULTS, RULES_ENABLED, confident_fields, covers_required_fields, pre_extract
+from schema import dumps, extract_json, loads
+from text_layer import TEXT_LAYER_ENABLED, extract_text_in_box, extract_text_layer, extract_words
+
+logger = logging.getLogger(__name__)
+
+# Modelo de visão usado na extração
+LLM_MODEL = "llama-3.2-11b-vision-preview"
+# Receber a resposta do modelo em streaming na interface (campos exibidos à medida que chegam)
+LLM_STREAM = os.getenv('OFM_LLM_STREAM', '1') != '0'
+
+# Parâmetros de renderização e OCR (fazem parte das chaves do cache)
+RENDER_SCALE = 300/72
+OCR_LANG = 'por'
+
+# Largura das miniaturas usadas no seletor de páginas
+THUMBNAIL_WIDTH = 240
+
+# Extensões aceitas pelo pipeline
+PDF_EXTENSIONS = (".pdf",)
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+# Função para renderizar uma página do PDF como array RGB
+# O array é uma visão do bitmap do pdfium, sem cópia nem codificação intermediária
+def render_page(page, scale=RENDER_SCALE):
+    with stage("renderizacao", paginas=1) as record:
+        image = page.render(scale=scale, rev_byteorder=True).to_numpy()
+        record.add(bytes_saida=image.nbytes)
+    return image
+
+# Função para renderizar as páginas do PDF uma por vez como arrays RGB
+def render_pdf_pages(pdf_source, scale=RENDER_SCALE):
+    pdf_file = pdfium.PdfDocument(pdf_source)
+    try:
+        for i in range(len(pdf_file)):
+            page = pdf_file[i]
+            image = render_page(page, scale)
+            page.close()
+            yield i, image
+    finally:
+        pdf_file.close()
+
+# Função para converter PDF em imagens JPEG (sem aplicar inversão de cores)
+# Aceita tanto o caminho do arquivo quanto os bytes do PDF
+def convert_pdf_to_images(pdf_source, scale=RENDER_SCALE):
+    return [{i: encode_jpeg(image, optimize=False)} for i, image in render_pdf_pages(pdf_source, scale)]
+
+# Função para extrair texto usando o Tesseract OCR (usando imagens originais)
+# As páginas são processadas em paralelo pelo backend configurado em ocr_backends
+def extract_text_with_pytesseract(list_dict_final_images, backend=None):
+    image_list = [list(data.values())[0] for data in list_dict_final_images]
+    image_content, _ = ocr_pages(image_list, OCR_LANG, backend)
+    return "\n".join(image_content)
+
+# Função para verificar se um nome de arquivo é um PDF
+def is_pdf_name(file_name):
+    return file_name.lower().endswith(PDF_EXTENSIONS)
+
+# Função para gerar a miniatura JPEG de uma página
+def make_thumbnail(image, width=THUMBNAIL_WIDTH):
+    image = as_array(image)
+    height = max(1, round(image.shape[0] * width / image.shape[1]))
+    return encode_jpeg(cv2.resize(image, (width, height), interpolation=cv2.INTER_AREA), optimize=False)
+
+# Função para renderizar uma única página do PDF em resolução total, sob demanda (visualizador)
+# Abre o PDF direto dos bytes enviados e guarda o JPEG no cache de páginas
+def render_page_preview(file_bytes, page_index, document_hash=None, use_cache=True):
+    pages_cache = get_cache("paginas") if use_cache else None
+    page_key = make_key(document_hash or hash_bytes(file_bytes), "render", RENDER_SCALE, "pagina", page_index)
+    if pages_cache is not None:
+        cached_page = pages_cache.get(page_key)
+        if cached_page is not None:
+            return cached_page
+
+    pdf_file = pdfium.PdfDocument(file_bytes)
+    try:
+        page = pdf_file[page_index]
+        image = render_page(page)
+        page.close()
+    finally:
+        pdf_file.close()
+    # Prévia para a interface, sem a segunda passada de Huffman (optimize) usada no payload do LLM
+    page_bytes = encode_jpeg(image, optimize=False)
+    if pages_cache is not None:
+        pages_cache.set(page_key, page_bytes)
+    return page_bytes
+
+# Função para obter as páginas escolhidas para a imagem enviada ao modelo
+# Páginas de PDF são renderizadas direto no tamanho do orçamento de pixels do payload, sem passar
+# pela resolução do OCR
+def load_payload_pages(file_bytes, is_pdf, page_indices):
+    if not is_pdf:
+        return [decode_image(file_bytes)]
+    max_pixels = page_pixel_budget(len(page_indices))
+    pdf_file = pdfium.PdfDocument(file_bytes)
+    try:
+        pages = []
+        for i in page_indices:
+            page = pdf_file[i]
+            width, height = page.get_size()
+            scale = min(RENDER_SCALE, math.sqrt(max_pixels / (width * height)))
+            pages.append(render_page(page, scale))
+            page.close()
+        return pages
+    finally:
+        pdf_file.close()
+
+# Função para obter o número de páginas de um documento (imagens têm uma página)
+def document_page_count(file_bytes, is_pdf):
+    if not is_pdf:
+        return 1
+    pdf_file = pdfium.PdfDocument(file_bytes)
+    try:
+        return len(pdf_file)
+    finally:
+        pdf_file.close()
+
+# Função para percorrer as páginas de um documento
+# Para cada página retorna (índice, texto da camada de texto ou None, array RGB em resolução
+# total ou None, miniatura JPEG ou None). A página só é renderizada em resolução total quando
+# vai para o OCR
+def iter_document_pages(file_bytes, is_pdf, extract_text=True, use_text_layer=True, thumbnails=False):
+    if not is_pdf:
+        image = decode_image(file_bytes)
+        yield 0, None, image, make_thumbnail(image) if thumbnails else None
+        return
+
+    pdf_file = pdfium.PdfDocument(file_bytes)
+    try:
+        for i in range(len(pdf_file)):
+            page = pdf_file[i]
+            text = extract_text_layer(page) if extract_text and use_text_layer else None
+            image = None
+            if extract_text and text is None:
+                image = render_page(page)
+            thumbnail = None
+            if thumbnails:
+                if image is not None:
+                    thumbnail = make_thumbnail(image)
+                else:
+                    # Página com camada de texto: renderizar direto no tamanho da miniatura
+                    thumbnail_scale = THUMBNAIL_WIDTH / page.get_width()
+                    thumbnail = encode_jpeg(render_page(page, thumbnail_scale), optimize=False)
+            page.close()
+            yield i, text, image, thumbnail
+    finally:
+        pdf_file.close()
+
+# Função para resumir o caminho de extração de texto usado em um documento
+def summarize_text_sources(text_sources):
+    if all(source == "texto" for source in text_sources):
+        return "texto"
+    if all(source == "ocr" for source in text_sources):
+        return "ocr"
+    if all(source == "zonal" for source in text_sources):
+        return "zonal"
+    return "misto"
+
+# Função para calcular a impressão digital de um PDF: hash perceptual da primeira página
+# reduzida e texto da sua camada de texto (None se não houver)
+def _pdf_fingerprint(pdf_file):
+    page = pdf_file[0]
+    try:
+        image = render_page(page, FINGERPRINT_WIDTH / page.get_width())
+        text = extract_text_layer(page) if TEXT_LAYER_ENABLED else None
+    finally:
+        page.close()
+    return page_hash(image), text
+
+# Função para recortar uma região (caixa normalizada) de uma página
+def _crop_region(image, box):
+    height, width = image.shape[:2]
+    x0, y0, x1, y1 = box
+    return image[int(y0 * height):math.ceil(y1 * height), int(x0 * width):math.ceil(x1 * width)]
+
+# Função para reconhecer um documento na memória de layouts e ler só as regiões dos seus campos
+# Páginas com camada de texto têm o texto lido dentro das caixas; nas demais só os recortes das
+# regiões passam pelo OCR. Retorna os valores lidos e as páginas enviadas como imagem ao modelo,
+# que lê o restante da nota, ou None se nenhum modelo corresponder ou se algum campo não puder
+# ser lido (o documento segue então pelo pipeline completo)
+def match_layout(file_bytes, is_pdf, ocr_backend=None):
+    index = get_layout_index()
+    if index is None or not len(index):
+        return None
+    region_texts = {}
+    crops = []
+    crop_fields = []
+    pdf_file = pdfium.PdfDocument(file_bytes) if is_pdf else None
+    try:
+        if is_pdf:
+            page_count = len(pdf_file)
+            phash, first_text = _pdf_fingerprint(pdf_file)
+        else:
+            page_count = 1
+            image = decode_image(file_bytes)
+            phash, first_text = page_hash(image), None
+        started = time.perf_counter()
+        template = index.lookup(phash, token_minhash(first_text))
+        logger.debug("Busca na memória de layouts: %.3f ms", (time.perf_counter() - started) * 1000)
+        if template is None:
+            return None
+
+        boxes_by_page = {}
+        for field, region in template["regioes"].items():
+            boxes_by_page.setdefault(region["pagina"], []).append((field, region["caixa"]))
+        if max(boxes_by_page) >= page_count:
+            index.record_use(template["id"], False)
+            return None
+        for page_index, boxes in sorted(boxes_by_page.items()):
+            if is_pdf:
+                page = pdf_file[page_index]
+                try:
+                    has_text = first_text is not None if page_index == 0 else TEXT_LAYER_ENABLED and extract_text_layer(page) is not None
+                    if has_text:
+                        for field, box in boxes:
+                            region_texts[field] = extract_text_in_box(page, box)
+                        continue
+                    image = render_page(page)
+                finally:
+                    page.close()
+            for field, box in boxes:
+                crops.append(_crop_region(image, box))
+                crop_fields.append(field)
+    finally:
+        if pdf_file is not None:
+            pdf_file.close()
+
+    ocr_latencies = []
+    if crops:
+        # Recortes pequenos: sem correção de inclinação nem detecção de blocos, lidos como um bloco de texto
+        ocr_texts, ocr_latencies = ocr_pages(crops, OCR_LANG, ocr_backend, steps=("cinza", "binarizacao"), psm=PSM_BLOCK)
+        region_texts.update(zip(crop_fields, ocr_texts))
+    extraction = build_extraction(template, region_texts)
+    index.record_use(template["id"], extraction is not None)
+    if extraction is None:
+        return None
+    logger.info("Layout memorizado %s: %d campo(s) lido(s) nas regiões", template["id"], len(region_texts))
+    # Texto do documento: o lido nas regiões, por página
+    page_texts = [""] * page_count
+    for field, region in template["regioes"].items():
+        page_texts[region["pagina"]] += region_texts[field].strip() + "\n"
+    # Páginas da imagem: as da nota corrigida (modelos antigos: as duas primeiras)
+    image_pages = [i for i in template.get("paginas_imagem", range(2)) if i < page_count]
+    return {
+        "modelo": template["id"],
+        "dados": extraction,
+        "campos": sorted(region_texts),
+        "page_texts": page_texts,
+        "image_pages": image_pages,
+        "ocr_latencies": ocr_latencies,
+    }
+
+# Função para obter as palavras de uma página de PDF com caixas normalizadas (camada de texto ou OCR)
+def _page_words(page, ocr_backend=None):
+    if TEXT_LAYER_ENABLED and extract_text_layer(page) is not None:
+        return extract_words(page)
+    return _image_words(render_page(page), ocr_backend)
+
+# Função para obter as palavras de uma imagem pelo OCR, com as caixas normalizadas
+def _image_words(image, ocr_backend=None):
+    height, width = image.shape[:2]
+    return [
+        (text, x0 / width, y0 / height, x1 / width, y1 / height)
+        for text, x0, y0, x1, y1 in ocr_words(image, OCR_LANG, ocr_backend)
+    ]
+
+# Função para memorizar o layout de um documento a partir do JSON corrigido pelo usuário
+# Os valores dos campos são localizados nas palavras da primeira página e das páginas da imagem
+# da primeira nota; um modelo existente para o mesmo layout é substituído. Documentos com mais
+# de uma nota não são memorizados. Retorna o id do modelo ou None
+def remember_layout(file_bytes, is_pdf, prepared, corrected_json):
+    index = get_layout_index()
+    invoices = corrected_json if isinstance(corrected_json, list) else [corrected_json]
+    if index is None or len(invoices) != 1 or not isinstance(invoices[0], dict):
+        return None
+    parts = prepared["parts"]
+    page_indices = sorted({0, *(parts[0]["image_pages"] if parts else range(min(prepared["page_count"], 2)))})
+    words_by_page = {}
+    if is_pdf:
+        pdf_file = pdfium.PdfDocument(file_bytes)
+        try:
+            phash, first_text = _pdf_fingerprint(pdf_file)
+            for page_index in page_indices:
+                page = pdf_file[page_index]
+                try:
+                    words_by_page[page_index] = _page_words(page)
+                finally:
+                    page.close()
+        finally:
+            pdf_file.close()
+    else:
+        image = decode_image(file_bytes)
+        phash, first_text = page_hash(image), None
+        words_by_page[0] = _image_words(image)
+    # Sem camada de texto o MinHash vem das palavras do OCR da primeira página
+    minhash = token_minhash(first_text if first_text is not None else " ".join(word[0] for word in words_by_page[0]))
+    template = build_template(phash, minhash, words_by_page, invoices[0])
+    if template is None:
+        return None
+    existing = index.lookup(phash, minhash)
+    index.add(template, replace_id=existing["id"] if existing is not None else None)
+    logger.info(
+        "Layout %s memorizado: regiões de %s", template["id"], ", ".join(sorted(template["regioes"])),
+    )
+    return template["id"]
+
+# Função para preparar um documento: renderização, OCR, classificação das páginas e imagens para o LLM
+# Cada etapa é consultada no cache em disco antes de ser executada. Páginas de PDFs com camada
+# de texto utilizável têm o texto extraído diretamente, sem OCR. As demais são renderizadas
+# uma por vez e entregues ao OCR à medida que ficam prontas, e delas só a miniatura é mantida.
+# As páginas são pontuadas pelos sinais de nota fiscal e agrupadas por nota; cada grupo (parte)
+# recebe uma imagem com as suas páginas mais relevantes. O visualizador renderiza a página
+# selecionada sob demanda com render_page_preview. Documentos de um layout memorizado (ver
+# match_layout) têm só as regiões dos campos lidas, sem OCR completo nem classificação: uma única
+# parte, com os valores das regiões como campos conhecidos e a imagem das páginas memorizadas.
+# As regras são aplicadas ao texto de cada parte; com allow_bypass, as partes em que elas cobrem
+# todos os campos obrigatórios dispensam o modelo e não têm a imagem montada (payload None).
+# progress(etapa, concluídos, total) é chamada ao longo da preparação (ex: fila de trabalhos)
+def prepare_document(file_bytes, is_pdf, use_cache=True, keep_previews=True, use_layouts=True, allow_bypass=True, progress=None):
+    def report(stage, done=0, total=None):
+        if progress is not None:
+            progress(stage, done, total)
+
+    document_hash = hash_bytes(file_bytes)
+    render_key = make_key(document_hash, "render", RENDER_SCALE if is_pdf else "original")
+    pages_cache = get_cache("paginas") if use_cache else None
+    ocr_cache = get_cache("ocr") if use_cache else None
+
+    # Miniaturas das páginas gravadas no cache
+    thumbnails = None
+    thumbnails_key = make_key(render_key, "miniaturas", THUMBNAIL_WIDTH)
+    if keep_previews and pages_cache is not None:
+        cached_thumbnails = pages_cache.get(thumbnails_key)
+        if cached_thumbnails is not None:
+            thumbnails = unpack_blobs(cached_thumbnails)
+    build_previews = keep_previews and thumbnails is None
+
+    # Texto por página e sua origem ("texto" para a camada de texto do PDF, "ocr" para o Tesseract)
+    ocr_backend = resolve_backend()
+    use_text_layer = is_pdf and TEXT_LAYER_ENABLED
+    ocr_key = make_key(
+        render_key, "ocr", OCR_LANG, ocr_backend, "camada-texto" if use_text_layer else "", preprocess_settings(),
+    )
+    page_texts = None
+    text_sources = None
+    cached_texts = ocr_cache.get_text(ocr_key) if ocr_cache is not None else None
+    if cached_texts is not None:
+        cached_texts = json.loads(cached_texts)
+        page_texts = cached_texts["textos"]
+        text_sources = cached_texts["fontes"]
+    ocr_latencies = []
+
+    # Layout memorizado: os campos das regiões são lidos sem OCR completo
+    layout = None
+    if page_texts is None and use_layouts:
+        report("layout")
+        with stage("layout", bytes_entrada=len(file_bytes)):
+            layout = match_layout(file_bytes, is_pdf, ocr_backend)
+    if layout is not None:
+        page_texts = layout.pop("page_texts")
+        text_sources = ["zonal"] * len(page_texts)
+        ocr_latencies = layout.pop("ocr_latencies")
+
+    # Imagem enviada já decodificada durante o OCR (documentos que não são PDF)
+    decoded_image = []
+    if page_texts is None or build_previews:
+        extract_text = page_texts is None
+        previews = []
+        layer_texts = {}
+        ocr_indices = []
+        page_total = document_page_count(file_bytes, is_pdf)
+        ocr_done = [0]
+
+        # Páginas com texto pronto: as da camada de texto e as que já passaram pelo OCR
+        def page_done(done=None):
+            if done is not None:
+                ocr_done[0] = done
+            if extract_text:
+                report("paginas", len(layer_texts) + ocr_done[0], page_total)
+            else:
+                report("miniaturas", len(previews), page_total)
+
+        page_done()
+
+        # Gerador que entrega ao OCR apenas as páginas sem camada de texto utilizável, à medida que
+        # são renderizadas, guardando somente as miniaturas
+        def pages_for_ocr():
+            for i, text, image, thumbnail in iter_document_pages(file_bytes, is_pdf, extract_text, use_text_layer, build_previews):
+                if not is_pdf:
+                    # Imagem enviada: reaproveitada na imagem do modelo sem nova decodificação
+                    decoded_image.append(image)
+                if thumbnail is not None:
+                    previews.append(thumbnail)
+                if not extract_text:
+                    page_done()
+                    continue
+                if text is not None:
+                    layer_texts[i] = text
+                    page_done()
+                else:
+                    ocr_indices.append(i)
+                    yield image
+
+        if extract_text:
+            ocr_texts, ocr_latencies = ocr_pages(pages_for_ocr(), OCR_LANG, ocr_backend, on_page=page_done)
+            texts_by_page = dict(layer_texts)
+            texts_by_page.update(zip(ocr_indices, ocr_texts))
+            page_texts = [texts_by_page[i] for i in range(len(texts_by_page))]
+            text_sources = ["texto" if i in layer_texts else "ocr" for i in range(len(texts_by_page))]
+            if ocr_cache is not None:
+                ocr_cache.set_text(ocr_key, json.dumps({"textos": page_texts, "fontes": text_sources}, ensure_ascii=False))
+        else:
+            for _ in pages_for_ocr():
+                pass
+
+        if build_previews:
+            thumbnails = previews
+            if pages_cache is not None:
+                pages_cache.set(thumbnails_key, pack_blobs(previews))
+
+    # Páginas enviadas ao modelo: as mais relevantes de cada nota fiscal encontrada no documento
+    if layout is not None:
+        page_scores = [0] * len(page_texts)
+        parts = [{"pages": list(range(len(page_texts))), "image_pages": layout.pop("image_pages")}]
+    else:
+        page_scores, parts = rank_document_pages(page_texts)
+    for part_index, part in enumerate(parts):
+        # Campos obtidos pelas regras no texto das páginas da parte (ou lidos nas regiões do layout
+        # memorizado); os confiáveis (known) não são pedidos ao modelo
+        if layout is not None:
+            part["fields"] = {field: (value, 1.0) for field, value in layout["dados"].items()}
+        else:
+            part["fields"] = pre_extract([page_texts[i] for i in part["pages"]]) if RULES_ENABLED else {}
+        part["known"] = confident_fields(part["fields"])
+        if allow_bypass and covers_required_fields(part["known"]):
+            # Modelo dispensado: a imagem não é montada
+            part["payload"] = None
+            part["base64_combined_image"] = None
+            continue
+        report("imagem", part_index, len(parts))
+        # Imagem da parte (páginas e cópias invertidas dentro do orçamento de pixels e bytes)
+        payload_key = make_key(render_key, "payload", part["image_pages"], *payload_settings())
+        cached_payload = pages_cache.get(payload_key) if pages_cache is not None else None
+        if cached_payload is not None:
+            payload_info, payload_bytes = unpack_blobs(cached_payload)
+            payload_info = json.loads(payload_info)
+        else:
+            payload_pages = decoded_image if not is_pdf and decoded_image else load_payload_pages(file_bytes, is_pdf, part["image_pages"])
+            with stage("payload", paginas=len(payload_pages)) as record:
+                payload_bytes, payload_info = build_payload(payload_pages)
+                record.add(bytes_saida=len(payload_bytes))
+            if pages_cache is not None:
+                pages_cache.set(payload_key, pack_blobs([json.dumps(payload_info).encode('utf-8'), payload_bytes]))
+        part["payload"] = payload_info
+        part["base64_combined_image"] = encode_image(payload_bytes)
+
+    return {
+        "document_hash": document_hash,
+        "thumbnails": thumbnails,
+        "page_count": len(page_texts),
+        "page_texts": page_texts,
+        "ocr_text": "\n".join(page_texts),
+        # Origem do texto por página e resumo do documento (texto, ocr ou misto)
+        "text_sources": text_sources,
+        "text_path": summarize_text_sources(text_sources),
+        # Latência do OCR por página processada (vazia quando o texto veio do cache)
+        "ocr_backend": ocr_backend,
+        "ocr_latencies": ocr_latencies,
+        # Pontuação de cada página e partes extraídas (uma por nota fiscal), com as páginas do
+        # texto, as páginas da imagem, os campos das regras, o resumo da imagem e a imagem em base64
+        # (None nas partes em que o modelo foi dispensado)
+        "page_scores": page_scores,
+        "parts": parts,
+        # Layout memorizado reconhecido: {"modelo", "dados", "campos"} ou None
+        "layout": layout,
+    }
+
+# Função para planejar a extração de um documento preparado: uma entrada por parte (nota fiscal)
+# Os campos das regras (calculados na preparação) não são pedidos ao modelo, e a mensagem (texto da
+# parte e imagem das suas páginas mais relevantes) fica None nas partes em que o modelo foi
+# dispensado na preparação (para chamar o modelo, o documento deve ser preparado de novo com
+# allow_bypass=False)
+def plan_document_extraction(prepared):
+    plans = []
+    for part in prepared["parts"]:
+        fields, known = part["fields"], part["known"]
+        if part["base64_combined_image"] is None:
+            message_content = None
+        else:
+            texts = [prepared["page_texts"][i] for i in part["pages"]]
+            message_content = build_message_content(texts, part["base64_combined_image"], skip_fields=tuple(known))
+        logger.info(
+            "Regras: %d campo(s) confiável(is) de %d encontrado(s)%s",
+            len(known), len(fields), "; modelo dispensado" if message_content is None else "",
+        )
+        plans.append({"fields": fields, "known": known, "message_content": message_content})
+    return plans
+
+# Função para incluir os campos obtidos pelas regras na primeira nota da extração, na ordem da estrutura
+def fill_known_fields(extraction, known):
+    if not known:
+        return extraction
+    invoices = extraction if isinstance(extraction, list) else [extraction]
+    if not invoices or not isinstance(invoices[0], dict):
+        invoices = [{}] + list(invoices)
+    first = invoices[0]
+    ordered = {field: known[field] if field in known else first[field] for field in TEMPLATE_FIELDS if field in known or field in first}
+    # Campos fora da estrutura devolvidos pelo modelo são mantidos no final
+    for field, value in first.items():
+        ordered.setdefault(field, value)
+    return [ordered] + invoices[1:]
+
+# Função para montar a extração de uma parte em que o modelo foi dispensado: a estrutura com os
+# campos das regras, os valores padrão dos obrigatórios que elas não leem (RULES_DEFAULTS) e os
+# demais vazios (listas sem itens)
+def rules_only_extraction(known):
+    invoice = json.loads(JSON_TEMPLATE)[0]
+    for field, value in invoice.items():
+        if isinstance(value, list):
+            invoice[field] = []
+    return fill_known_fields([invoice], {**RULES_DEFAULTS, **known})
+
+# Função para montar os parâmetros da chamada de completion (compartilhados pelo cliente síncrono e pelo agendador)
+def completion_params(message_content, stream=False):
+    return {
+        "model": LLM_MODEL,
+        "messages": [
+            {
+                "role": "user",
+                "content": message_content
+            }
+        ],
+        "temperature": 0,  # Definir como 0 para saída determinística
+        "max_tokens": 8000,  # Ajuste conforme necessário
+        "top_p": 1,
+        "stream": stream,
+        "stop": None,
+    }
+
+# Função para obter os valores de uso de uma chamada ao modelo para a etapa "modelo": tokens e, quando a
+# API informa os tempos (Groq: queue_time e total_time), a espera na fila e o processamento do modelo.
+# O restante do tempo medido no cliente é registrado como a etapa "rede"
+def llm_usage_values(usage, wall):
+    if usage is None:
+        return {}
+    values = {"tokens_prompt": usage.prompt_tokens, "tokens_resposta": usage.completion_tokens}
+    model_time = getattr(usage, "total_time", None)
+    if model_time is not None:
+        queue_time = getattr(usage, "queue_time", None) or 0.0
+        network_time = max(0.0, wall - model_time - queue_time)
+        values.update(tempo_modelo=model_time, tempo_fila=queue_time, tempo_rede=round(network_time, 6))
+        record_stage("rede", network_time)
+    return values
+
+# Função para registrar o tamanho da requisição (para comparar custo e precisão entre configurações)
+def log_request_size(message_content):
+    text_chars = sum(len(part["text"]) for part in message_content if part["type"] == "text")
+    image_chars = sum(len(part["image_url"]["url"]) for part in message_content if part["type"] == "image_url")
+    logger.info("Requisição ao LLM: %d caracteres de texto, %d bytes de imagem em base64", text_chars, image_chars)
+
+# Função para chamar a API Groq e obter a resposta bruta do modelo
+def request_completion(client, message_content):
+    log_request_size(message_content)
+    with stage("modelo") as record:
+        started = time.perf_counter()
+        completion = client.chat.completions.create(**completion_params(message_content))
+        record.add(**llm_usage_values(completion.usage, time.perf_counter() - started))
+    return completion.choices[0].message.content
+
+# Função para chamar a API Groq em modo streaming, interpretando o JSON à medida que chega
+# on_field(índice do objeto, nome, valor) é chamada para cada campo de primeiro nível concluído.
+# A conexão é encerrada no colchete de fechamento do array, então o texto que o modelo
+# escreveria depois dele não é gerado. Retorna o texto do JSON e as métricas de tempo
+def stream_completion(client, message_content, on_field=None):
+    log_request_size(message_content)
+    started = time.perf_counter()
+    parser = JsonArrayStream()
+    metrics = {"tempo_primeiro_token": None, "tempo_primeiro_campo": None, "campos": 0, "encerrado_no_fim_do_json": False}
+    # Uso de tokens: a Groq o informa em x_groq.usage no último evento, que só chega se a resposta
+    # não for encerrada antes no fim do JSON
+    usage = None
+    with stage("modelo") as record:
+        stream = client.chat.completions.create(**completion_params(message_content, stream=True))
+        try:
+            for chunk in stream:
+                x_groq = getattr(chunk, "x_groq", None)
+                if x_groq is not None and getattr(x_groq, "usage", None) is not None:
+                    usage = x_groq.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if not delta:
+                    continue
+                if metrics["tempo_primeiro_token"] is None:
+                    metrics["tempo_primeiro_token"] = round(time.perf_counter() - started, 3)
+                for index, key, value in parser.feed(delta):
+                    if metrics["tempo_primeiro_campo"] is None:
+                        metrics["tempo_primeiro_campo"] = round(time.perf_counter() - started, 3)
+                    metrics["campos"] += 1
+                    if on_field is not None:
+                        on_field(index, key, value)
+                if parser.done:
+                    metrics["encerrado_no_fim_do_json"] = True
+                    break
+        finally:
+            stream.close()
+        metrics["tempo_total"] = round(time.perf_counter() - started, 3)
+        record.add(tempo_primeiro_token=metrics["tempo_primeiro_token"], **llm_usage_values(usage, metrics["tempo_total"]))
+    logger.info(
+        "Streaming do LLM: primeiro campo em %ss, %d campos em %.2fs%s",
+        metrics["tempo_primeiro_campo"], metrics["campos"], metrics["tempo_total"],
+        " (encerrado no fim do JSON)" if metrics["encerrado_no_fim_do_json"] else "",
+    )
+    # Sem colchete de abertura o modelo não respondeu no formato pedido: aplicar a mesma extração do modo sem streaming
+    json_text = parser.json_text() if parser.start is not None else extract_json_text(parser.text)
+    return json_text, metrics
+
+# Função para extrair apenas o JSON da resposta (lista de notas localizada pelo esquema, em uma única passada)
+# Texto antes ou depois do JSON, inclusive com colchetes, é descartado
+def extract_json_text(raw_response):
+    return extract_json(raw_response)
+
+# Função para obter o JSON (já formatado) gravado no cache para uma mensagem
+def load_cached_json(message_content):
+    llm_cache = get_cache("llm")
+    if llm_cache is None:
+        return None
+    return llm_cache.get_text(make_key(LLM_MODEL, json.dumps(message_content, ensure_ascii=False)))
+
+# Função para gravar no cache o JSON gerado para uma mensagem
+def store_cached_json(message_content, pretty_json):
+    llm_cache = get_cache("llm")
+    if llm_cache is not None:
+        llm_cache.set_text(make_key(LLM_MODEL, json.dumps(message_content, ensure_ascii=False)), pretty_json)
+
+# Função para verificar se um item de lista veio vazio (o modelo às vezes repete o item do modelo de JSON)
+def _is_empty_item(item):
+    return isinstance(item, dict) and all(value in ("", 0, 0.0, None, []) for value in item.values())
+
+# Função para juntar as extrações das partes de um documento (etapa de redução)
+# Partes com o mesmo numeroNota (ou sem número, continuação da anterior) formam uma só nota:
+# os campos vazios são preenchidos e as listas de Servicos, CodigoReceita, ImpostosRetido e
+# Titulos são concatenadas sem repetir itens. Notas com números diferentes ficam separadas
+def merge_extractions(extractions):
+    if len(extractions) == 1:
+        return extractions[0]
+    merged = []
+    by_number = {}
+    for extraction in extractions:
+        for invoice in extraction if isinstance(extraction, list) else [extraction]:
+            if not isinstance(invoice, dict):
+                continue
+            number = str(invoice.get("numeroNota") or "").strip()
+            target = by_number.get(number) if number else (merged[-1] if merged else None)
+            if target is None:
+                target = {}
+                merged.append(target)
+            if number:
+                by_number.setdefault(number, target)
+            for key, value in invoice.items():
+                if isinstance(value, list):
+                    items = target.setdefault(key, [])
+                    seen = {json.dumps(item, sort_keys=True, ensure_ascii=False, default=str) for item in items}
+                    for item in value:
+                        item_key = json.dumps(item, sort_keys=True, ensure_ascii=False, default=str)
+                        if item_key not in seen and not _is_empty_item(item):
+                            items.append(item)
+                            seen.add(item_key)
+                elif target.get(key) in (None, "", 0, 0.0):
+                    target[key] = value
+    return merged
+
+# Função para extrair os dados das partes de um documento (uma chamada ao modelo por parte, exceto
+# nas dispensadas pelas regras) e juntá-las
+# complete(message_content) retorna o texto do JSON de uma parte. Com refresh=True o cache não é
+# consultado (regeneração), mas o resultado é gravado nele. progress(etapa, concluídos, total) é
+# chamada antes de cada parte
+# Levanta json.JSONDecodeError (com o texto recebido em .doc) se uma resposta não for um JSON válido
+def extract_parts(plans, complete, use_cache=True, refresh=False, progress=None):
+    extractions = []
+    for plan_index, plan in enumerate(plans):
+        if progress is not None:
+            progress("modelo", plan_index, len(plans))
+        message_content = plan["message_content"]
+        if message_content is None:
+            extractions.append(rules_only_extraction(plan["known"]))
+            continue
+        cached_json = load_cached_json(message_content) if use_cache and not refresh else None
+        if cached_json is not None:
+            parsed_json = loads(cached_json)
+        else:
+            parsed_json = loads(complete(message_content))
+            if use_cache:
+                store_cached_json(message_content, dumps(parsed_json, indent=4))
+        extractions.append(fill_known_fields(parsed_json, plan["known"]))
+    return merge_extractions(extractions)
+
+# Função para extrair os dados de um documento de ponta a ponta (sem interface)
+# Levanta json.JSONDecodeError se a resposta do modelo não for um JSON válido
+def extract_document(client, file_bytes, is_pdf, use_cache=True):
+    prepared = prepare_document(file_bytes, is_pdf, use_cache)
+    parsed_json = extract_parts(
+        plan_document_extraction(prepared),
+        lambda message_content: extract_json_text(request_completion(client, message_content)),
+        use_cache,
+    )
+    return parsed_json, prepared
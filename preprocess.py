@@ -0,0 +1,253 @@
+import argparse
+import difflib
+import json
+import os
+import sys
+import time
+
+import cv2
+import numpy as np
+
+# Pré-processamento das páginas antes do OCR: tons de cinza, binarização adaptativa, correção da
+# inclinação, recorte das margens e detecção dos blocos de texto, para que o Tesseract leia só os
+# recortes com texto, com o modo de segmentação adequado. Cada etapa pode ser ligada ou desligada
+# (OFM_PREPROCESS) para medir o tempo e a precisão do OCR de cada uma (python preprocess.py)
+
+# Etapas, na ordem em que são aplicadas
+PREPROCESS_STEPS_ALL = ("cinza", "binarizacao", "inclinacao", "margens", "blocos")
+PREPROCESS_STEPS = tuple(
+    step for step in os.getenv('OFM_PREPROCESS', ",".join(PREPROCESS_STEPS_ALL)).split(",") if step in PREPROCESS_STEPS_ALL
+)
+
+# Modos de segmentação do Tesseract: página inteira (layout automático) e bloco uniforme de texto
+PSM_PAGE = 3
+PSM_BLOCK = 6
+
+# Binarização adaptativa: vizinhança (ímpar, em pixels a 300 DPI) e desconto sobre a média local
+BINARIZE_BLOCK_SIZE = 31
+BINARIZE_OFFSET = 15
+# Inclinação máxima corrigida (graus), passo da busca grossa e precisão da busca fina
+DESKEW_MAX_ANGLE = 5.0
+DESKEW_COARSE_STEP = 0.5
+DESKEW_STEP = 0.1
+# Máximo de pixels de tinta projetados (amostra uniforme dos pixels da página reduzida)
+DESKEW_MAX_POINTS = 20000
+# Largura da página reduzida usada na análise (inclinação e blocos)
+ANALYSIS_WIDTH = 800
+# Folga em volta do conteúdo e dos blocos recortados, em pixels da página original
+CROP_PADDING = 12
+# Acima deste número de blocos a página é lida inteira (cada bloco é uma chamada ao Tesseract)
+MAX_TEXT_BLOCKS = int(os.getenv('OFM_PREPROCESS_MAX_BLOCKS', '12'))
+
+# Função para alterar as etapas ativas (ex: a partir dos argumentos do modo em lote)
+def configure(steps=None):
+    global PREPROCESS_STEPS
+    if steps is not None:
+        PREPROCESS_STEPS = tuple(step for step in PREPROCESS_STEPS_ALL if step in steps)
+
+# Função para obter as etapas ativas (fazem parte da chave do cache do OCR)
+def preprocess_settings():
+    return ",".join(PREPROCESS_STEPS) or "nenhuma"
+
+# Função para converter uma página RGB em tons de cinza
+def to_grayscale(image):
+    return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+
+# Função para binarizar a página com limiar local (remove fundos cinza e sombras da digitalização)
+def binarize(gray):
+    return cv2.adaptiveThreshold(
+        gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY, BINARIZE_BLOCK_SIZE, BINARIZE_OFFSET
+    )
+
+# Função para obter a máscara de tinta (texto = True) de uma página em tons de cinza
+def ink_mask(gray):
+    _, mask = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    return mask > 0
+
+def _analysis_scale(image):
+    return min(1.0, ANALYSIS_WIDTH / image.shape[1])
+
+# Função para escolher, entre os ângulos candidatos, o de perfil de projeção mais concentrado
+# Os pontos são projetados em todos os ângulos de uma vez (NumPy): no ângulo certo as linhas de
+# texto se concentram em poucas faixas e a soma dos quadrados do histograma é máxima
+def _best_projection_angle(ys, xs, angles):
+    radians = np.deg2rad(angles)[:, None]
+    rows = np.round(ys[None, :] * np.cos(radians) - xs[None, :] * np.sin(radians)).astype(np.int64)
+    rows -= rows.min(axis=1, keepdims=True)
+    # Histograma de cada ângulo em uma única contagem, com deslocamento por linha da matriz
+    width = int(rows.max()) + 1
+    offsets = np.arange(len(angles))[:, None] * width
+    counts = np.bincount((rows + offsets).ravel(), minlength=len(angles) * width).reshape(len(angles), width)
+    scores = (counts.astype(np.float64) ** 2).sum(axis=1)
+    return float(angles[int(np.argmax(scores))])
+
+# Função para estimar a inclinação do texto em graus (busca grossa e depois fina em volta da melhor)
+def estimate_skew(gray):
+    scale = _analysis_scale(gray)
+    small = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    ys, xs = np.nonzero(ink_mask(small))
+    if len(xs) < 100:
+        return 0.0
+    stride = -(-len(xs) // DESKEW_MAX_POINTS)
+    ys, xs = ys[::stride], xs[::stride]
+    coarse = _best_projection_angle(ys, xs, np.arange(-DESKEW_MAX_ANGLE, DESKEW_MAX_ANGLE + 1e-9, DESKEW_COARSE_STEP))
+    fine = np.arange(coarse - DESKEW_COARSE_STEP, coarse + DESKEW_COARSE_STEP + 1e-9, DESKEW_STEP)
+    return round(_best_projection_angle(ys, xs, fine), 2)
+
+# Função para girar a página em angle graus (a correção da inclinação usa o ângulo estimado com sinal trocado)
+# O fundo exposto pela rotação fica branco
+def rotate(image, angle):
+    height, width = image.shape[:2]
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), -angle, 1.0)
+    border = (255,) * (image.shape[2] if image.ndim == 3 else 1)
+    return cv2.warpAffine(image, matrix, (width, height), flags=cv2.INTER_LINEAR, borderValue=border)
+
+def _padded(start, end, limit):
+    return max(0, start - CROP_PADDING), min(limit, end + CROP_PADDING)
+
+# Função para encontrar a caixa do conteúdo da página (sem as margens em branco)
+# Linhas e colunas com poucos pixels de tinta (sujeira da digitalização) não contam
+def content_box(mask):
+    height, width = mask.shape
+    rows = np.flatnonzero(mask.sum(axis=1) > max(2, width * 0.002))
+    cols = np.flatnonzero(mask.sum(axis=0) > max(2, height * 0.002))
+    if len(rows) == 0 or len(cols) == 0:
+        return None
+    y0, y1 = _padded(int(rows[0]), int(rows[-1]) + 1, height)
+    x0, x1 = _padded(int(cols[0]), int(cols[-1]) + 1, width)
+    return x0, y0, x1, y1
+
+# Função para detectar os blocos de texto: a tinta é dilatada até as palavras de um parágrafo
+# se unirem, e cada região conectada vira um bloco. Retorna as caixas na ordem de leitura
+def text_blocks(mask):
+    scale = _analysis_scale(mask)
+    small = mask.astype(np.uint8)
+    if scale < 1:
+        small = cv2.resize(small, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, small.shape[1] // 40), max(3, small.shape[0] // 60)))
+    merged = cv2.dilate((small > 0).astype(np.uint8), kernel)
+    contours, _ = cv2.findContours(merged, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    height, width = mask.shape
+    blocks = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        # Pontos e riscos isolados não são texto
+        if w * h < 50:
+            continue
+        x0, x1 = _padded(int(x / scale), int((x + w) / scale), width)
+        y0, y1 = _padded(int(y / scale), int((y + h) / scale), height)
+        blocks.append((x0, y0, x1, y1))
+    return sorted(blocks, key=lambda box: (box[1], box[0]))
+
+# Função para preparar uma página para o OCR
+# Retorna os recortes a ler, na ordem de leitura, com o modo de segmentação de cada um: os blocos
+# de texto (PSM 6) ou a página inteira, sem margens (PSM 3)
+def preprocess_page(image, steps=None):
+    steps = PREPROCESS_STEPS if steps is None else steps
+    if not steps:
+        return [(image, PSM_PAGE)]
+    gray = to_grayscale(image)
+    # A análise usa sempre tons de cinza; a imagem lida pelo Tesseract só é convertida com a etapa "cinza"
+    page = gray if "cinza" in steps else image
+    if "binarizacao" in steps:
+        gray = page = binarize(gray)
+    if "inclinacao" in steps:
+        angle = estimate_skew(gray)
+        if abs(angle) >= DESKEW_STEP:
+            gray = rotate(gray, -angle)
+            page = gray if page.ndim == 2 else rotate(page, -angle)
+    if "margens" not in steps and "blocos" not in steps:
+        return [(page, PSM_PAGE)]
+
+    mask = ink_mask(gray)
+    box = content_box(mask)
+    if box is None:
+        # Página em branco
+        return []
+    x0, y0, x1, y1 = box
+    if "blocos" in steps:
+        blocks = text_blocks(mask[y0:y1, x0:x1])
+        if 0 < len(blocks) <= MAX_TEXT_BLOCKS:
+            return [(page[y0 + by0:y0 + by1, x0 + bx0:x0 + bx1], PSM_BLOCK) for bx0, by0, bx1, by1 in blocks]
+    return [(page[y0:y1, x0:x1], PSM_PAGE)]
+
+# Função para medir a precisão de caracteres de um texto em relação à referência (0 a 1)
+def char_accuracy(text, reference):
+    normalize = lambda value: " ".join(value.split())
+    return difflib.SequenceMatcher(None, normalize(text), normalize(reference), autojunk=False).ratio()
+
+# Configurações comparadas no benchmark: nenhuma etapa, as etapas acumuladas e todas menos uma
+def benchmark_configurations():
+    configurations = [()]
+    configurations += [PREPROCESS_STEPS_ALL[:i] for i in range(1, len(PREPROCESS_STEPS_ALL) + 1)]
+    configurations += [tuple(step for step in PREPROCESS_STEPS_ALL if step != skipped) for skipped in PREPROCESS_STEPS_ALL]
+    return list(dict.fromkeys(configurations))
+
+# Função para medir o tempo e a precisão do OCR de cada configuração de etapas em um conjunto de páginas
+# pages: [(nome, array RGB, texto de referência ou None)]
+def run_benchmark(pages, lang, backend=None, configurations=None):
+    # Importado aqui: ocr_backends usa este módulo
+    from ocr_backends import ocr_pages
+    results = []
+    for steps in configurations or benchmark_configurations():
+        # Tempo do pré-processamento isolado; a latência de cada página inclui o pré-processamento e o OCR
+        started = time.perf_counter()
+        for _, image, _ in pages:
+            preprocess_page(image, steps)
+        preprocess_time = time.perf_counter() - started
+        started = time.perf_counter()
+        texts, latencies = ocr_pages([image for _, image, _ in pages], lang, backend, steps=steps)
+        accuracies = [char_accuracy(text, reference) for text, (_, _, reference) in zip(texts, pages) if reference is not None]
+        results.append({
+            "etapas": ",".join(steps) or "nenhuma",
+            "paginas": len(pages),
+            "tempo_total": round(time.perf_counter() - started, 3),
+            "tempo_preprocessamento": round(preprocess_time, 3),
+            "tempo_por_pagina": round(sum(latencies) / len(latencies), 3) if latencies else None,
+            "precisao_caracteres": round(sum(accuracies) / len(accuracies), 4) if accuracies else None,
+        })
+    return results
+
+# Função para carregar as páginas do benchmark: imagens e PDFs, com a referência em um .txt de mesmo nome
+def load_benchmark_pages(paths):
+    from pipeline import decode_image, is_pdf_name, render_pdf_pages
+    pages = []
+    for path in paths:
+        stem = os.path.splitext(path)[0]
+        references = []
+        if os.path.exists(stem + ".txt"):
+            with open(stem + ".txt", encoding='utf-8') as reference_file:
+                # Páginas separadas por form feed, como na saída do Tesseract
+                references = reference_file.read().split("\f")
+        with open(path, 'rb') as document:
+            file_bytes = document.read()
+        if is_pdf_name(path):
+            images = [image.copy() for _, image in render_pdf_pages(file_bytes)]
+        else:
+            images = [decode_image(file_bytes)]
+        for i, image in enumerate(images):
+            reference = references[i] if i < len(references) else None
+            pages.append((f"{path}#{i + 1}", image, reference))
+    return pages
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compara o tempo e a precisão do OCR com cada etapa do pré-processamento.")
+    parser.add_argument("documentos", nargs="+", help="Imagens ou PDFs (texto de referência opcional em <nome>.txt)")
+    parser.add_argument("--ocr", choices=["auto", "tesserocr", "pytesseract"], default=None, help="Backend de OCR")
+    parser.add_argument("--idioma", default="por", help="Idioma do Tesseract")
+    parser.add_argument("--saida", default=None, help="Arquivo JSON com os resultados")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(load_benchmark_pages(args.documentos), args.idioma, args.ocr)
+    for result in results:
+        print(
+            f"{result['etapas']:<45} {result['tempo_por_pagina']}s/página, "
+            f"pré-processamento {result['tempo_preprocessamento']}s, precisão {result['precisao_caracteres']}"
+        )
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
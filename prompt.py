@@ -0,0 +1,298 @@
+import functools
+import json
+import logging
+import os
+import re
+
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+# Montagem do prompt enviado ao modelo. As instruções, as definições dos campos e a estrutura
+# do JSON formam um prefixo fixo, montado uma única vez na importação e idêntico em todas as
+# chamadas (aproveitável pelo cache de prompt do provedor); o texto do OCR vem depois,
+# compactado e limitado a um orçamento de tokens
+
+# Estimativa de tokens: ~4 caracteres por token de texto
+CHARS_PER_TOKEN = 4
+# Máximo de tokens estimados do texto do OCR no prompt
+PROMPT_OCR_MAX_TOKENS = int(os.getenv('OFM_PROMPT_OCR_TOKENS', '3000'))
+# Linhas repetidas em outras páginas (cabeçalhos, rodapés) só são removidas a partir deste tamanho
+PROMPT_DEDUP_MIN_CHARS = 4
+# Linhas com menos letras/dígitos que isso, ou com baixa proporção deles, são ruído do OCR
+PROMPT_NOISE_MIN_ALNUM = 2
+PROMPT_NOISE_MIN_ALNUM_RATIO = 0.4
+
+# Definições dos campos do JSON
+FIELD_DEFINITIONS = (
+    "Definições dos campos do JSON a serem preenchidos:\n\n"
+    "1. numeroRps (String) - Número do RPS que gerou a nota fiscal de saída de serviço. Obrigatório: Sim\n"
+    "2. numeroNota (String) - Número da nota fiscal de saída de serviço. Obrigatório: Sim\n"
+    "3. dataEmissao (String) - Data de emissão da nota fiscal de saída (Formato: DD/MM/YYYY HH24:MI:SS). Obrigatório: Sim\n"
+    "4. codigoSerie (String) - Código da série da nota fiscal de serviço. Obrigatório: Não\n"
+    "5. descricaoSerie (String) - Descrição da série da nota fiscal de serviço. Obrigatório: Não\n"
+    "6. codigoModelo (String) - Código do modelo da nota fiscal de serviço. Obrigatório: Sim\n"
+    "7. descricaoModelo (String) - Descrição do modelo da nota fiscal de serviço. Obrigatório: Não\n"
+    "8. cnpjCliente (String) - CNPJ do cliente da nota fiscal de serviço. Obrigatório: Não\n"
+    "9. razaoCliente (String) - Razão social do cliente da nota fiscal de serviço. Obrigatório: Não\n"
+    "10. codIbgeEstadoServico (String) - Código IBGE do estado da execução do serviço. Obrigatório: Sim\n"
+    "11. codIbgeCidadeServico (String) - Código IBGE da cidade da execução do serviço. Obrigatório: Sim\n"
+    "12. tipoTributacaoIss (String) - Tipo de Tributação do ISS (1 a 9). Obrigatório: Sim\n"
+    "   Valores possíveis:\n"
+    "     1. Tributado no Município\n"
+    "     2. Tributado fora do Município\n"
+    "     3. Tributado no Município Isento\n"
+    "     4. Tributado fora do Município Isento\n"
+    "     5. Tributado no Município Imune\n"
+    "     6. Tributado fora do Município Imune\n"
+    "     7. Tributado no Município Suspensa\n"
+    "     8. Tributado fora do Município Suspensa\n"
+    "     9. Exp Servicos\n"
+    "13. valorNotaFiscal (BigDecimal) - Valor da nota fiscal de serviço. Obrigatório: Sim\n"
+    "14. valorMulta (BigDecimal) - Valor da multa na nota fiscal de serviço. Obrigatório: Não\n"
+    "15. valorDesconto (BigDecimal) - Valor do desconto na nota fiscal de serviço. Obrigatório: Não\n"
+    "16. termoRecebimento (String) - Descrição do termo de recebimento da nota fiscal de serviço integrado com o Fusion (Oracle). Obrigatório: Não\n"
+    "17. observacao (String) - Descrição da observação da nota fiscal de serviço. Obrigatório: Sim\n\n"
+    "Servicos:\n"
+    "1. codigoTipoServico (String) - Código do Tipo de Serviço na nota fiscal. Obrigatório: Sim\n"
+    "2. descricaoTipoServico (String) - Descrição do Tipo de Serviço na nota fiscal. Obrigatório: Sim\n"
+    "3. codigoServico (String) - Código do Serviço na nota fiscal. Obrigatório: Sim\n"
+    "4. descricaoServico (String) - Descrição do Serviço na nota fiscal. Obrigatório: Sim\n"
+    "5. quantidadeServico (BigDecimal) - Quantidade do serviço na nota fiscal. Obrigatório: Sim\n"
+    "6. valorServico (BigDecimal) - Valor do serviço na nota fiscal. Obrigatório: Sim\n"
+    "7. valorTotalServico (BigDecimal) - Valor total do serviço na nota fiscal. Obrigatório: Sim\n\n"
+    "ImpostosRetido (Se houver):\n"
+    "1. indicadorImposto (String) - Tipo de imposto (ex: COFINS, PIS/PASEP, ISS, INSS-PJ, INSS-PF, IRRF-PF, IRRF-PJ, CSLL). Obrigatório se houver informação no documento.\n"
+    "2. codigoReceita (String) - Código da Receita. Obrigatório: Não\n"
+    "3. indicadorRetencao (String) - Indica se o imposto possui Retenção. Obrigatório se houver informação no documento.\n"
+    "4. vlrBaseImposto (BigDecimal) - Valor base do Imposto. Obrigatório se houver informação no documento.\n"
+    "5. aliquotaImposto (BigDecimal) - Alíquota do Imposto. Obrigatório se houver informação no documento.\n"
+    "6. vlrImposto (BigDecimal) - Valor do Imposto. Obrigatório se houver informação no documento.\n\n"
+    "Titulos:\n"
+    "1. numeroTitulo (String) - Informar o número do título. Obrigatório: Não\n"
+    "2. dataVencimento (Data) - Data de vencimento do título (Formato: DD/MM/YYYY). Obrigatório: Não\n"
+    "3. cnpjCpfCredorTitulo (String) - CNPJ/CPF do credor do título. Obrigatório: Não\n"
+    "4. valorTitulo (BigDecimal) - Valor do título. Obrigatório: Não\n"
+    "5. indicadorTipoTitulo (String) - Tipo do título ('P' - Título do credor principal, 'R' - Título de retenção). Obrigatório: Não\n"
+)
+
+# Estrutura do JSON a ser preenchido pelo modelo
+JSON_TEMPLATE = (
+    "[\n"
+    "  {\n"
+    "    \"numeroRps\": \"\",\n"
+    "    \"numeroNota\": \"\",\n"
+    "    \"dataEmissao\": \"\",\n"
+    "    \"codigoSerie\": \"\",\n"
+    "    \"descricaoSerie\": \"\",\n"
+    "    \"codigoModelo\": \"\",\n"
+    "    \"descricaoModelo\": \"\",\n"
+    "    \"cnpjCliente\": \"\",\n"
+    "    \"razaoCliente\": \"\",\n"
+    "    \"codIbgeEstadoServico\": \"\",\n"
+    "    \"codIbgeCidadeServico\": \"\",\n"
+    "    \"tipoTributacaoIss\": \"\",\n"
+    "    \"valorNotaFiscal\": 0,\n"
+    "    \"valorMulta\": 0,\n"
+    "    \"valorDesconto\": 0,\n"
+    "    \"termoRecebimento\": \"\",\n"
+    "    \"observacao\": \"\",\n"
+    "    \"Servicos\": [\n"
+    "      {\n"
+    "        \"codigoTipoServico\": \"\",\n"
+    "        \"descricaoTipoServico\": \"\",\n"
+    "        \"codigoServico\": \"\",\n"
+    "        \"descricaoServico\": \"\",\n"
+    "        \"quantidadeServico\": 0,\n"
+    "        \"valorServico\": 0,\n"
+    "        \"valorTotalServico\": 0,\n"
+    "        \"cstSpedEfdSaida\": 0,\n"
+    "        \"aliqPisSpedEfdSaida\": 0.0,\n"
+    "        \"aliqCofinsSpedEfdSaida\": 0.0\n"
+    "      }\n"
+    "    ],\n"
+    "    \"CodigoReceita\": [\n"
+    "      {\n"
+    "        \"codigoReceita\": \"\"\n"
+    "      },\n"
+    "      {\n"
+    "        \"codigoReceita\": \"\"\n"
+    "      }\n"
+    "    ],\n"
+    "    \"ImpostosRetido\": [\n"
+    "      {\n"
+    "        \"indicadorImposto\": \"\",\n"
+    "        \"codigoReceita\": \"\",\n"
+    "        \"indicadorRetencao\": \"\",\n"
+    "        \"vlrBaseImposto\": 0,\n"
+    "        \"aliquotaImposto\": 0.0,\n"
+    "        \"vlrImposto\": 0.0\n"
+    "      }\n"
+    "    ],\n"
+    "    \"Titulos\": [\n"
+    "      {\n"
+    "        \"numeroTitulo\": \"\",\n"
+    "        \"dataVencimento\": \"\",\n"
+    "        \"cnpjCpfCredorTitulo\": \"\",\n"
+    "        \"valorTitulo\": 0,\n"
+    "        \"indicadorTipoTitulo\": \"\"\n"
+    "      }\n"
+    "    ]\n"
+    "  }\n"
+    "]"
+)
+
+PROMPT_INSTRUCTIONS = (
+    "Por favor, analise o documento fornecido e extraia todas as informações relevantes necessárias para preencher o JSON abaixo. "
+    "Note que os arquivos fornecidos podem não seguir um padrão específico, portanto, é importante buscar as informações pertinentes para preencher o JSON, independentemente do formato do documento. "
+    "Utilize tanto o conteúdo das imagens (original e tratada) quanto o texto extraído via OCR fornecido abaixo. "
+    "Corrija todas as incongruências entre o OCR e as imagens para chegar ao melhor resultado possível. "
+    "Preencha o JSON abaixo com os dados extraídos. "
+    "Não inclua descrições adicionais, apenas preencha o JSON seguindo exatamente a estrutura apresentada. "
+    "Sempre responda **apenas com o JSON**, sem incluir qualquer texto adicional ou explicações.\n\n"
+    "Certifique-se de preencher todos os campos com as informações extraídas do documento fornecido e siga a estrutura exata para garantir a compatibilidade com o sistema de integração. "
+    "Por favor, concentre-se apenas nas informações do arquivo; não invente dados. Para os campos que não tiverem informação no arquivo, deixe vazio como \"\".\n\n"
+)
+
+# Prefixo fixo do prompt (não depende do documento)
+PROMPT_PREFIX = (
+    f"{PROMPT_INSTRUCTIONS}"
+    f"{FIELD_DEFINITIONS}\n"
+    "Estrutura do JSON a ser preenchido,  caso não tenha informações suficientes de seção, exiba apenas o array vazio []:\n"
+    f"{JSON_TEMPLATE}\n\n"
+)
+# Campos de primeiro nível da estrutura, na ordem do modelo de JSON
+TEMPLATE_FIELDS = tuple(json.loads(JSON_TEMPLATE)[0])
+PARTIAL_PROMPT_NOTE = (
+    "Os demais campos já foram obtidos do documento por outro meio: preencha apenas os campos da estrutura abaixo.\n"
+)
+OCR_SECTION_HEADER = "Conteúdo extraído via OCR (pode conter erros):\n"
+OCR_TRUNCATION_MARKER = "[... restante do texto omitido ...]"
+
+# Função para estimar os tokens de um texto
+def estimate_text_tokens(text):
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+PROMPT_PREFIX_TOKENS = estimate_text_tokens(PROMPT_PREFIX)
+
+_DEFINITION = re.compile(r'^\d+\. (\w+) \(')
+
+# Função para montar o prefixo do prompt sem os campos de primeiro nível já conhecidos (ex: obtidos
+# pelas regras), encurtando as definições e a estrutura do JSON. Cada combinação de campos é
+# montada uma única vez, e sem campos conhecidos o prefixo é o fixo
+@functools.lru_cache(maxsize=64)
+def prompt_prefix(skip_fields=frozenset()):
+    if not skip_fields:
+        return PROMPT_PREFIX
+    # Definições: o bloco de primeiro nível vem entre o título e a primeira seção (Servicos)
+    title, rest = FIELD_DEFINITIONS.split("\n\n", 1)
+    top_level, sections = rest.split("\n\n", 1)
+    definitions = []
+    number = 0
+    skipping = False
+    for line in top_level.split("\n"):
+        match = _DEFINITION.match(line)
+        if match:
+            skipping = match.group(1) in skip_fields
+            if not skipping:
+                # Renumerar as definições restantes
+                number += 1
+                definitions.append(f"{number}.{line.split('.', 1)[1]}")
+            continue
+        # Linhas de continuação (ex: valores possíveis do tipoTributacaoIss)
+        if not skipping:
+            definitions.append(line)
+    template = json.loads(JSON_TEMPLATE)
+    for field in skip_fields:
+        template[0].pop(field, None)
+    return (
+        f"{PROMPT_INSTRUCTIONS}"
+        f"{PARTIAL_PROMPT_NOTE}\n"
+        f"{title}\n\n" + "\n".join(definitions) + f"\n\n{sections}\n"
+        "Estrutura do JSON a ser preenchido,  caso não tenha informações suficientes de seção, exiba apenas o array vazio []:\n"
+        f"{json.dumps(template, indent=2, ensure_ascii=False)}\n\n"
+    )
+
+_WHITESPACE = re.compile(r'[ \t\f\v\u00a0]+')
+
+# Função para normalizar os espaços de uma linha (sequências de espaços viram um só)
+def normalize_line(line):
+    return _WHITESPACE.sub(' ', line).strip()
+
+# Função para identificar linhas de ruído do OCR (bordas de tabela, traços, sujeira da digitalização)
+def is_noise_line(line):
+    visible = line.replace(' ', '')
+    alnum = sum(1 for char in visible if char.isalnum())
+    return alnum < PROMPT_NOISE_MIN_ALNUM or alnum / len(visible) < PROMPT_NOISE_MIN_ALNUM_RATIO
+
+# Função para compactar o texto do OCR das páginas: normaliza espaços, remove linhas de ruído e
+# linhas já vistas em páginas anteriores e trunca no orçamento de tokens
+# Aceita a lista de textos por página ou um texto único; retorna o texto e um resumo da compactação
+def compact_ocr_text(page_texts, max_tokens=None):
+    max_tokens = PROMPT_OCR_MAX_TOKENS if max_tokens is None else max_tokens
+    if isinstance(page_texts, str):
+        page_texts = [page_texts]
+    stats = {"tokens_originais": estimate_text_tokens("\n".join(page_texts)), "repetidas": 0, "ruido": 0, "truncado": False}
+
+    lines = []
+    seen = set()
+    budget_chars = max_tokens * CHARS_PER_TOKEN
+    used_chars = 0
+    for page_number, text in enumerate(page_texts, start=1):
+        page_lines = []
+        for raw_line in text.splitlines():
+            line = normalize_line(raw_line)
+            if not line:
+                continue
+            if is_noise_line(line):
+                stats["ruido"] += 1
+                continue
+            if line in seen:
+                stats["repetidas"] += 1
+                continue
+            page_lines.append(line)
+        seen.update(line for line in page_lines if len(line) >= PROMPT_DEDUP_MIN_CHARS)
+        if not page_lines:
+            continue
+        # Marcar o início de cada página quando houver mais de uma
+        if len(page_texts) > 1:
+            page_lines.insert(0, f"[Página {page_number}]")
+        for line in page_lines:
+            if used_chars + len(line) + 1 > budget_chars:
+                stats["truncado"] = True
+                break
+            lines.append(line)
+            used_chars += len(line) + 1
+        if stats["truncado"]:
+            lines.append(OCR_TRUNCATION_MARKER)
+            break
+
+    compacted = "\n".join(lines)
+    stats["tokens"] = estimate_text_tokens(compacted)
+    return compacted, stats
+
+# Função para construir o conteúdo da mensagem enviada ao modelo
+# ocr_text: textos do OCR por página (ou um texto único)
+# skip_fields: campos de primeiro nível já conhecidos, que não são pedidos ao modelo
+def build_message_content(ocr_text, base64_combined_image, max_ocr_tokens=None, skip_fields=()):
+    with stage("prompt") as record:
+        prefix = prompt_prefix(frozenset(skip_fields))
+        compacted, stats = compact_ocr_text(ocr_text, max_ocr_tokens)
+        text_chars = len(prefix) + len(OCR_SECTION_HEADER) + len(compacted)
+        record.add(
+            caracteres=text_chars, tokens_estimados=estimate_text_tokens(prefix) + stats["tokens"],
+            bytes_saida=text_chars + len(base64_combined_image),
+        )
+    logger.info(
+        "Prompt: ~%d tokens de OCR (de ~%d; %d linhas repetidas e %d de ruído removidas%s) + ~%d tokens fixos%s",
+        stats["tokens"], stats["tokens_originais"], stats["repetidas"], stats["ruido"],
+        ", truncado" if stats["truncado"] else "", estimate_text_tokens(prefix),
+        f" ({len(skip_fields)} campos já conhecidos)" if skip_fields else "",
+    )
+    # Os arquivos podem não seguir um padrão, então o prompt pede para buscar as informações independentemente do formato
+    return [
+        {"type": "text", "text": prefix},
+        {"type": "text", "text": f"{OCR_SECTION_HEADER}{compacted}"},
+        # Imagem combinada (original e tratada)
+        {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{base64_combined_image}"}},
+    ]
@@ -0,0 +1,290 @@
+import csv
+import logging
+import os
+import re
+import unicodedata
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from page_ranking import INVOICE_NUMBER
+from schema import required_fields
+
+logger = logging.getLogger(__name__)
+
+# Extração por regras, executada antes da chamada ao modelo. Campos com padrão verificável
+# (CNPJ com dígitos verificadores, datas válidas, valores monetários, códigos IBGE conferidos
+# na tabela de municípios) são obtidos direto do texto, cada um com uma confiança entre 0 e 1.
+# Os campos confiáveis não são pedidos ao modelo, e quando todos os campos obrigatórios da NFS-e
+# que as regras extraem estão entre eles a chamada ao modelo é dispensada
+
+RULES_ENABLED = os.getenv('OFM_RULES', '1') != '0'
+# Confiança mínima para um campo ser usado sem confirmação do modelo
+RULES_MIN_CONFIDENCE = float(os.getenv('OFM_RULES_MIN_CONFIDENCE', '0.85'))
+# Dispensar o modelo quando todos os campos obrigatórios forem obtidos pelas regras
+RULES_BYPASS_ENABLED = os.getenv('OFM_RULES_BYPASS', '1') != '0'
+# Campos extraídos pelas regras
+RULE_FIELDS = (
+    "numeroRps", "numeroNota", "dataEmissao", "cnpjCliente", "codIbgeEstadoServico", "codIbgeCidadeServico", "valorNotaFiscal",
+)
+# Campos obrigatórios pelas definições da NFS-e que as regras extraem: todos precisam ser confiáveis
+# para dispensar o modelo
+RULES_REQUIRED_FIELDS = tuple(field for field in required_fields() if field in RULE_FIELDS)
+# Valores dos demais campos obrigatórios quando o modelo é dispensado. O modelo do documento é sempre
+# NFS-e; os que as regras não leem (tributação do ISS, observação e a lista de serviços) ficam vazios,
+# e a validação marca a nota como "invalido" para que sejam completados na revisão
+RULES_DEFAULTS = {"codigoModelo": "NFS-e"}
+# Tabela de municípios do IBGE (codigo,nome,uf). A tabela distribuída traz as capitais e os
+# maiores municípios; a lista completa do IBGE pode ser indicada em OFM_IBGE_MUNICIPIOS
+IBGE_TABLE_PATH = os.getenv(
+    'OFM_IBGE_MUNICIPIOS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'municipios_ibge.csv')
+)
+
+# Códigos IBGE das unidades da federação
+UF_CODES = {
+    "RO": "11", "AC": "12", "AM": "13", "RR": "14", "PA": "15", "AP": "16", "TO": "17",
+    "MA": "21", "PI": "22", "CE": "23", "RN": "24", "PB": "25", "PE": "26", "AL": "27", "SE": "28", "BA": "29",
+    "MG": "31", "ES": "32", "RJ": "33", "SP": "35",
+    "PR": "41", "SC": "42", "RS": "43",
+    "MS": "50", "MT": "51", "GO": "52", "DF": "53",
+}
+
+# Função para montar a tabela de remoção de acentos caractere a caractere (as posições no
+# texto são preservadas, então os trechos encontrados no texto sem acentos valem para o original)
+def _build_fold_table():
+    table = {ord('º'): 'o', ord('ª'): 'a'}
+    for code in range(0xC0, 0x250):
+        base = unicodedata.normalize('NFKD', chr(code))[0]
+        if base != chr(code) and base.isascii():
+            table[code] = base
+    return table
+
+_FOLD = _build_fold_table()
+
+# Padrões aplicados ao texto sem acentos
+_CNPJ = re.compile(r'(?<![\d.])(\d{2})\.?(\d{3})\.?(\d{3})/?(\d{4})-?(\d{2})(?!\d)')
+_TOMADOR = re.compile(r'tomador', re.IGNORECASE)
+_DATE = r'(\d{2})/(\d{2})/(\d{4})(?:\s*(?:-|as|,)?\s*(\d{2}):(\d{2})(?::(\d{2}))?)?'
+_EMISSION_DATE = re.compile(
+    r'(?:data\s+(?:e\s+hora\s+)?(?:de\s+|da\s+)?emissao|emitida\s+em)\D{0,30}?' + _DATE, re.IGNORECASE
+)
+_ANY_DATE = re.compile(r'(?<!\d)' + _DATE)
+# Número do RPS só com rótulo explícito ("Número do RPS", "RPS Nº", "RPS número"), logo antes do número:
+# sem ele, a série ou outro número próximo seria lido como o RPS
+_RPS = re.compile(r'(?:\bnumero\s+(?:do\s+)?rps|\brps\s*(?:n[o°]\.?|numero))\s*[:.\-]?\s*(\d{1,15})\b', re.IGNORECASE)
+_AMOUNT = r'\D{0,30}?(?<![\d.,])(\d{1,3}(?:\.\d{3})+,\d{2}|\d+,\d{2})(?![\d,])'
+# Rótulos do valor da nota, do mais específico ao mais genérico, com a confiança de cada um
+_TOTAL_LABELS = (
+    (re.compile(r'valor\s+(?:total\s+)?da\s+(?:nota|nfs-?e)' + _AMOUNT, re.IGNORECASE), 0.95),
+    (re.compile(r'total\s+da\s+nota' + _AMOUNT, re.IGNORECASE), 0.95),
+    (re.compile(r'valor\s+(?:total\s+)?do?s?\s+servicos?' + _AMOUNT, re.IGNORECASE), 0.9),
+    (re.compile(r'valor\s+total\b(?!\s+(?:d[oa]s?\s+)?(?:impostos?|tributos|retenc|dedu))' + _AMOUNT, re.IGNORECASE), 0.7),
+)
+_CITY_CODE = re.compile(
+    r'(?:cod(?:igo)?\.?\s*(?:do\s+)?(?:municipio|ibge|cidade)|ibge)[^\d\n]{0,40}?(?<!\d)(\d{7})(?!\d)', re.IGNORECASE
+)
+_CITY_NAME = r"\s*[:\-]?\s*([A-Za-z][A-Za-z' ]+?)\s*(?:[-/(]\s*([A-Z]{2})\b|\n|$)"
+_SERVICE_CITY = re.compile(
+    r'(?:local\s+da\s+prestacao(?:\s+do\s+servico)?|municipio\s+d[ae]\s+prestacao(?:\s+do\s+servico)?|municipio\s+de\s+incidencia)'
+    + _CITY_NAME,
+    re.IGNORECASE | re.MULTILINE,
+)
+_CITY_HALL = re.compile(
+    r'prefeitura\s+(?:municipal\s+)?(?:do\s+municipio\s+)?d[aeo]\s+' + _CITY_NAME, re.IGNORECASE | re.MULTILINE
+)
+
+_municipalities = None
+
+# Função para remover os acentos de um texto sem alterar o seu comprimento
+def fold_text(text):
+    return text.translate(_FOLD)
+
+# Função para normalizar o nome de um município para busca na tabela
+def _city_key(name):
+    return " ".join(fold_text(name).upper().replace("'", " ").split())
+
+# Função para carregar a tabela de municípios (uma vez por processo)
+# Retorna os códigos válidos e um índice nome normalizado -> [(código, UF)]
+def load_municipalities():
+    global _municipalities
+    if _municipalities is None:
+        codes = set()
+        by_name = {}
+        try:
+            with open(IBGE_TABLE_PATH, encoding='utf-8', newline='') as table:
+                for row in csv.DictReader(table):
+                    codes.add(row["codigo"])
+                    by_name.setdefault(_city_key(row["nome"]), []).append((row["codigo"], row["uf"]))
+        except FileNotFoundError:
+            logger.warning("Tabela de municípios do IBGE não encontrada: %s", IBGE_TABLE_PATH)
+        _municipalities = (codes, by_name)
+    return _municipalities
+
+# Função para validar os dígitos verificadores de um CNPJ (14 dígitos)
+def is_valid_cnpj(digits):
+    if len(digits) != 14 or len(set(digits)) == 1:
+        return False
+    for length in (12, 13):
+        weights = list(range(length - 7, 1, -1)) + list(range(9, 1, -1))
+        total = sum(int(digit) * weight for digit, weight in zip(digits[:length], weights))
+        check = 11 - total % 11
+        if (0 if check >= 10 else check) != int(digits[length]):
+            return False
+    return True
+
+# Função para formatar um CNPJ como 00.000.000/0000-00
+def format_cnpj(digits):
+    return f"{digits[:2]}.{digits[2:5]}.{digits[5:8]}/{digits[8:12]}-{digits[12:]}"
+
+# Função para validar o dígito verificador de um código de município do IBGE
+def is_valid_ibge_code(code):
+    total = 0
+    for i, digit in enumerate(code[:6]):
+        product = int(digit) * (1 if i % 2 == 0 else 2)
+        total += product // 10 + product % 10
+    return code[:2] in UF_CODES.values() and (10 - total % 10) % 10 == int(code[6])
+
+# Função para converter um valor no formato brasileiro (1.234,56) em Decimal exato
+def parse_amount(text):
+    try:
+        return Decimal(text.replace('.', '').replace(',', '.'))
+    except InvalidOperation:
+        return None
+
+# Função para montar a data de emissão no formato DD/MM/YYYY HH:MM:SS (None se a data for inválida)
+def _emission_date(match):
+    day, month, year, hour, minute, second = match.groups()
+    try:
+        value = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0))
+    except ValueError:
+        return None
+    return value.strftime("%d/%m/%Y %H:%M:%S"), hour is not None
+
+# Função para ler a primeira data válida de um texto sem acentos no formato DD/MM/YYYY HH:MM:SS
+# (None se não houver)
+def parse_emission_date(folded):
+    for match in _ANY_DATE.finditer(folded):
+        result = _emission_date(match)
+        if result is not None:
+            return result[0]
+    return None
+
+# Função para ler o primeiro CNPJ com dígitos verificadores válidos de um texto sem acentos,
+# formatado como 00.000.000/0000-00 (None se não houver)
+def find_cnpj(folded):
+    for match in _CNPJ.finditer(folded):
+        digits = "".join(match.groups())
+        if is_valid_cnpj(digits):
+            return format_cnpj(digits)
+    return None
+
+def _extract_cnpj(folded):
+    valid = []
+    for match in _CNPJ.finditer(folded):
+        digits = "".join(match.groups())
+        if is_valid_cnpj(digits):
+            valid.append((match.start(), digits))
+    if not valid:
+        return None
+    # O cliente é o tomador do serviço: o primeiro CNPJ válido depois do rótulo
+    for label in _TOMADOR.finditer(folded):
+        for position, digits in valid:
+            if label.end() <= position <= label.end() + 400:
+                return format_cnpj(digits), 0.9
+    distinct = list(dict.fromkeys(digits for _, digits in valid))
+    # Sem rótulo: prestador e tomador costumam aparecer nessa ordem
+    if len(distinct) == 2:
+        return format_cnpj(distinct[1]), 0.6
+    return format_cnpj(distinct[0]), 0.4
+
+def _extract_emission_date(folded):
+    for match in _EMISSION_DATE.finditer(folded):
+        result = _emission_date(match)
+        if result is not None:
+            value, has_time = result
+            # Sem a hora no texto o horário seria inventado (00:00:00): abaixo da confiança mínima,
+            # para o modelo ler a data e hora completas
+            return value, 0.95 if has_time else 0.7
+    value = parse_emission_date(folded)
+    return (value, 0.5) if value is not None else None
+
+def _extract_total(folded):
+    candidates = []
+    for pattern, confidence in _TOTAL_LABELS:
+        for match in pattern.finditer(folded):
+            value = parse_amount(match.group(1))
+            if value is not None:
+                candidates.append((value, confidence))
+    if not candidates:
+        return None
+    value, confidence = max(candidates, key=lambda candidate: candidate[1])
+    # Rótulos confiáveis com valores diferentes: deixar o modelo decidir
+    if any(other != value and other_confidence >= 0.9 for other, other_confidence in candidates):
+        confidence = 0.6
+    return value, confidence
+
+# Função para encontrar um município da tabela a partir do nome capturado (que pode trazer palavras a mais)
+def _lookup_city(name, uf):
+    _, by_name = load_municipalities()
+    words = _city_key(name).split()
+    for length in range(len(words), 0, -1):
+        rows = by_name.get(" ".join(words[:length]))
+        if not rows:
+            continue
+        if uf:
+            rows = [row for row in rows if row[1] == uf.upper()] or rows
+        if len(rows) == 1:
+            return rows[0][0]
+    return None
+
+def _extract_city(folded):
+    codes, _ = load_municipalities()
+    for match in _CITY_CODE.finditer(folded):
+        code = match.group(1)
+        if code in codes:
+            return code, 0.95
+        if is_valid_ibge_code(code):
+            return code, 0.9
+    for pattern, confidence in ((_SERVICE_CITY, 0.9), (_CITY_HALL, 0.75)):
+        for match in pattern.finditer(folded):
+            code = _lookup_city(match.group(1), match.group(2))
+            if code is not None:
+                return code, confidence
+    return None
+
+# Função para extrair os campos por regras a partir dos textos das páginas
+# Retorna {campo: (valor, confiança)} apenas com os campos encontrados
+def pre_extract(page_texts):
+    if isinstance(page_texts, str):
+        page_texts = [page_texts]
+    text = "\n".join(page_texts)
+    folded = fold_text(text)
+    fields = {}
+
+    number = INVOICE_NUMBER.search(text)
+    if number is not None:
+        fields["numeroNota"] = (number.group(1), 0.9)
+    rps = _RPS.search(folded)
+    if rps is not None:
+        fields["numeroRps"] = (rps.group(1), 0.85)
+    for name, extractor in (
+        ("cnpjCliente", _extract_cnpj),
+        ("dataEmissao", _extract_emission_date),
+        ("valorNotaFiscal", _extract_total),
+        ("codIbgeCidadeServico", _extract_city),
+    ):
+        result = extractor(folded)
+        if result is not None:
+            fields[name] = result
+    if "codIbgeCidadeServico" in fields:
+        city_code, confidence = fields["codIbgeCidadeServico"]
+        fields["codIbgeEstadoServico"] = (city_code[:2], confidence)
+    return fields
+
+# Função para separar os campos confiáveis (usados sem confirmação do modelo)
+def confident_fields(fields, min_confidence=None):
+    min_confidence = RULES_MIN_CONFIDENCE if min_confidence is None else min_confidence
+    return {name: value for name, (value, confidence) in fields.items() if confidence >= min_confidence}
+
+# Função para verificar se os campos confiáveis cobrem todos os obrigatórios (modelo dispensado)
+def covers_required_fields(known):
+    return RULES_BYPASS_ENABLED and all(field in known for field in RULES_REQUIRED_FIELDS)
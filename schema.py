@@ -0,0 +1,423 @@
+import argparse
+import csv
+import json
+import re
+import sys
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from prompt import FIELD_DEFINITIONS, JSON_TEMPLATE
+
+# Esquema da NFS-e compilado a partir das definições dos campos e da estrutura do JSON do prompt:
+# tipo de cada campo (texto, decimal exato ou data com formato) e obrigatoriedade. O esquema guia
+# a localização do JSON na resposta do modelo (uma única passada, com colchetes balanceados), a
+# validação e normalização das notas (valores em Decimal, datas no formato da definição, campos
+# obrigatórios) e a exportação em lote em NDJSON ou CSV. Documentos validados ficam em cache pelo
+# texto do JSON, então um texto inalterado (ex: o editor a cada reexecução) não é lido de novo
+
+# Documentos validados mantidos em cache (pelo texto do JSON)
+DOCUMENT_CACHE_SIZE = 64
+
+# Tipos das definições dos campos
+TYPE_KINDS = {"String": "texto", "BigDecimal": "decimal", "Data": "data"}
+# Partes dos formatos de data das definições
+DATE_FORMAT_PARTS = (("DD", "%d"), ("MM", "%m"), ("YYYY", "%Y"), ("HH24", "%H"), ("MI", "%M"), ("SS", "%S"))
+# Formatos de data aceitos na entrada (o modelo e os usuários nem sempre seguem o da definição)
+INPUT_DATE_FORMATS = (
+    "%d/%m/%Y %H:%M:%S", "%d/%m/%Y %H:%M", "%d/%m/%Y", "%d/%m/%y",
+    "%d-%m-%Y %H:%M:%S", "%d-%m-%Y", "%d.%m.%Y",
+    "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d",
+)
+
+_DEFINITION = re.compile(r'^\s*\d+\. (\w+) \((\w+)\) - (.*)$')
+_SECTION = re.compile(r'^(\w+)(?: \(.*\))?:$')
+_DATE_FORMAT = re.compile(r'Formato: ([^)]+)\)')
+
+# Função para converter o formato de data de uma definição (ex: DD/MM/YYYY HH24:MI:SS) para o strftime
+def _strftime_format(definition_format):
+    for part, directive in DATE_FORMAT_PARTS:
+        definition_format = definition_format.replace(part, directive)
+    return definition_format
+
+# Função para ler as definições dos campos por seção ("" para os campos de primeiro nível)
+# Retorna {seção: {campo: (tipo, obrigatório, formato de data ou None)}}
+def _parse_definitions(definitions):
+    sections = {"": {}}
+    section = ""
+    for line in definitions.splitlines():
+        header = _SECTION.match(line)
+        if header and not line.startswith(" "):
+            section = header.group(1)
+            sections.setdefault(section, {})
+            continue
+        definition = _DEFINITION.match(line)
+        if definition is None:
+            continue
+        name, type_name, description = definition.groups()
+        date_format = _DATE_FORMAT.search(description)
+        kind = TYPE_KINDS.get(type_name, "texto")
+        if date_format is not None:
+            kind = "data"
+            date_format = _strftime_format(date_format.group(1).strip())
+        sections[section][name] = (kind, "Obrigatório: Sim" in description, date_format)
+    return sections
+
+# Função para compilar os campos de um objeto: para cada campo da estrutura, o conversor do seu tipo
+# e a obrigatoriedade. Campos sem definição seguem o tipo do valor na estrutura (número: decimal)
+def _compile_fields(template, definitions):
+    fields = OrderedDict()
+    for name, default in template.items():
+        if isinstance(default, list):
+            continue
+        kind, required, date_format = definitions.get(
+            name, ("decimal" if isinstance(default, (int, float)) else "texto", False, None),
+        )
+        if kind == "data":
+            converter = _date_converter(date_format or "%d/%m/%Y")
+        else:
+            converter = _to_decimal if kind == "decimal" else _to_text
+        fields[name] = {"tipo": kind, "obrigatorio": required, "converter": converter}
+    return fields
+
+# Função para compilar o esquema da NFS-e a partir das definições e da estrutura do JSON do prompt
+def compile_schema(definitions=FIELD_DEFINITIONS, json_template=JSON_TEMPLATE):
+    sections = _parse_definitions(definitions)
+    template = json.loads(json_template)[0]
+    lists = OrderedDict(
+        (name, _compile_fields(items[0] if items else {}, sections.get(name, {})))
+        for name, items in template.items() if isinstance(items, list)
+    )
+    return {"campos": _compile_fields(template, sections[""]), "listas": lists, "ordem": tuple(template)}
+
+# Função para converter um valor em texto (números sem casas decimais desnecessárias)
+def _to_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        raise ValueError("esperado texto")
+    if isinstance(value, Decimal):
+        return format(value.to_integral_value() if value == value.to_integral_value() else value, 'f')
+    if isinstance(value, (list, dict)):
+        raise ValueError("esperado texto")
+    return str(value).strip()
+
+# Função para converter um valor em Decimal exato. Números do JSON chegam como Decimal (lidos com
+# loads, sem passar por float); textos aceitam o formato brasileiro (R$ 1.234,56) e o com ponto
+# decimal. Vazio vira 0
+def _to_decimal(value):
+    if value is None or value == "":
+        return Decimal(0)
+    if isinstance(value, bool) or isinstance(value, (list, dict)):
+        raise ValueError("esperado número")
+    if isinstance(value, (int, Decimal)):
+        return Decimal(value)
+    text = str(value).replace("R$", "").replace("%", "").replace(" ", "").strip()
+    if "," in text and "." in text:
+        # O último separador é o decimal
+        text = text.replace(".", "").replace(",", ".") if text.rfind(",") > text.rfind(".") else text.replace(",", "")
+    elif "," in text:
+        text = text.replace(",", ".")
+    elif re.fullmatch(r'-?[1-9]\d{0,2}(\.\d{3}){2,}', text):
+        # Só pontos, em dois ou mais grupos de três dígitos: separador de milhar (1.234.567). Um
+        # ponto só é o separador decimal ("0.065" é uma alíquota, "1.500" é 1,5)
+        text = text.replace(".", "")
+    try:
+        number = Decimal(text)
+    except InvalidOperation:
+        raise ValueError(f"valor numérico inválido: {value!r}") from None
+    if not number.is_finite():
+        raise ValueError(f"valor numérico inválido: {value!r}")
+    return number
+
+# Função para criar o conversor de datas de um formato: aceita os formatos comuns e devolve no da definição
+def _date_converter(date_format):
+    def convert(value):
+        text = _to_text(value)
+        if not text:
+            return ""
+        for input_format in (date_format,) + INPUT_DATE_FORMATS:
+            try:
+                return datetime.strptime(text, input_format).strftime(date_format)
+            except ValueError:
+                continue
+        raise ValueError(f"data inválida: {text!r}")
+    return convert
+
+SCHEMA = compile_schema()
+
+# Função para listar o que uma nota precisa ter pelas definições: os campos obrigatórios de primeiro
+# nível e as listas com algum campo obrigatório nos itens (ex: Servicos), que validate exige com ao
+# menos um item
+def required_fields(schema=SCHEMA):
+    fields = [name for name, field in schema["campos"].items() if field["obrigatorio"]]
+    fields += [name for name, item_fields in schema["listas"].items() if any(field["obrigatorio"] for field in item_fields.values())]
+    return tuple(fields)
+
+# Função para verificar se um valor está vazio (texto vazio, zero, nulo ou lista vazia)
+def _is_empty(value):
+    return value in ("", None, []) or (isinstance(value, (int, float, Decimal)) and not isinstance(value, bool) and value == 0)
+
+# Função para validar e normalizar um objeto com os campos compilados
+# Decimais obrigatórios (valores e quantidades) precisam ser maiores que zero: 0 é o valor da
+# estrutura do prompt, então um zero conta como campo ausente
+# Retorna o objeto normalizado (campos na ordem da estrutura; campos desconhecidos mantidos no final)
+def _validate_object(item, fields, path, errors):
+    normalized = OrderedDict()
+    for name, field in fields.items():
+        value = original = item.get(name)
+        try:
+            value = field["converter"](original)
+        except ValueError as e:
+            errors.append((f"{path}{name}", str(e)))
+        if field["obrigatorio"] and (original is None or original == "" or value == ""):
+            errors.append((f"{path}{name}", "obrigatório"))
+        elif field["obrigatorio"] and isinstance(value, Decimal) and value <= 0:
+            errors.append((f"{path}{name}", "obrigatório (maior que zero)"))
+        normalized[name] = value
+    for name, value in item.items():
+        normalized.setdefault(name, value)
+    return normalized
+
+# Função para validar e normalizar as notas de uma extração (lista de notas ou uma nota)
+# Itens de lista vazios (a estrutura repetida pelo modelo) são removidos; as listas obrigatórias
+# (as de required_fields, ex: Servicos) precisam ter ao menos um item
+# Retorna as notas normalizadas e os erros [(caminho do campo, mensagem)]
+def validate(data, schema=SCHEMA):
+    errors = []
+    invoices = data if isinstance(data, list) else [data]
+    normalized_invoices = []
+    for index, invoice in enumerate(invoices):
+        path = f"[{index}]."
+        if not isinstance(invoice, dict):
+            errors.append((f"[{index}]", "esperado um objeto"))
+            continue
+        normalized = _validate_object(invoice, schema["campos"], path, errors)
+        for list_name, fields in schema["listas"].items():
+            required = any(field["obrigatorio"] for field in fields.values())
+            items = invoice.get(list_name)
+            if items is None or items == "":
+                items = []
+            if not isinstance(items, list):
+                errors.append((f"{path}{list_name}", "esperada uma lista"))
+                continue
+            normalized[list_name] = [
+                _validate_object(item, fields, f"{path}{list_name}[{item_index}].", errors)
+                for item_index, item in enumerate(items)
+                if isinstance(item, dict) and not all(_is_empty(value) for value in item.values())
+            ]
+            if required and not normalized[list_name]:
+                errors.append((f"{path}{list_name}", "obrigatório (ao menos um item)"))
+        # Ordem da estrutura, inclusive para as listas
+        ordered = OrderedDict((name, normalized[name]) for name in schema["ordem"] if name in normalized)
+        ordered.update(normalized)
+        normalized_invoices.append(ordered)
+    return normalized_invoices, errors
+
+# Função para localizar o JSON na resposta do modelo em uma única passada
+# O esquema define a raiz como uma lista de notas: o primeiro "[" seguido de "{" ou "]" (ou um
+# objeto solto, que vira uma lista) é lido até o fechamento correspondente, respeitando strings.
+# Sem JSON, retorna o texto recebido; JSON incompleto é retornado do início até o fim do texto
+def extract_json(text):
+    start = None
+    depth = 0
+    in_string = False
+    escape = False
+    for pos, char in enumerate(text):
+        if start is None:
+            if char in '[{':
+                following = text[pos + 1:pos + 64].lstrip()[:1]
+                if (char == '[' and following in ('{', ']')) or (char == '{' and following in ('"', '}')):
+                    start = pos
+                    depth = 1
+            continue
+        if in_string:
+            if escape:
+                escape = False
+            elif char == '\\':
+                escape = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '[{':
+            depth += 1
+        elif char in ']}':
+            depth -= 1
+            if depth == 0:
+                found = text[start:pos + 1]
+                return found if found[0] == '[' else f"[{found}]"
+    return text if start is None else text[start:]
+
+# Função para ler um texto JSON com os números com casas decimais em Decimal, sem passar por float
+# ("1500.00" continua 1500.00)
+def loads(text):
+    return json.loads(text, parse_float=Decimal)
+
+# Função para serializar um valor em JSON com os Decimal como números exatos
+# indent=None gera uma linha (NDJSON); com indent, o mesmo formato de json.dumps(indent=...)
+def dumps(value, indent=None, level=0):
+    if isinstance(value, Decimal):
+        return format(value, 'f')
+    if isinstance(value, dict):
+        items = [f"{json.dumps(str(key), ensure_ascii=False)}: {dumps(item, indent, level + 1)}" for key, item in value.items()]
+        return _join("{", items, "}", indent, level)
+    if isinstance(value, (list, tuple)):
+        return _join("[", [dumps(item, indent, level + 1) for item in value], "]", indent, level)
+    return json.dumps(value, ensure_ascii=False)
+
+def _join(opening, items, closing, indent, level):
+    if not items:
+        return opening + closing
+    if indent is None:
+        return opening + ", ".join(items) + closing
+    inner = "\n" + " " * (indent * (level + 1))
+    return opening + inner + ("," + inner).join(items) + "\n" + " " * (indent * level) + closing
+
+# Função para converter os Decimal em float (para quem espera o JSON lido com json.loads)
+def to_plain(value):
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() and value.as_tuple().exponent >= 0 else float(value)
+    if isinstance(value, dict):
+        return {key: to_plain(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [to_plain(item) for item in value]
+    return value
+
+class ValidatedDocument:
+    # Resultado da validação de um JSON: notas normalizadas (data, com Decimal), texto formatado (text),
+    # erros de validação [(caminho, mensagem)] e o erro de leitura (error, json.JSONDecodeError) quando
+    # o texto não é um JSON válido. O mesmo objeto é devolvido pelo cache: não deve ser alterado
+    def __init__(self, text, data=None, errors=(), error=None):
+        self.text = text
+        self.data = data
+        self.errors = list(errors)
+        self.error = error
+
+    @property
+    def valid(self):
+        return self.error is None and not self.errors
+
+_documents = OrderedDict()
+_documents_lock = threading.Lock()
+
+def _remember(key, document):
+    with _documents_lock:
+        _documents[key] = document
+        _documents.move_to_end(key)
+        while len(_documents) > DOCUMENT_CACHE_SIZE:
+            _documents.popitem(last=False)
+    return document
+
+# Função para validar notas já lidas (ex: o resultado de extract_parts) e obter o documento formatado
+# O documento fica no cache pelo seu texto, que é o exibido no editor e baixado pelo usuário
+def validate_document(data):
+    invoices, errors = validate(data)
+    document = ValidatedDocument(dumps(invoices, indent=4), invoices, errors)
+    return _remember(document.text, document)
+
+# Função para obter o documento validado de um texto JSON, lendo e validando só textos novos
+# Textos inválidos também ficam no cache, com o erro de leitura em error
+def load_document(text):
+    with _documents_lock:
+        document = _documents.get(text)
+        if document is not None:
+            _documents.move_to_end(text)
+            return document
+    try:
+        data = loads(text)
+    except json.JSONDecodeError as e:
+        return _remember(text, ValidatedDocument(text, error=e))
+    invoices, errors = validate(data)
+    document = ValidatedDocument(dumps(invoices, indent=4), invoices, errors)
+    _remember(document.text, document)
+    return _remember(text, document)
+
+# Função para percorrer as notas de arquivos de resultado, uma por vez: NDJSON do modo em lote
+# (registros com "dados", inclusive os inválidos) ou arquivos JSON com a lista de notas
+# Retorna (arquivo de origem, número da nota no arquivo, nota normalizada, erros da nota)
+def iter_invoices(paths):
+    for path in paths:
+        with open(path, encoding='utf-8') as input_file:
+            if path.endswith(".ndjson") or path.endswith(".jsonl"):
+                records = (loads(line) for line in input_file if line.strip())
+                sources = ((record["arquivo"], record["dados"]) for record in records if record.get("status") in ("ok", "invalido") and "dados" in record)
+            else:
+                sources = [(path, loads(input_file.read()))]
+            for source, data in sources:
+                invoices = data if isinstance(data, list) else [data]
+                for number, invoice in enumerate(invoices, 1):
+                    normalized, errors = validate([invoice])
+                    if normalized:
+                        yield source, number, normalized[0], [(field[len("[0]."):] if field.startswith("[0].") else field, message) for field, message in errors]
+
+# Função para exportar as notas em NDJSON (uma nota por linha, com a origem e os erros de validação)
+def export_ndjson(invoices, output_file, only_valid=False):
+    count = 0
+    for source, number, invoice, errors in invoices:
+        if only_valid and errors:
+            continue
+        record = {"arquivo": source, "nota": number, "erros": [f"{field}: {message}" for field, message in errors], "dados": invoice}
+        output_file.write(dumps(record) + "\n")
+        count += 1
+    return count
+
+# Função para formatar um valor em uma célula do CSV (decimais com ponto, sem notação científica)
+def _csv_value(value):
+    if isinstance(value, Decimal):
+        return format(value, 'f')
+    return value
+
+# Função para exportar as notas em CSV: uma linha por nota com os campos de primeiro nível ou,
+# com list_name (ex: Servicos), uma linha por item da lista com a identificação da nota
+def export_csv(invoices, output_file, list_name=None, only_valid=False, schema=SCHEMA):
+    if list_name is not None and list_name not in schema["listas"]:
+        raise ValueError(f"Lista desconhecida: {list_name}")
+    if list_name is None:
+        columns = list(schema["campos"])
+    else:
+        columns = ["numeroNota", "cnpjCliente", "item"] + list(schema["listas"][list_name])
+    writer = csv.writer(output_file)
+    writer.writerow(["arquivo", "nota"] + columns + ["erros"])
+    count = 0
+    for source, number, invoice, errors in invoices:
+        if only_valid and errors:
+            continue
+        error_text = "; ".join(f"{field}: {message}" for field, message in errors)
+        if list_name is None:
+            rows = [invoice]
+        else:
+            rows = [
+                dict(item, numeroNota=invoice.get("numeroNota"), cnpjCliente=invoice.get("cnpjCliente"), item=item_index + 1)
+                for item_index, item in enumerate(invoice.get(list_name, []))
+            ]
+        for row in rows:
+            writer.writerow([source, number] + [_csv_value(row.get(column, "")) for column in columns] + [error_text])
+            count += 1
+    return count
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Valida as notas extraídas e exporta em NDJSON ou CSV para a integração.")
+    parser.add_argument("entradas", nargs="+", help="Resultados do modo em lote (.ndjson) ou arquivos JSON com a lista de notas")
+    parser.add_argument("--formato", choices=["ndjson", "csv"], default="ndjson", help="Formato da exportação")
+    parser.add_argument("--lista", default=None, help="Exporta uma linha por item desta lista no CSV (ex: Servicos)")
+    parser.add_argument("--somente-validas", action="store_true", help="Exporta apenas as notas sem erros de validação")
+    parser.add_argument("--saida", default="-", help="Arquivo de saída ('-' para a saída padrão)")
+    args = parser.parse_args(argv)
+
+    invoices = iter_invoices(args.entradas)
+    output_file = sys.stdout if args.saida == "-" else open(args.saida, 'w', encoding='utf-8', newline='')
+    try:
+        if args.formato == "csv":
+            count = export_csv(invoices, output_file, args.lista, args.somente_validas)
+        else:
+            count = export_ndjson(invoices, output_file, args.somente_validas)
+    finally:
+        if output_file is not sys.stdout:
+            output_file.close()
+    print(f"{count} linha(s) exportada(s)", file=sys.stderr)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
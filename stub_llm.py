@@ -0,0 +1,262 @@
+import argparse
+import json
+import random
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Servidor local que imita o endpoint de chat completions compatível com OpenAI usado pela Groq,
+# com latência configurável, cotas de requisições/tokens por minuto (responde 429 com
+# Retry-After) e falhas 5xx aleatórias. Permite saturar o agendador sem gastar a cota real.
+# Requisições com "stream": true recebem a resposta em eventos SSE, um token por vez.
+# Exemplo: python stub_llm.py --porta 8000 --latencia 1.5 --rpm 30
+#          GROQ_BASE_URL=http://127.0.0.1:8000 python batch.py notas/
+
+# Resposta padrão: um JSON no formato esperado, cercado de texto como o modelo costuma fazer
+DEFAULT_CONTENT = (
+    "Segue o JSON extraído:\n"
+    "[\n"
+    "  {\n"
+    "    \"numeroRps\": \"123\",\n"
+    "    \"numeroNota\": \"4567\",\n"
+    "    \"dataEmissao\": \"05/10/2024 10:22:01\",\n"
+    "    \"codigoSerie\": \"\",\n"
+    "    \"descricaoSerie\": \"\",\n"
+    "    \"codigoModelo\": \"NFS-e\",\n"
+    "    \"descricaoModelo\": \"Nota Fiscal de Serviços Eletrônica\",\n"
+    "    \"cnpjCliente\": \"11.222.333/0001-81\",\n"
+    "    \"razaoCliente\": \"Cliente Exemplo Ltda\",\n"
+    "    \"codIbgeEstadoServico\": \"35\",\n"
+    "    \"codIbgeCidadeServico\": \"3550308\",\n"
+    "    \"tipoTributacaoIss\": \"1\",\n"
+    "    \"valorNotaFiscal\": 1234.56,\n"
+    "    \"valorMulta\": 0,\n"
+    "    \"valorDesconto\": 0,\n"
+    "    \"termoRecebimento\": \"\",\n"
+    "    \"observacao\": \"\",\n"
+    "    \"Servicos\": [],\n"
+    "    \"CodigoReceita\": [],\n"
+    "    \"ImpostosRetido\": [],\n"
+    "    \"Titulos\": []\n"
+    "  }\n"
+    "]\n"
+    "Espero ter ajudado!"
+)
+
+# Mesma estimativa de tokens usada pelo agendador
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1600
+
+# Função para estimar os tokens de entrada de uma requisição
+def estimate_prompt_tokens(body):
+    tokens = 0
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, str):
+            tokens += len(content) // CHARS_PER_TOKEN
+            continue
+        for part in content or []:
+            if part.get("type") == "text":
+                tokens += len(part["text"]) // CHARS_PER_TOKEN
+            elif part.get("type") == "image_url":
+                tokens += IMAGE_TOKENS
+    return tokens
+
+class SlidingWindow:
+    # Janela deslizante de 60 segundos para cotas por minuto
+    def __init__(self, limit):
+        self.limit = limit
+        self.events = deque()
+        self.total = 0
+
+    def _expire(self, now):
+        while self.events and now - self.events[0][0] >= 60:
+            self.total -= self.events.popleft()[1]
+
+    # Retorna 0 se a quantidade cabe na cota (e a registra) ou os segundos até haver espaço
+    def try_add(self, amount, now):
+        self._expire(now)
+        if self.total + amount > self.limit and self.events:
+            return max(0.1, 60 - (now - self.events[0][0]))
+        self.events.append((now, amount))
+        self.total += amount
+        return 0
+
+class StubLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.5, jitter=0.0, rpm=None, tpm=None, error_rate=0.0, content=None, token_interval=0.01):
+        super().__init__(address, StubLLMHandler)
+        self.latency = latency
+        # Intervalo entre tokens no modo streaming
+        self.token_interval = token_interval
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.content = content or DEFAULT_CONTENT
+        self.request_window = SlidingWindow(rpm) if rpm else None
+        self.token_window = SlidingWindow(tpm) if tpm else None
+        self.lock = threading.Lock()
+        self.stats = {"requisicoes": 0, "respondidas": 0, "limitadas": 0, "erros": 0, "em_andamento": 0, "pico_em_andamento": 0, "interrompidas": 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key, delta=1):
+        with self.lock:
+            self.stats[key] += delta
+            if key == "em_andamento":
+                self.stats["pico_em_andamento"] = max(self.stats["pico_em_andamento"], self.stats["em_andamento"])
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Envia a resposta em eventos SSE no formato do streaming da API (um token de ~4 caracteres por evento)
+    def _send_stream(self, completion_id, model, content, usage):
+        server = self.server
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        def event(delta, finish_reason=None, extra=None):
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            payload.update(extra or {})
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        try:
+            event({"role": "assistant", "content": ""})
+            for start in range(0, len(content), CHARS_PER_TOKEN):
+                time.sleep(server.token_interval)
+                event({"content": content[start:start + CHARS_PER_TOKEN]})
+            # A Groq informa o uso de tokens no último evento, em x_groq
+            event({}, "stop", {"x_groq": {"id": completion_id, "usage": usage}})
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+            return True
+        except (BrokenPipeError, ConnectionResetError):
+            # O cliente encerrou a conexão (ex: ao encontrar o fim do JSON)
+            server.count("interrompidas")
+            return False
+
+    def do_GET(self):
+        if self.path == "/stats":
+            with self.server.lock:
+                self._send_json(200, dict(self.server.stats))
+        else:
+            self._send_json(404, {"error": {"message": "não encontrado"}})
+
+    def do_POST(self):
+        server = self.server
+        if not self.path.endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": "não encontrado"}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        server.count("requisicoes")
+
+        prompt_tokens = estimate_prompt_tokens(body)
+        completion_tokens = len(server.content) // CHARS_PER_TOKEN
+        now = time.monotonic()
+        with server.lock:
+            retry_after = server.request_window.try_add(1, now) if server.request_window else 0
+            if not retry_after and server.token_window:
+                retry_after = server.token_window.try_add(prompt_tokens + completion_tokens, now)
+        if retry_after:
+            server.count("limitadas")
+            self._send_json(
+                429,
+                {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+                {"Retry-After": f"{retry_after:.2f}"},
+            )
+            return
+
+        server.count("em_andamento")
+        try:
+            delay = max(0.0, server.latency + random.uniform(-server.jitter, server.jitter))
+            time.sleep(delay)
+            if server.error_rate and random.random() < server.error_rate:
+                server.count("erros")
+                self._send_json(503, {"error": {"message": "Service Unavailable", "type": "internal_server_error"}})
+                return
+            completion_id = f"chatcmpl-stub-{random.getrandbits(32):08x}"
+            model = body.get("model", "stub")
+            # Tempos do modelo no formato da Groq: a latência simulada é o processamento do prompt e,
+            # em streaming, a geração dos tokens também é contada
+            completion_time = completion_tokens * server.token_interval if body.get("stream") else 0.0
+            usage = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "queue_time": 0.0,
+                "prompt_time": round(delay, 6),
+                "completion_time": round(completion_time, 6),
+                "total_time": round(delay + completion_time, 6),
+            }
+            if body.get("stream"):
+                if not self._send_stream(completion_id, model, server.content, usage):
+                    return
+            else:
+                self._send_json(200, {
+                    "id": completion_id,
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": model,
+                    "choices": [
+                        {"index": 0, "message": {"role": "assistant", "content": server.content}, "finish_reason": "stop"}
+                    ],
+                    "usage": usage,
+                })
+            server.count("respondidas")
+        finally:
+            server.count("em_andamento", -1)
+
+# Função para iniciar o servidor em uma thread (porta 0 escolhe uma porta livre)
+def start_stub_server(host="127.0.0.1", port=0, **options):
+    server = StubLLMServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Servidor local que imita o endpoint de chat completions da Groq.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--porta", type=int, default=8000)
+    parser.add_argument("--latencia", type=float, default=0.5, help="Latência de cada resposta em segundos")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Variação aleatória da latência em segundos")
+    parser.add_argument("--rpm", type=int, default=None, help="Cota de requisições por minuto (429 ao exceder)")
+    parser.add_argument("--tpm", type=int, default=None, help="Cota de tokens por minuto (429 ao exceder)")
+    parser.add_argument("--taxa-erro", type=float, default=0.0, help="Fração de respostas 503")
+    parser.add_argument("--intervalo-token", type=float, default=0.01, help="Intervalo entre tokens no modo streaming, em segundos")
+    args = parser.parse_args(argv)
+
+    server = StubLLMServer(
+        (args.host, args.porta), latency=args.latencia, jitter=args.jitter, rpm=args.rpm, tpm=args.tpm, error_rate=args.taxa_erro,
+        token_interval=args.intervalo_token,
+    )
+    print(f"Servidor stub em {server.base_url} (use GROQ_BASE_URL={server.base_url})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
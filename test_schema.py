@@ -0,0 +1,30 @@
+from decimal import Decimal
+
+import schema
+
+# Testes de regressão da conversão de números do esquema (python -m pytest)
+
+# Função para verificar que um ponto só é o separador decimal (alíquota enviada como texto)
+def test_to_decimal_single_dot_is_decimal_point():
+    assert schema._to_decimal("0.065") == Decimal("0.065")
+    assert schema._to_decimal("1.5") == Decimal("1.5")
+
+# Função para verificar os separadores de milhar e decimal no formato brasileiro
+def test_to_decimal_brazilian_format():
+    assert schema._to_decimal("1.500,00") == Decimal("1500.00")
+    assert schema._to_decimal("R$ 1.234.567,89") == Decimal("1234567.89")
+    assert schema._to_decimal("1.234.567") == Decimal("1234567")
+
+# Função para verificar que os números do JSON mantêm as casas decimais (sem passar por float)
+def test_load_document_keeps_decimal_scale():
+    document = schema.load_document('[{"valorNotaFiscal": 1500.00}]')
+    assert document.data[0]["valorNotaFiscal"] == Decimal("1500.00")
+    assert '"valorNotaFiscal": 1500.00' in document.text
+
+# Função para verificar que uma lista obrigatória (Servicos) vazia é apontada, como em required_fields
+def test_validate_flags_empty_required_list():
+    assert "Servicos" in schema.required_fields()
+    _, errors = schema.validate([{"Servicos": []}])
+    assert ("[0].Servicos", "obrigatório (ao menos um item)") in errors
+    _, errors = schema.validate([{"Titulos": []}])
+    assert not [field for field, _ in errors if "Titulos" in field]
@@ -0,0 +1,77 @@
+import os
+
+# Detecção e extração da camada de texto embutida em PDFs gerados digitalmente
+# (ex: NFS-e emitidas pelos portais das prefeituras), evitando renderização e OCR
+
+TEXT_LAYER_ENABLED = os.getenv('OFM_TEXT_LAYER', '1') != '0'
+# Mínimo de caracteres alfanuméricos para considerar que a página tem texto de verdade
+# (páginas escaneadas às vezes trazem só um carimbo ou cabeçalho em texto)
+TEXT_LAYER_MIN_CHARS = int(os.getenv('OFM_TEXT_LAYER_MIN_CHARS', '50'))
+# Fração mínima de caracteres imprimíveis entre os visíveis (fontes sem mapeamento Unicode
+# produzem caracteres de controle, de uso privado ou de substituição)
+TEXT_LAYER_MIN_VALID_RATIO = 0.9
+# Fração mínima de letras e dígitos entre os caracteres visíveis
+TEXT_LAYER_MIN_ALNUM_RATIO = 0.5
+
+# Função para verificar se o texto extraído da camada de texto é utilizável
+def is_text_layer_usable(text):
+    visible = [char for char in text if not char.isspace()]
+    alnum = sum(1 for char in visible if char.isalnum())
+    if alnum < TEXT_LAYER_MIN_CHARS:
+        return False
+    valid = sum(
+        1 for char in visible
+        if char.isprintable() and char != '\ufffd' and not ('\ue000' <= char <= '\uf8ff')
+    )
+    return valid / len(visible) >= TEXT_LAYER_MIN_VALID_RATIO and alnum / len(visible) >= TEXT_LAYER_MIN_ALNUM_RATIO
+
+# Função para extrair o texto de uma página do pypdfium2 (None se a camada de texto não for utilizável)
+def extract_text_layer(page):
+    textpage = page.get_textpage()
+    try:
+        text = textpage.get_text_range()
+    finally:
+        textpage.close()
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return text if is_text_layer_usable(text) else None
+
+# Função para extrair as palavras da camada de texto de uma página com suas caixas normalizadas
+# (0 a 1, origem no canto superior esquerdo): [(texto, x0, y0, x1, y1)]
+def extract_words(page):
+    width, height = page.get_size()
+    textpage = page.get_textpage()
+    try:
+        count = textpage.count_chars()
+        text = textpage.get_text_range(0, count)
+        words = []
+        chars = []
+        box = None
+        for index in range(min(count, len(text))):
+            char = text[index]
+            if char.isspace():
+                if chars:
+                    words.append(("".join(chars), *box))
+                chars = []
+                continue
+            left, bottom, right, top = textpage.get_charbox(index)
+            char_box = (left / width, 1 - top / height, right / width, 1 - bottom / height)
+            if not chars:
+                box = char_box
+            else:
+                box = (min(box[0], char_box[0]), min(box[1], char_box[1]), max(box[2], char_box[2]), max(box[3], char_box[3]))
+            chars.append(char)
+        if chars:
+            words.append(("".join(chars), *box))
+        return words
+    finally:
+        textpage.close()
+
+# Função para extrair o texto da camada de texto dentro de uma caixa normalizada (0 a 1, origem no canto superior esquerdo)
+def extract_text_in_box(page, box):
+    width, height = page.get_size()
+    x0, y0, x1, y1 = box
+    textpage = page.get_textpage()
+    try:
+        return textpage.get_text_bounded(left=x0 * width, bottom=(1 - y1) * height, right=x1 * width, top=(1 - y0) * height)
+    finally:
+        textpage.close()